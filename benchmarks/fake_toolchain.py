@@ -0,0 +1,132 @@
+"""
+ベンチマーク用のpdflatexとImageMagick (magick) の代用品
+
+create_fake_toolchainで作ったディレクトリをPATHの先頭に加えると、
+formula.latex_to_pngが呼ぶpdflatexとmagickがこのスクリプトに置き換わる。
+どちらも入力を読むだけで、指定した遅延の後に最小限のPDF・PNGを書き出す。
+TeX LiveやImageMagickがない環境でも、数式の追加処理の流れ全体を計測できる。
+
+使い方:
+    python benchmarks/fake_toolchain.py create ./fake-bin --latency-ms 150
+    PATH=./fake-bin:$PATH python main.py ./base.ymmp latex -f "$x^2$"
+"""
+
+import argparse
+import os
+import platform
+import struct
+import sys
+import time
+import zlib
+from pathlib import Path
+
+# 遅延 (ミリ秒) を伝える環境変数 (create_fake_toolchainで指定した値が既定になる)
+LATENCY_ENV = "FAKE_TOOLCHAIN_LATENCY_MS"
+
+MINIMAL_PDF = b"%PDF-1.4\n1 0 obj<<>>endobj\ntrailer<<>>\n%%EOF\n"
+
+
+def create_png(width: int = 1, height: int = 1) -> bytes:
+    """透明なRGBAのPNGを作成する"""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    rows = b"".join(b"\x00" + b"\x00" * 4 * width for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _sleep() -> None:
+    latency_ms = float(os.getenv(LATENCY_ENV, "0"))
+    if latency_ms > 0:
+        time.sleep(latency_ms / 1000)
+
+
+def run_pdflatex(args: list[str]) -> int:
+    """pdflatex [オプション] file.tex の代わりに、カレントディレクトリにPDFを書き出す"""
+    sources = [arg for arg in args if not arg.startswith("-")]
+    if not sources:
+        print("fake pdflatex: 入力ファイルがありません", file=sys.stderr)
+        return 1
+    tex_file = Path(sources[-1])
+    tex_file.read_text(encoding="utf-8")
+    _sleep()
+    Path(tex_file.with_suffix(".pdf").name).write_bytes(MINIMAL_PDF)
+    print(f"Output written on {tex_file.with_suffix('.pdf').name}")
+    return 0
+
+
+def run_magick(args: list[str]) -> int:
+    """magick convert [オプション] input.pdf output.png の代わりにPNGを書き出す"""
+    try:
+        source, output = args[-2:]
+    except ValueError:
+        print("fake magick: 入力と出力を指定してください", file=sys.stderr)
+        return 1
+    Path(source).read_bytes()
+    _sleep()
+    Path(output).write_bytes(create_png())
+    return 0
+
+
+TOOLS = {"pdflatex": run_pdflatex, "magick": run_magick}
+
+
+def create_fake_toolchain(directory: Path, latency_ms: float = 0.0) -> Path:
+    """
+    pdflatexとmagickの代用品を置いたディレクトリを作成する
+
+    Args:
+        directory (Path): 作成先のディレクトリ
+        latency_ms (float): 1回の実行にかかる時間 (ミリ秒)
+
+    Returns:
+        Path: PATHの先頭に加えるディレクトリ
+    """
+    if platform.system().lower() == "windows":
+        # latex_to_pngはpdflatexを拡張子なしで起動するため、.cmdでは置き換えられない
+        raise RuntimeError("代用品のツールチェーンはWindowsに対応していません。")
+    directory.mkdir(parents=True, exist_ok=True)
+    script = Path(__file__).resolve()
+    for tool in TOOLS:
+        wrapper = directory / tool
+        wrapper.write_text(
+            "#!/bin/sh\n"
+            f': "${{{LATENCY_ENV}:={latency_ms}}}"\n'
+            f"export {LATENCY_ENV}\n"
+            f'exec "{sys.executable}" "{script}" {tool} "$@"\n',
+            encoding="utf-8",
+        )
+        wrapper.chmod(0o755)
+    return directory
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] in TOOLS:
+        sys.exit(TOOLS[sys.argv[1]](sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_create = subparsers.add_parser("create", help="代用品のディレクトリを作成")
+    parser_create.add_argument("directory", help="作成先のディレクトリ")
+    parser_create.add_argument(
+        "--latency-ms", type=float, default=0.0, help="1回の実行にかかる時間"
+    )
+    args = parser.parse_args()
+    directory = create_fake_toolchain(Path(args.directory), args.latency_ms)
+    print(f"PATHの先頭に追加してください: {directory.resolve()}")
+
+
+if __name__ == "__main__":
+    main()
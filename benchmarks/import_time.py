@@ -0,0 +1,137 @@
+"""
+main.pyの起動時のインポート時間を計測し、予算を超えていないか確認するスクリプト
+
+python -X importtime で各サブコマンドを実行し、インタープリター自体の起動で
+読み込まれるモジュールを除いたインポート時間 (各モジュールのself時間の合計) を
+予算と比較する。
+あわせて、サブコマンドごとに読み込んではいけないモジュール (例えばlatexでの
+requestsやVOICEVOXクライアント) が読み込まれていないかを確認する。
+予算超過や不要なインポートがあれば終了コード1で終了する。
+
+使い方:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --repeat 10 --scale 2.0
+"""
+
+import argparse
+import subprocess
+import sys
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# サブコマンドの処理は存在しないプロジェクトを指定して実行する
+# (プロジェクトの読み込みで終了するため、ネットワークや外部コマンドには触れない)
+MISSING_PROJECT = str(Path(tempfile.gettempdir()) / "import_time_missing.ymmp")
+
+# 重い依存や、サブコマンドに無関係なサブシステム
+HEAVY_MODULES = {"requests", "urllib3", "voice", "formula", "scene_pipeline"}
+
+
+@dataclass
+class Scenario:
+    """計測するコマンドと、インポート時間の予算 (ミリ秒)"""
+
+    name: str
+    args: list[str]
+    budget_ms: float
+    forbidden: set[str] = field(default_factory=set)
+
+
+# 予算は実測値 (import main・--helpは5-9 ms、infoは20-32 ms、merge・latexは
+# 35-65 ms) に、実行ごとのぶれを見込んだ余裕を持たせて決めている
+SCENARIOS = [
+    Scenario("import main", ["-c", "import main"], 15.0, HEAVY_MODULES | {"utils"}),
+    Scenario(
+        "--help", [str(ROOT / "main.py"), "--help"], 15.0, HEAVY_MODULES | {"utils"}
+    ),
+    Scenario(
+        "info", [str(ROOT / "main.py"), MISSING_PROJECT, "info"], 45.0, HEAVY_MODULES
+    ),
+    Scenario(
+        "merge",
+        [str(ROOT / "main.py"), MISSING_PROJECT, "merge", MISSING_PROJECT],
+        80.0,
+        HEAVY_MODULES,
+    ),
+    Scenario(
+        "latex",
+        [str(ROOT / "main.py"), MISSING_PROJECT, "latex", "-f", "x"],
+        80.0,
+        {"requests", "urllib3", "voice", "scene_pipeline"},
+    ),
+]
+
+
+def run_importtime(args: list[str]) -> dict[str, int]:
+    """-X importtime付きでPythonを実行し、モジュールごとのself時間 (マイクロ秒) を返す"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+        check=False,
+    )
+    self_times: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _cumulative, name = line[len("import time:") :].split("|")
+        self_times[name.strip()] = int(self_us)
+    return self_times
+
+
+def measure(
+    args: list[str], repeat: int, exclude: frozenset[str] = frozenset()
+) -> tuple[float, set[str]]:
+    """
+    repeat回実行した中で最も短いインポート時間 (ミリ秒) と、読み込まれたモジュールを返す
+
+    excludeのモジュール (インタープリターの起動で読み込まれるもの) は合計に含めない。
+    起動時のsiteや.pthの処理は環境によって大きくぶれるため、差し引くより除外する方が安定する。
+    """
+    runs = [run_importtime(args) for _ in range(repeat)]
+    totals = [
+        sum(us for name, us in run.items() if name not in exclude) for run in runs
+    ]
+    return min(totals) / 1000, set(runs[0])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5, help="各コマンドの実行回数")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="予算に掛ける倍率 (遅い環境向け)"
+    )
+    args = parser.parse_args()
+
+    baseline_ms, baseline_modules = measure(["-c", "pass"], args.repeat)
+    print(f"インタープリターの起動: {baseline_ms:.1f} ms")
+    startup = frozenset(baseline_modules)
+
+    failed = False
+    for scenario in SCENARIOS:
+        elapsed_ms, modules = measure(scenario.args, args.repeat, startup)
+        budget_ms = scenario.budget_ms * args.scale
+        # パッケージ配下のモジュールも含めて判定する (voice.add_voiceなど)
+        loaded = sorted(
+            name
+            for name in modules - baseline_modules
+            if name.split(".")[0] in scenario.forbidden
+        )
+        ok = elapsed_ms <= budget_ms and not loaded
+        failed |= not ok
+        status = "OK" if ok else "NG"
+        print(
+            f"[{status}] {scenario.name}: {elapsed_ms:.1f} ms (予算 {budget_ms:.0f} ms)"
+        )
+        if loaded:
+            print(f"     不要なインポート: {', '.join(loaded)}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""
+シーン追加の処理全体を計測するベンチマーク
+
+VOICEVOXのスタブサーバー (stub_voicevox.py)・pdflatexとImageMagickの代用品
+(fake_toolchain.py)・合成したプロジェクト (synthetic_project.py) を使い、
+外部のツールなしで次の処理の所要時間とスループットを計測する。
+
+- project.load.cold / project.load.warm: プロジェクトの読み込み
+  (スナップショットキャッシュなし / あり)
+- project.save: プロジェクト全体の保存
+- add_voice_scene / add_voice_scene.append: 音声シーンの追加 (全体の書き直し / 追記)
+- add_latex_scene: 数式シーンの追加
+- add_scenes_from_instructions: 指示リストによる一括追加
+
+結果はJSONで書き出し、--compareで以前の結果と比較できる
+(中央値が許容範囲を超えて遅くなったケースがあれば終了コード1で終了する)。
+
+使い方:
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 --output baseline.json
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 --compare baseline.json
+    python benchmarks/run_benchmarks.py --sizes 100000 --repeat 3 --synthesis-latency-ms 50
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Optional
+
+from fake_toolchain import create_fake_toolchain
+from stub_voicevox import StubVoicevoxServer
+
+ROOT = Path(__file__).resolve().parent.parent
+
+RESULT_VERSION = 1
+
+
+@dataclass
+class BenchmarkResult:
+    """
+    1つのケースの計測結果
+
+    Attributes:
+        name (str): ケースの名前
+        size (int): ベースのプロジェクトのアイテム数
+        operations (int): 1回の実行で処理した件数 (シーンの数など)
+        runs_ms (list[float]): 各回の所要時間 (ミリ秒)
+    """
+
+    name: str
+    size: int
+    operations: int
+    runs_ms: list[float]
+
+    @property
+    def median_ms(self) -> float:
+        return statistics.median(self.runs_ms)
+
+    @property
+    def throughput(self) -> float:
+        """1秒あたりの処理件数 (中央値から計算)"""
+        return self.operations / (self.median_ms / 1000) if self.median_ms else 0.0
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            **asdict(self),
+            "median_ms": self.median_ms,
+            "min_ms": min(self.runs_ms),
+            "max_ms": max(self.runs_ms),
+            "throughput_per_s": self.throughput,
+        }
+
+
+def measure(
+    function: Callable[[], Any],
+    repeat: int,
+    setup: Optional[Callable[[], Any]] = None,
+) -> list[float]:
+    """setup (計測しない) とfunctionをrepeat回実行し、functionの所要時間を返す"""
+    runs_ms = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        runs_ms.append((time.perf_counter() - start) * 1000)
+    return runs_ms
+
+
+@contextmanager
+def benchmark_environment(
+    workdir: Path, synthesis_latency_ms: float, toolchain_latency_ms: float
+) -> Iterator[StubVoicevoxServer]:
+    """
+    スタブのVOICEVOXと代用品のツールチェーンを使う作業ディレクトリに移動する
+
+    設定はconfigの読み込み時に環境変数から決まるため、プロジェクトの
+    モジュールはこの中で初めてインポートすること。
+    """
+    toolchain = create_fake_toolchain(workdir / "bin", toolchain_latency_ms)
+    with StubVoicevoxServer(synthesis_latency=synthesis_latency_ms / 1000) as stub:
+        saved_environ = dict(os.environ)
+        saved_cwd = Path.cwd()
+        os.environ["VOICEVOX_API_ENDPOINT"] = stub.url
+        os.environ["YMM4_SNAPSHOT_CACHE_DIR"] = str(workdir / "snapshots")
+        os.environ["PATH"] = f"{toolchain}{os.pathsep}{os.environ['PATH']}"
+        os.chdir(workdir)
+        sys.path.insert(0, str(ROOT))
+        try:
+            yield stub
+        finally:
+            os.chdir(saved_cwd)
+            os.environ.clear()
+            os.environ.update(saved_environ)
+
+
+def make_instructions(count: int) -> list[dict[str, Any]]:
+    """音声と数式を交互に並べた、重複のない指示を作成する"""
+    instructions: list[dict[str, Any]] = []
+    for number in range(count):
+        frame = number * 180
+        if number % 2 == 0:
+            instructions.append(
+                {"type": "voice", "text": f"一括追加のセリフ{number}", "frame": frame}
+            )
+        else:
+            instructions.append(
+                {"type": "latex", "formula": f"$y_{{{number}}}$", "frame": frame}
+            )
+    return instructions
+
+
+def run_size(
+    size: int, workdir: Path, repeat: int, instructions: int
+) -> list[BenchmarkResult]:
+    """1つのプロジェクトの大きさについて全ケースを計測する"""
+    from synthetic_project import generate_project
+
+    from formula.add_latex import add_latex_scene
+    from scene_adder import add_scenes_from_instructions
+    from utils.ymmp_utils import read_ymmp_file, save_ymmp_project
+    from voice.add_voice import VoiceSceneConfig, add_voice_scene
+
+    base = str(generate_project(workdir / f"base_{size}.ymmp", size))
+    output = str(workdir / "output" / f"base_{size}_output.ymmp")
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    snapshots = Path(os.environ["YMM4_SNAPSHOT_CACHE_DIR"])
+
+    def clear_snapshots() -> None:
+        shutil.rmtree(snapshots, ignore_errors=True)
+
+    def clear_output() -> None:
+        for path in Path(output).parent.glob(f"{Path(output).name}*"):
+            path.unlink()
+
+    results = [
+        BenchmarkResult(
+            "project.load.cold",
+            size,
+            1,
+            measure(lambda: read_ymmp_file(base), repeat, setup=clear_snapshots),
+        ),
+        BenchmarkResult(
+            "project.load.warm",
+            size,
+            1,
+            measure(lambda: read_ymmp_file(base), repeat),
+        ),
+    ]
+    project_data = read_ymmp_file(base)
+    results.append(
+        BenchmarkResult(
+            "project.save",
+            size,
+            1,
+            measure(lambda: save_ymmp_project(project_data, output), repeat),
+        )
+    )
+
+    for append in (False, True):
+        config = VoiceSceneConfig(base, "ベンチマークなのだ", output, append=append)
+        results.append(
+            BenchmarkResult(
+                "add_voice_scene.append" if append else "add_voice_scene",
+                size,
+                1,
+                measure(lambda config=config: add_voice_scene(config), repeat),
+            )
+        )
+    results.append(
+        BenchmarkResult(
+            "add_latex_scene",
+            size,
+            1,
+            measure(lambda: add_latex_scene(base, "$e^{i\\pi}=-1$", output), repeat),
+        )
+    )
+    batch = make_instructions(instructions)
+    results.append(
+        BenchmarkResult(
+            "add_scenes_from_instructions",
+            size,
+            instructions,
+            measure(
+                lambda: add_scenes_from_instructions(base, batch, output),
+                repeat,
+                setup=clear_output,
+            ),
+        )
+    )
+    return results
+
+
+def get_git_revision() -> Optional[str]:
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+        check=False,
+    )
+    return result.stdout.strip() or None
+
+
+def compare_results(
+    results: list[dict[str, Any]], baseline: list[dict[str, Any]], tolerance: float
+) -> bool:
+    """
+    以前の結果と1件あたりの所要時間 (中央値) を比較して表示する
+
+    Returns:
+        bool: 許容範囲を超えて遅くなったケースがなければTrue
+    """
+    previous = {(r["name"], r["size"]): r for r in baseline}
+    ok = True
+    for result in results:
+        before = previous.get((result["name"], result["size"]))
+        if before is None:
+            continue
+        before_ms = before["median_ms"] / before["operations"]
+        after_ms = result["median_ms"] / result["operations"]
+        ratio = after_ms / before_ms if before_ms else 1.0
+        regressed = ratio > 1 + tolerance
+        ok &= not regressed
+        print(
+            f"[{'NG' if regressed else 'OK'}] {result['name']} ({result['size']}): "
+            f"{before_ms:.1f} ms -> {after_ms:.1f} ms ({ratio:.2f}x)"
+        )
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000],
+        help="ベースのプロジェクトのアイテム数 (デフォルト: 1000 10000)",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="各ケースの実行回数")
+    parser.add_argument(
+        "--instructions", type=int, default=100, help="一括追加する指示の数"
+    )
+    parser.add_argument(
+        "--synthesis-latency-ms",
+        type=float,
+        default=0.0,
+        help="スタブのVOICEVOXで1件の合成にかかる時間",
+    )
+    parser.add_argument(
+        "--toolchain-latency-ms",
+        type=float,
+        default=0.0,
+        help="代用品のpdflatex・magickの1回の実行にかかる時間",
+    )
+    parser.add_argument(
+        "--output", default=None, help="結果を書き出すJSONファイルのパス"
+    )
+    parser.add_argument(
+        "--compare", default=None, help="比較する以前の結果 (JSONファイルのパス)"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="--compareで許容する中央値の悪化の割合 (デフォルト: 0.2)",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="作業ディレクトリを削除せずに残します。"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    workdir = Path(tempfile.mkdtemp(prefix="ymm4_bench_"))
+    results: list[BenchmarkResult] = []
+    try:
+        with benchmark_environment(
+            workdir, args.synthesis_latency_ms, args.toolchain_latency_ms
+        ) as stub:
+            for size in args.sizes:
+                for result in run_size(size, workdir, args.repeat, args.instructions):
+                    print(
+                        f"{result.name:<32}{size:>8}{result.median_ms:>12.1f} ms"
+                        f"{result.throughput:>12.1f} /s"
+                    )
+                    results.append(result)
+    finally:
+        if args.keep:
+            print(f"作業ディレクトリ: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "version": RESULT_VERSION,
+        "metadata": {
+            "revision": get_git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "instructions": args.instructions,
+            "synthesis_latency_ms": args.synthesis_latency_ms,
+            "toolchain_latency_ms": args.toolchain_latency_ms,
+            "voicevox_requests": dict(stub.requests),
+        },
+        "results": [result.to_dict() for result in results],
+    }
+    if args.output is not None:
+        Path(args.output).write_text(
+            json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+        print(f"結果を書き出しました: {args.output}")
+    if args.compare is not None:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        if not compare_results(report["results"], baseline["results"], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# ruff: noqa: RUF002
+"""
+ベンチマーク用のVOICEVOX互換スタブサーバー
+
+本物のエンジンの代わりに、/version・/speakers・/audio_query・/synthesis・
+/multi_synthesis に応答する。合成結果はセリフの長さに比例した無音のWAVで、
+各エンドポイントに任意の遅延を入れられる。本物のエンジンと同じく合成は
+既定で1件ずつ直列に処理する (--concurrencyで変更できる)。
+
+使い方:
+    python benchmarks/stub_voicevox.py --port 50021 --synthesis-latency-ms 200
+    VOICEVOX_API_ENDPOINT=http://127.0.0.1:50021 python main.py ./base.ymmp voice -t "テスト"
+"""
+
+import argparse
+import functools
+import io
+import json
+import threading
+import time
+import wave
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+from urllib.parse import parse_qs, urlparse
+
+STUB_VERSION = "0.0.0-stub"
+SAMPLE_RATE = 24000
+
+# 1文字あたりの読み上げ時間 (秒)
+SECONDS_PER_CHARACTER = 0.12
+
+
+@functools.lru_cache(maxsize=256)
+def create_silent_wav(frames: int, sample_rate: int = SAMPLE_RATE) -> bytes:
+    """指定したサンプル数の無音のWAV (16bitモノラル) を作成する"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(b"\x00\x00" * frames)
+    return buffer.getvalue()
+
+
+def create_audio_query(text: str, speaker: int) -> dict[str, Any]:
+    """VOICEVOXのaudio_queryと同じ形のクエリを作成する (モーラは1文字1つ)"""
+    moras = [
+        {
+            "text": character,
+            "consonant": None,
+            "consonant_length": None,
+            "vowel": "a",
+            "vowel_length": SECONDS_PER_CHARACTER,
+            "pitch": 5.5,
+        }
+        for character in text
+    ]
+    return {
+        "accent_phrases": [
+            {"moras": moras, "accent": 1, "pause_mora": None, "is_interrogative": False}
+        ],
+        "speedScale": 1.0,
+        "pitchScale": 0.0,
+        "intonationScale": 1.0,
+        "volumeScale": 1.0,
+        "prePhonemeLength": 0.1,
+        "postPhonemeLength": 0.1,
+        "outputSamplingRate": SAMPLE_RATE,
+        "outputStereo": False,
+        "kana": text,
+        "speaker": speaker,
+    }
+
+
+def synthesize(query: dict[str, Any]) -> bytes:
+    """クエリのモーラ数と話速から長さを決めた無音のWAVを返す"""
+    seconds = sum(
+        mora.get("vowel_length") or 0.0
+        for phrase in query.get("accent_phrases", [])
+        for mora in phrase.get("moras", [])
+    )
+    seconds += query.get("prePhonemeLength", 0.0) + query.get("postPhonemeLength", 0.0)
+    speed = query.get("speedScale") or 1.0
+    sample_rate = int(query.get("outputSamplingRate", SAMPLE_RATE))
+    return create_silent_wav(int(seconds / speed * sample_rate), sample_rate)
+
+
+class StubVoicevoxHandler(BaseHTTPRequestHandler):
+    """VOICEVOXエンジンのAPIのうち、このプロジェクトが使う部分を模倣するハンドラー"""
+
+    server: "StubVoicevoxServer"
+
+    def do_GET(self) -> None:  # noqa: N802
+        path = urlparse(self.path).path
+        if path in ("/version", "/speakers"):
+            # 起動確認 (/version) の回数もクライアントの使い回しの指標になる
+            self.server.count(path)
+        if path == "/version":
+            self._respond_json(STUB_VERSION)
+        elif path == "/speakers":
+            self._respond_json(
+                [
+                    {
+                        "name": "ずんだもん",
+                        "speaker_uuid": "stub",
+                        "styles": [{"name": "ノーマル", "id": 1}],
+                    }
+                ]
+            )
+        else:
+            self._respond_json({"detail": "Not Found"}, 404)
+
+    def do_POST(self) -> None:  # noqa: N802
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        stub = self.server
+        try:
+            speaker = int(params.get("speaker", ["1"])[0])
+            if url.path == "/audio_query":
+                stub.wait(stub.query_latency)
+                self._respond_json(create_audio_query(params["text"][0], speaker))
+            elif url.path == "/synthesis":
+                query = json.loads(body)
+                with stub.engine:
+                    stub.wait(stub.synthesis_latency)
+                    data = synthesize(query)
+                self._respond(data, "audio/wav")
+            elif url.path == "/multi_synthesis":
+                queries = json.loads(body)
+                archive = io.BytesIO()
+                with stub.engine, zipfile.ZipFile(archive, "w") as zf:
+                    for number, query in enumerate(queries, start=1):
+                        stub.wait(stub.synthesis_latency)
+                        zf.writestr(f"{number:03d}.wav", synthesize(query))
+                self._respond(archive.getvalue(), "application/zip")
+            else:
+                self._respond_json({"detail": "Not Found"}, 404)
+                return
+        except (KeyError, ValueError) as e:
+            self._respond_json({"detail": f"{type(e).__name__}: {e}"}, 422)
+            return
+        stub.count(url.path)
+
+    def _respond_json(self, body: Any, status: int = 200) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self._respond(data, "application/json", status)
+
+    def _respond(self, data: bytes, content_type: str, status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # リクエストごとのアクセスログは出さない
+        pass
+
+
+class StubVoicevoxServer(ThreadingHTTPServer):
+    """
+    VOICEVOX互換のスタブサーバー
+
+    使い方:
+        with StubVoicevoxServer(synthesis_latency=0.05) as stub:
+            client = VoicevoxClient(stub.url)
+            ...
+        print(stub.requests)
+    """
+
+    daemon_threads = True
+
+    def __init__(  # noqa: PLR0913
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        query_latency: float = 0.0,
+        synthesis_latency: float = 0.0,
+        concurrency: int = 1,
+    ):
+        """
+        Args:
+            host (str): 待ち受けるアドレス
+            port (int): 待ち受けるポート (0の場合は空いているポート)
+            query_latency (float): audio_queryの応答までの遅延 (秒)
+            synthesis_latency (float): 1件の合成にかかる時間 (秒)
+            concurrency (int): 同時に合成する最大数 (本物のエンジンは1)
+        """
+        super().__init__((host, port), StubVoicevoxHandler)
+        self.query_latency = query_latency
+        self.synthesis_latency = synthesis_latency
+        self.engine = threading.BoundedSemaphore(concurrency)
+        self.requests: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @staticmethod
+    def wait(seconds: float) -> None:
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def count(self, path: str) -> None:
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def start(self) -> "StubVoicevoxServer":
+        """別スレッドで応答を開始する"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def __enter__(self) -> "StubVoicevoxServer":
+        return self.start()
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けるアドレス")
+    parser.add_argument("--port", type=int, default=50021, help="待ち受けるポート")
+    parser.add_argument(
+        "--query-latency-ms", type=float, default=0.0, help="audio_queryの遅延"
+    )
+    parser.add_argument(
+        "--synthesis-latency-ms", type=float, default=0.0, help="1件の合成にかかる時間"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="同時に合成する最大数"
+    )
+    args = parser.parse_args()
+
+    server = StubVoicevoxServer(
+        args.host,
+        args.port,
+        query_latency=args.query_latency_ms / 1000,
+        synthesis_latency=args.synthesis_latency_ms / 1000,
+        concurrency=args.concurrency,
+    )
+    print(f"VOICEVOXのスタブを起動しました: {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
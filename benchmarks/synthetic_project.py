@@ -0,0 +1,142 @@
+"""
+ベンチマーク用の大きな.ymmpファイルを生成するスクリプト
+
+音声アイテムと画像アイテムを交互に並べたタイムラインを持つプロジェクトを、
+アイテムを1つずつ書き出しながら作成する (10万アイテムでもメモリに全体を持たない)。
+同じ引数からは常に同じ内容 (Guidを含む) のファイルができる。
+
+使い方:
+    python benchmarks/synthetic_project.py ./bench_10k.ymmp --items 10000
+    python benchmarks/synthetic_project.py ./bench_100k.ymmp --items 100000 --timelines 2
+"""
+
+import argparse
+import json
+import random
+import sys
+import uuid
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+# スクリプトとして直接実行された場合だけ、プロジェクトのルートディレクトリをPythonパスに追加
+if __package__ in (None, ""):
+    sys.path.append(str(Path(__file__).parent.parent.absolute()))
+
+# isort: off
+from utils.ymmp_templates import create_image_item_template, create_voice_item_template
+
+# isort: on
+
+# 1アイテムあたりのフレーム数と、アイテム間の間隔
+ITEM_LENGTH = 120
+ITEM_GAP = 60
+
+_ITEMS_MARKER = "__SYNTHETIC_ITEMS__"
+
+
+def iter_synthetic_items(
+    count: int, rng: random.Random, layers: int = 4
+) -> Iterator[dict[str, Any]]:
+    """音声アイテムと画像アイテムを交互に、重ならないように並べて返す"""
+    frame = 0
+    for number in range(count):
+        layer = number % layers + 1
+        if number % 2 == 0:
+            item = create_voice_item_template(
+                frame=frame,
+                length=ITEM_LENGTH,
+                file_path=f"C:/voices/voice_{number:06d}.wav",
+            )
+            text = f"ベンチマーク用のセリフ{number}番なのだ"
+            item["Serif"] = text
+            item["Hatsuon"] = text
+            item["Remark"] = text
+        else:
+            item = create_image_item_template()
+            item["Frame"] = frame
+            item["Length"] = ITEM_LENGTH
+            item["FilePath"] = f"C:/formulas/formula_{number:06d}.png"
+            item["Remark"] = f"$x_{{{number}}}$"
+        item["Layer"] = layer
+        item["Guid"] = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        yield item
+        frame += ITEM_LENGTH + ITEM_GAP
+
+
+def create_skeleton(timelines: int, fps: int) -> dict[str, Any]:
+    """アイテムを含まないプロジェクトの骨格を作成する"""
+    return {
+        "FilePath": "",
+        "SelectedTimelineIndex": 0,
+        "Timelines": [
+            {
+                "ID": index,
+                "Name": f"タイムライン{index + 1}",
+                "VideoInfo": {
+                    "FPS": fps,
+                    "Hz": 48000,
+                    "Width": 1920,
+                    "Height": 1080,
+                },
+                "Items": [_ITEMS_MARKER],
+                "LayerSettings": {"Items": []},
+                "CurrentFrame": 0,
+                "Length": 0,
+            }
+            for index in range(timelines)
+        ],
+        "Characters": [],
+    }
+
+
+def generate_project(
+    path: Path, items: int, timelines: int = 1, fps: int = 60, seed: int = 0
+) -> Path:
+    """
+    合成したプロジェクトを書き出す
+
+    Args:
+        path (Path): 出力先の.ymmpファイル
+        items (int): タイムライン1つあたりのアイテム数
+        timelines (int): タイムラインの数
+        fps (int): FPS
+        seed (int): Guidを決める乱数のシード
+
+    Returns:
+        Path: 出力先のパス
+    """
+    rng = random.Random(seed)
+    text = json.dumps(create_skeleton(timelines, fps), ensure_ascii=False, indent=2)
+    # YMM4と同じBOM付きUTF-8で、Itemsの中身だけを順番に書き出す
+    parts = text.split(f'"{_ITEMS_MARKER}"')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8-sig") as f:
+        f.write(parts[0])
+        for part in parts[1:]:
+            for number, item in enumerate(iter_synthetic_items(items, rng)):
+                if number:
+                    f.write(",\n")
+                f.write(json.dumps(item, ensure_ascii=False))
+            f.write(part)
+    return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("output", help="出力先の.ymmpファイル")
+    parser.add_argument(
+        "--items", type=int, default=1000, help="タイムライン1つあたりのアイテム数"
+    )
+    parser.add_argument("--timelines", type=int, default=1, help="タイムラインの数")
+    parser.add_argument("--fps", type=int, default=60, help="FPS")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    args = parser.parse_args()
+    path = generate_project(
+        Path(args.output), args.items, args.timelines, args.fps, args.seed
+    )
+    print(f"{path} を生成しました ({path.stat().st_size / 1024 / 1024:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,26 @@
+import functools
 import os
-import platform
 import shutil
 import tempfile
 from pathlib import Path
 
+# configはmain.pyの起動時に読み込まれるため、定数の定義に不要なモジュール
+# (loggingやplatform) は使う関数の中でインポートする。
+
 # 出力ディレクトリの設定
 DEFAULT_OUTPUT_DIR = Path("output")
 
+# 解析済みプロジェクトのスナップショットキャッシュの保存先と上限サイズ
+SNAPSHOT_CACHE_DIR = Path(
+    os.getenv(
+        "YMM4_SNAPSHOT_CACHE_DIR",
+        str(Path.home() / ".cache" / "ymm4_creator" / "snapshots"),
+    )
+)
+SNAPSHOT_CACHE_MAX_BYTES = (
+    int(os.getenv("YMM4_SNAPSHOT_CACHE_MAX_MB", "1024")) * 1024 * 1024
+)
+
 # VOICEVOXの実行ファイルのパス
 # 環境変数から取得、なければデフォルトのインストール場所を使用
 VOICEVOX_PATH = os.getenv(
@@ -15,7 +29,32 @@ VOICEVOX_PATH = os.getenv(
 )
 
 # APIのエンドポイント
-API_ENDPOINT = "http://localhost:50021"
+# (ベンチマークなどで別のVOICEVOX互換サーバーを使う場合は環境変数で上書きする)
+API_ENDPOINT = os.getenv("VOICEVOX_API_ENDPOINT", "http://localhost:50021")
+
+# VOICEVOXへ同時に送る合成リクエストの上限
+# (エンジン側で合成が直列化されるため、増やしても速くならない)
+VOICEVOX_MAX_CONCURRENCY = int(os.getenv("VOICEVOX_MAX_CONCURRENCY", "2"))
+
+# メモリプロファイル (main.py --memory-profile) で許容するPythonのメモリ使用量 (MB)
+# 未設定の場合は予算を設けない
+MEMORY_BUDGET_MB = (
+    float(os.environ["YMM4_MEMORY_BUDGET_MB"])
+    if os.getenv("YMM4_MEMORY_BUDGET_MB")
+    else None
+)
+
+# プロジェクトへの書き込みのロックを待つ最大の秒数
+PROJECT_LOCK_TIMEOUT = float(os.getenv("YMM4_PROJECT_LOCK_TIMEOUT", "60"))
+
+# 常駐モード (daemon.py) の待ち受けアドレス
+DAEMON_HOST = os.getenv("YMM4_DAEMON_HOST", "127.0.0.1")
+DAEMON_PORT = int(os.getenv("YMM4_DAEMON_PORT", "50120"))
+DAEMON_URL = f"http://{DAEMON_HOST}:{DAEMON_PORT}"
+# 常駐プロセスが起動ごとに作る接続用トークンの保存先 (所有者だけが読めるディレクトリ)
+DAEMON_TOKEN_DIR = Path(
+    os.getenv("YMM4_DAEMON_TOKEN_DIR", str(Path.home() / ".cache" / "ymm4_creator"))
+)
 
 
 def get_latex_env_path() -> Path:
@@ -35,7 +74,11 @@ def get_latex_env_path() -> Path:
             return path
 
     # TeX Live環境が見つからない場合、インストールを実行
-    print("TeX Live環境が見つかりません。インストールを開始します...")
+    import logging
+
+    logging.getLogger(__name__).warning(
+        "TeX Live環境が見つかりません。インストールを開始します..."
+    )
     # 動的にインポート
     from formula.build_latex import build_latex_env
 
@@ -55,6 +98,8 @@ def get_latex_env() -> dict[str, str]:
     """
     TeX Live環境の環境変数を取得
     """
+    import platform
+
     latex_env_path = get_latex_env_path()
 
     # 環境変数を設定
@@ -80,9 +125,12 @@ def get_latex_env() -> dict[str, str]:
     return env
 
 
+@functools.cache
 def get_imagemagick_path() -> str:
     """
     ImageMagickのパスを取得する関数
+
+    一度見つけたパスはプロセス内で使い回す (見つからなかった場合は毎回探し直す)。
     """
     # まず環境変数PATHから探す
     magick_path = shutil.which("magick")
@@ -90,6 +138,8 @@ def get_imagemagick_path() -> str:
         return magick_path
 
     # Windowsの場合、一般的なインストール場所を確認
+    import platform
+
     if platform.system().lower() == "windows":
         possible_paths = [
             Path(r"C:\Program Files\ImageMagick-7.1.1-Q16-HDRI\magick.exe"),
@@ -0,0 +1,428 @@
+import argparse
+import hmac
+import json
+import secrets
+import threading
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from config import DAEMON_HOST, DAEMON_PORT, DEFAULT_OUTPUT_DIR, get_imagemagick_path
+from daemon_client import TOKEN_HEADER, write_daemon_token
+from formula.add_latex import build_latex_item, render_latex_asset
+from instruction_reader import iter_instructions, validate_instruction
+from scene_pipeline import ScenePipeline
+from utils import (
+    ProjectIndex,
+    commit_project_items,
+    get_file_version,
+    load_ymmp_project,
+)
+from utils.ymmp_lock import FileVersion
+from utils.ymmp_stream import TimelineRef
+from voice.add_voice import build_voice_item, get_voice_asset_path, render_voice_asset
+from voice.voicevox_client import VoicevoxClient
+
+
+@dataclass
+class LoadedProject:
+    """
+    常駐プロセスが保持しているプロジェクト
+
+    Attributes:
+        base_file (str): 読み込んだベースの.ymmpファイルのパス
+        output_file (str): flushしたときの保存先
+        index (ProjectIndex): プロジェクトデータと集計値
+        version (Optional[FileVersion]): 読み込み時 (または最後に保存した直後) の
+            出力先のバージョン
+        lock (threading.Lock): 追加と保存を排他するロック
+        pending (list): 最後に保存してから追加した (タイムライン, アイテム)
+    """
+
+    base_file: str
+    output_file: str
+    index: ProjectIndex
+    version: Optional[FileVersion] = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    pending: list[tuple[TimelineRef, dict[str, Any]]] = field(default_factory=list)
+
+    @property
+    def dirty(self) -> bool:
+        """最後に保存してから変更があったかどうか"""
+        return bool(self.pending)
+
+
+class SceneDaemon:
+    """
+    VOICEVOXクライアント・ImageMagickのパス・読み込んだプロジェクトを
+    メモリ上に保持したまま、シーンの追加コマンドを受け付けるクラス
+
+    追加したアイテムはメモリ上のプロジェクトにだけ反映し、flushしたときに
+    出力先へ保存する。同じベースと出力先への追加は1つのプロジェクトに積み重なる。
+    """
+
+    def __init__(self, jobs: Optional[int] = None):
+        self.jobs = jobs
+        self._projects: dict[tuple[str, str], LoadedProject] = {}
+        self._lock = threading.Lock()
+        self._batch_lock = threading.Lock()
+        self._voice_client: Optional[VoicevoxClient] = None
+        self._pipeline: Optional[ScenePipeline] = None
+
+    @property
+    def voice_client(self) -> VoicevoxClient:
+        """VOICEVOXクライアント (初めて音声を追加するときにVOICEVOXの起動を確認する)"""
+        with self._lock:
+            if self._voice_client is None:
+                self._voice_client = VoicevoxClient()
+            return self._voice_client
+
+    @property
+    def pipeline(self) -> ScenePipeline:
+        """一括追加で使い回すScenePipeline"""
+        with self._lock:
+            if self._pipeline is None:
+                self._pipeline = ScenePipeline(jobs=self.jobs)
+            return self._pipeline
+
+    def project(self, payload: dict[str, Any]) -> LoadedProject:
+        """
+        コマンドの対象のプロジェクトを取得する (初回はファイルから読み込む)
+
+        Raises:
+            ValueError: プロジェクトを読み込めない場合
+        """
+        base_file = str(Path(payload["project"]).resolve())
+        output_file = payload.get("output") or str(
+            (Path(DEFAULT_OUTPUT_DIR) / f"{Path(base_file).stem}_output.ymmp").resolve()
+        )
+        key = (base_file, output_file)
+        with self._lock:
+            project = self._projects.get(key)
+            if project is None:
+                version = get_file_version(output_file)
+                project_data = load_ymmp_project(base_file)
+                if not project_data:
+                    raise ValueError(f"プロジェクトを読み込めません: {base_file}")
+                project = LoadedProject(
+                    base_file, output_file, ProjectIndex(project_data), version
+                )
+                self._projects[key] = project
+        return project
+
+    def add_voice(self, payload: dict[str, Any]) -> dict[str, Any]:
+        """
+        音声アイテムをタイムラインの最後尾に追加する
+
+        payload: project, text, output, speaker_name, speed, time_margin, timeline
+        """
+        project = self.project(payload)
+        text = payload["text"]
+        speed = payload.get("speed", 1.0)
+        asset = render_voice_asset(
+            text, speed, get_voice_asset_path(text, speed), self.voice_client
+        )
+        item = build_voice_item(
+            text, asset, speaker_name=payload.get("speaker_name", "ずんだもん")
+        )
+        return self._append(project, item, payload, payload.get("time_margin", 1.0))
+
+    def add_latex(self, payload: dict[str, Any]) -> dict[str, Any]:
+        """
+        数式アイテムをタイムラインの最後尾に追加する
+
+        payload: project, formula, output, duration_sec, time_margin_sec, timeline
+        """
+        project = self.project(payload)
+        timeline = project.index.timeline(payload.get("timeline", 0))
+        asset = render_latex_asset(payload["formula"])
+        item = build_latex_item(
+            payload["formula"],
+            asset,
+            length=int(timeline.fps * payload.get("duration_sec", 5.0)),
+        )
+        return self._append(project, item, payload, payload.get("time_margin_sec", 1.0))
+
+    def _append(
+        self,
+        project: LoadedProject,
+        item: dict[str, Any],
+        payload: dict[str, Any],
+        time_margin: float,
+    ) -> dict[str, Any]:
+        with project.lock:
+            timeline = project.index.timeline(payload.get("timeline", 0))
+            frame = timeline.append_after_last(item, timeline.fps * time_margin)
+            project.pending.append((payload.get("timeline", 0), item))
+        if payload.get("flush"):
+            self._flush_project(project)
+        return {"frame": frame, "guid": item.get("Guid"), "output": project.output_file}
+
+    def _with_voice_client(
+        self, pipeline: ScenePipeline, instructions: Iterable[dict[str, Any]]
+    ) -> Iterator[dict[str, Any]]:
+        """
+        最初の音声の指示が来た時点で、使い回すVOICEVOXクライアントをパイプラインに渡す
+
+        数式だけの一括追加ではVOICEVOXを起動しない。
+        """
+        for instruction in instructions:
+            if pipeline.voice_client is None and instruction["type"] == "voice":
+                pipeline.voice_client = self.voice_client
+            yield instruction
+
+    def batch(self, payload: dict[str, Any]) -> dict[str, Any]:
+        """
+        指示リストに基づいて複数のシーンを追加する
+
+        payload: project, output, instructions (指示のリスト) または
+            instructions_file (指示ファイルのパス)
+        """
+        project = self.project(payload)
+        errors: list[str] = []
+        if "instructions_file" in payload:
+            instructions = iter_instructions(
+                payload["instructions_file"], lambda error: errors.append(str(error))
+            )
+        else:
+            instructions = (
+                validate_instruction(instruction)
+                for instruction in payload["instructions"]
+            )
+        added = 0
+        with self._batch_lock:
+            pipeline = self.pipeline
+            for instruction, item in pipeline.run(
+                self._with_voice_client(pipeline, instructions)
+            ):
+                with project.lock:
+                    project.index.append(item, instruction.get("timeline", 0))
+                    project.pending.append((instruction.get("timeline", 0), item))
+                added += 1
+        if payload.get("flush"):
+            self._flush_project(project)
+        return {"added": added, "errors": errors, "output": project.output_file}
+
+    def _flush_project(self, project: LoadedProject) -> bool:
+        with project.lock:
+            if not project.dirty:
+                return False
+            # 他のプロセスが出力先に書き込んでいた場合は、その結果に追加分だけを足す
+            result = commit_project_items(
+                project.index.project_data,
+                project.pending,
+                project.output_file,
+                project.version,
+            )
+            if result is None:
+                return False
+            if result.merged:
+                project.index = ProjectIndex(result.project_data)
+            project.version = result.version
+            project.pending.clear()
+            return True
+
+    def flush(self, payload: dict[str, Any]) -> dict[str, Any]:
+        """
+        変更のあったプロジェクトを出力先に保存する
+
+        payload: project (省略時は全プロジェクト), output
+        """
+        if payload.get("project"):
+            projects = [self.project(payload)]
+        else:
+            with self._lock:
+                projects = list(self._projects.values())
+        saved = [p.output_file for p in projects if self._flush_project(p)]
+        return {"saved": saved}
+
+    def status(self, _payload: dict[str, Any]) -> dict[str, Any]:
+        """保持しているプロジェクトの一覧を返す"""
+        with self._lock:
+            projects = list(self._projects.values())
+        return {
+            "projects": [
+                {
+                    "project": p.base_file,
+                    "output": p.output_file,
+                    "dirty": p.dirty,
+                }
+                for p in projects
+            ]
+        }
+
+    def close(self) -> None:
+        """未保存のプロジェクトを保存し、ワーカープールを停止する"""
+        self.flush({})
+        if self._pipeline is not None:
+            self._pipeline.close()
+
+
+# Hostヘッダーとして受け付けるループバックの名前
+# (他の名前はDNSリバインディングでブラウザーから送られたリクエストとみなす)
+LOOPBACK_HOSTS = frozenset({"127.0.0.1", "localhost", "::1"})
+
+
+def _host_name(host_header: str) -> str:
+    """Hostヘッダーからポートを除いたホスト名を返す"""
+    if host_header.startswith("["):
+        return host_header[1:].split("]", 1)[0]
+    return host_header.rsplit(":", 1)[0] if host_header.count(":") == 1 else host_header
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /<コマンド> でJSONを受け取り、JSONで結果を返すハンドラー
+
+    ブラウザー上のページからの書き込みを防ぐため、Content-Typeが
+    application/jsonで (フォームなどの単純なリクエストでは送れない)、
+    Hostがループバックの名前で、起動ごとのトークンが一致するリクエストだけを受け付ける。
+    """
+
+    server: "DaemonServer"
+
+    def _rejection(self) -> Optional[tuple[int, str]]:
+        """受け付けないリクエストなら (ステータス, 理由) を返す"""
+        host = _host_name(self.headers.get("Host", "")).lower()
+        if host not in self.server.allowed_hosts:
+            return 403, f"許可されていないHostです: {host}"
+        content_type = self.headers.get("Content-Type", "").split(";", 1)[0].strip()
+        if content_type.lower() != "application/json":
+            return 415, "Content-Typeはapplication/jsonを指定してください。"
+        token = self.headers.get(TOKEN_HEADER, "")
+        if not hmac.compare_digest(token.encode("utf-8"), self.server.token.encode()):
+            return 403, f"{TOKEN_HEADER}ヘッダーのトークンが一致しません。"
+        return None
+
+    def do_POST(self) -> None:  # noqa: N802
+        rejection = self._rejection()
+        if rejection is not None:
+            status, reason = rejection
+            self._respond(status, {"error": reason})
+            return
+        handler = self.server.commands.get(self.path.strip("/"))
+        if handler is None:
+            self._respond(404, {"error": f"不明なコマンドです: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            result = handler(payload)
+        except (KeyError, ValueError, TypeError) as e:
+            self._respond(400, {"error": f"{type(e).__name__}: {e}"})
+        except Exception as e:
+            self._respond(500, {"error": f"{type(e).__name__}: {e}"})
+        else:
+            self._respond(200, result)
+
+    def _respond(self, status: int, body: dict[str, Any]) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # 1行追加するたびにアクセスログを出さない
+        pass
+
+
+class DaemonServer(ThreadingHTTPServer):
+    """SceneDaemonのコマンドをHTTPで公開するサーバー"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        daemon: SceneDaemon,
+        token: Optional[str] = None,
+    ):
+        """
+        Args:
+            address (tuple[str, int]): 待ち受けるアドレスとポート
+            daemon (SceneDaemon): コマンドを処理する常駐プロセス
+            token (str, optional): リクエストに求めるトークン. 省略時は生成する.
+        """
+        super().__init__(address, DaemonRequestHandler)
+        self.scene_daemon = daemon
+        self.token = token or secrets.token_urlsafe(32)
+        # 特定のアドレスで待ち受けている場合は、そのアドレスでの接続も受け付ける
+        host = address[0].lower()
+        self.allowed_hosts = LOOPBACK_HOSTS | (
+            {host} if host not in ("", "0.0.0.0", "::") else set()
+        )
+        self.commands: dict[str, Callable[[dict[str, Any]], dict[str, Any]]] = {
+            "voice": daemon.add_voice,
+            "latex": daemon.add_latex,
+            "batch": daemon.batch,
+            "flush": daemon.flush,
+            "status": daemon.status,
+            "shutdown": self._shutdown,
+        }
+
+    def _shutdown(self, _payload: dict[str, Any]) -> dict[str, Any]:
+        # serve_foreverと同じスレッドから呼ぶと止まらないため、別スレッドで停止する
+        threading.Thread(target=self.shutdown, daemon=True).start()
+        return {"shutdown": True}
+
+
+def serve(
+    host: str = DAEMON_HOST, port: int = DAEMON_PORT, jobs: Optional[int] = None
+) -> None:
+    """
+    常駐プロセスを起動する関数
+
+    ローカルからの接続だけを想定している。起動ごとにトークンを生成して
+    所有者だけが読めるファイル (daemon_client.get_token_path) に保存し、
+    トークンを付けたリクエストだけを受け付ける (daemon_clientは自動で付ける)。
+    停止時 (shutdownコマンドまたはCtrl+C) に未保存のプロジェクトを保存する。
+    """
+    daemon = SceneDaemon(jobs=jobs)
+    try:
+        # 起動時にツールチェーンを解決しておく (見つからなければ初回の数式追加時に再試行)
+        get_imagemagick_path()
+    except FileNotFoundError as e:
+        print(e)
+    server = DaemonServer((host, port), daemon)
+    token_path = write_daemon_token(server.server_address[1], server.token)
+    print(f"常駐プロセスを起動しました: http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        token_path.unlink(missing_ok=True)
+        daemon.close()
+        print("常駐プロセスを停止しました。")
+
+
+def main() -> None:
+    r"""メイン関数
+    # 常駐プロセスを起動
+    python daemon.py --port 50120
+
+    # main.pyから常駐プロセスに追加を依頼し、最後に保存する
+    python main.py ./base.ymmp --daemon voice --text "これはテストなのだ"
+    python main.py ./base.ymmp --daemon flush
+    """
+    parser = argparse.ArgumentParser(
+        description="YMM4プロジェクトを編集する常駐プロセスを起動します。"
+    )
+    parser.add_argument("--host", default=DAEMON_HOST, help="待ち受けるアドレス")
+    parser.add_argument(
+        "--port", type=int, default=DAEMON_PORT, help="待ち受けるポート"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None, help="一括追加で並行して描画する最大数"
+    )
+    args = parser.parse_args()
+    serve(args.host, args.port, args.jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import json
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Any, Optional
+
+from config import DAEMON_TOKEN_DIR, DAEMON_URL
+
+# 常駐プロセスへのリクエストに付ける、起動ごとのトークンのヘッダー
+TOKEN_HEADER = "X-YMM4-Daemon-Token"
+
+
+def get_token_path(port: int) -> Path:
+    """ポートで待ち受ける常駐プロセスのトークンファイルのパス"""
+    return DAEMON_TOKEN_DIR / f"daemon-{port}.token"
+
+
+def write_daemon_token(port: int, token: str) -> Path:
+    """トークンを所有者だけが読み書きできるファイルに保存し、そのパスを返す"""
+    DAEMON_TOKEN_DIR.mkdir(parents=True, exist_ok=True, mode=0o700)
+    path = get_token_path(port)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, "w", encoding="utf-8") as f:
+        f.write(token)
+    # 既に別の権限で存在していた場合も所有者だけに絞る
+    path.chmod(0o600)
+    return path
+
+
+def read_daemon_token(url: str) -> Optional[str]:
+    """URLの常駐プロセスのトークンを読み込む (ファイルが無ければNone)"""
+    port = urllib.parse.urlsplit(url).port or 80
+    try:
+        return get_token_path(port).read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+
+
+def send_daemon_command(
+    command: str,
+    payload: Optional[dict[str, Any]] = None,
+    url: str = DAEMON_URL,
+    timeout: Optional[float] = None,
+) -> dict[str, Any]:
+    """
+    常駐プロセス (daemon.py) にコマンドを送り、結果を受け取る関数
+
+    常駐プロセスが起動時に保存したトークン (get_token_path) を読み込んで送る。
+
+    Args:
+        command (str): コマンド名 ("voice", "latex", "batch", "flush", "status", "shutdown")
+        payload (dict, optional): コマンドの引数
+        url (str): 常駐プロセスのURL
+        timeout (float, optional): 応答を待つ秒数
+
+    Returns:
+        dict: コマンドの結果
+
+    Raises:
+        RuntimeError: 接続できない場合や、コマンドが失敗した場合
+    """
+    headers = {"Content-Type": "application/json"}
+    token = read_daemon_token(url)
+    if token is not None:
+        headers[TOKEN_HEADER] = token
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/{command}",
+        data=json.dumps(payload or {}, ensure_ascii=False).encode("utf-8"),
+        headers=headers,
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            result: dict[str, Any] = json.loads(response.read())
+            return result
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read()).get("error", e.reason)
+        except ValueError:
+            message = e.reason
+        raise RuntimeError(f"常駐プロセスでエラーが発生しました: {message}") from e
+    except urllib.error.URLError as e:
+        raise RuntimeError(f"常駐プロセスに接続できません ({url}): {e.reason}") from e
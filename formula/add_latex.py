@@ -1,47 +1,57 @@
+import hashlib
 import json
+import logging
 import sys
 from pathlib import Path
 from typing import Any, Optional
 
-# プロジェクトのルートディレクトリをPythonパスに追加
-sys.path.append(str(Path(__file__).parent.parent.absolute()))
+# スクリプトとして直接実行された場合だけ、プロジェクトのルートディレクトリをPythonパスに追加
+# (パッケージとしてインポートされた場合はsys.pathを書き換えない)
+if __package__ in (None, ""):
+    sys.path.append(str(Path(__file__).parent.parent.absolute()))
 
 # isort: off
 from utils import (
+    TimelineRef,
+    append_project_items,
+    commit_project_items,
+    find_appendable_timeline,
+    get_file_version,
     get_last_frame,
+    get_timeline,
+    get_timeline_fps,
     load_ymmp_project,
-    save_ymmp_project,
 )
+from utils.tracing import span
 from utils.ymmp_templates import create_image_item_template
 from formula.latex_to_png import latex_to_png
 
 # isort: on
 
+logger = logging.getLogger(__name__)
 
-def create_latex_item(
-    latex_formula: str,
-    frame: int = 0,
-    length: int = 300,  # 5秒 * 60fps
-    layer: int = 1,
-) -> dict[str, Any]:
-    """数式アイテムを生成します。
+
+def get_formula_asset_path(latex_formula: str) -> Path:
+    """数式から一意に決まる数式画像のパスを返します。
+
+    hash()はプロセスごとに値が変わるため、内容のハッシュ値をファイル名に使います。
+    """
+    digest = hashlib.sha1(latex_formula.encode()).hexdigest()[:16]
+    return Path("output") / "formulas" / f"formula_{digest}.png"
+
+
+def render_latex_asset(latex_formula: str) -> str:
+    """数式の画像を生成します。
 
     Args:
         latex_formula (str): LaTeX形式の数式
-        frame (int, optional): 開始フレーム. デフォルトは0.
-        length (int, optional): 表示フレーム数. デフォルトは300.
-        layer (int, optional): レイヤー番号. デフォルトは1.
 
     Returns:
-        dict: 生成された数式アイテム
+        str: 生成された画像の絶対パス
     """
     # 出力先のディレクトリが存在しない場合は作成
-    output_dir = Path("output") / "formulas"
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    # 衝突を避けるためにファイル名にハッシュ値などを使うとより安全
-    formula_image_filename = f"formula_{hash(latex_formula)}.png"
-    formula_image_path = output_dir / formula_image_filename
+    formula_image_path = get_formula_asset_path(latex_formula)
+    formula_image_path.parent.mkdir(parents=True, exist_ok=True)
 
     # LaTeX数式をPNG画像に変換
     try:
@@ -50,40 +60,110 @@ def create_latex_item(
         latex_to_png(latex_formula, abs_formula_image_path)
     except Exception as e:
         raise RuntimeError(f"数式の画像変換に失敗しました: {e}") from e
+    return abs_formula_image_path
 
-    # 画像アイテムをテンプレートから作成
-    new_image_item = create_image_item_template()
 
-    # パラメータを設定
-    new_image_item["Frame"] = frame
-    new_image_item["Length"] = length
-    new_image_item["Layer"] = layer
-    new_image_item["FilePath"] = abs_formula_image_path
-    new_image_item["Remark"] = latex_formula
+def build_latex_item(
+    latex_formula: str,
+    file_path: str,
+    frame: int = 0,
+    length: int = 300,
+    layer: int = 1,
+) -> dict[str, Any]:
+    """生成済みの数式画像から数式アイテムを組み立てます。
+
+    Args:
+        latex_formula (str): LaTeX形式の数式
+        file_path (str): 数式画像のパス
+        frame (int, optional): 開始フレーム. デフォルトは0.
+        length (int, optional): 表示フレーム数. デフォルトは300.
+        layer (int, optional): レイヤー番号. デフォルトは1.
+
+    Returns:
+        dict: 数式アイテム
+    """
+    with span("item.build", type="latex"):
+        # 画像アイテムをテンプレートから作成
+        new_image_item = create_image_item_template()
+
+        # パラメータを設定
+        new_image_item["Frame"] = frame
+        new_image_item["Length"] = length
+        new_image_item["Layer"] = layer
+        new_image_item["FilePath"] = file_path
+        new_image_item["Remark"] = latex_formula
 
     return new_image_item
 
 
-def add_latex_scene(
+def create_latex_item(
+    latex_formula: str,
+    frame: int = 0,
+    length: int = 300,  # 5秒 * 60fps
+    layer: int = 1,
+) -> dict[str, Any]:
+    """数式アイテムを生成します。
+
+    Args:
+        latex_formula (str): LaTeX形式の数式
+        frame (int, optional): 開始フレーム. デフォルトは0.
+        length (int, optional): 表示フレーム数. デフォルトは300.
+        layer (int, optional): レイヤー番号. デフォルトは1.
+
+    Returns:
+        dict: 生成された数式アイテム
+    """
+    abs_formula_image_path = render_latex_asset(latex_formula)
+    return build_latex_item(
+        latex_formula,
+        abs_formula_image_path,
+        frame=frame,
+        length=length,
+        layer=layer,
+    )
+
+
+def add_latex_scene(  # noqa: PLR0913
     project_file_path: str,
     latex_formula: str,
     output_file_path: str,
     duration_sec: float = 5.0,
     time_margin_sec: float = 1.0,
+    append: bool = False,
+    timeline: TimelineRef = 0,
 ) -> None:
     """
     YMM4プロジェクトに数式のシーンを追加する関数
-    """
-    # プロジェクトファイルを読み込む
-    project_data = load_ymmp_project(project_file_path)
-    if project_data is None:
-        return
-
-    # FPSを取得
-    fps = project_data.get("Timelines", [{}])[0].get("VideoInfo", {}).get("FPS", 60)
 
-    # タイムラインの最後尾のフレームを取得
-    last_frame = get_last_frame(project_data)
+    appendがTrueの場合、プロジェクト全体を書き直さずItems末尾へ追記する。
+    追記できない構造の場合は全体を書き直す。
+    timelineには追加先のタイムラインのインデックスまたは名前を指定する。
+    """
+    # 他の処理が同じ出力先へ同時に書き込んでいないか、保存時に確認するため記録しておく
+    loaded_version = get_file_version(str(output_file_path))
+
+    # 追記モードでは全体を読み込まずに、FPSと最後尾のフレームを走査で取得する
+    appendable = None
+    if append:
+        appendable = find_appendable_timeline(project_file_path, timeline)
+        if appendable is None:
+            logger.info("追記できない構造のため、プロジェクト全体を書き直します。")
+
+    project_data: Optional[dict[str, Any]] = None
+    if appendable is not None:
+        fps = appendable.fps
+        last_frame = appendable.last_frame
+    else:
+        # プロジェクトファイルを読み込む
+        project_data = load_ymmp_project(project_file_path)
+        if project_data is None:
+            return
+
+        # FPSを取得
+        fps = get_timeline_fps(project_data, timeline)
+
+        # タイムラインの最後尾のフレームを取得
+        last_frame = get_last_frame(project_data, timeline)
 
     # 開始フレームと表示時間を計算
     start_frame = int(last_frame + fps * time_margin_sec)
@@ -96,13 +176,32 @@ def add_latex_scene(
         length=duration_frames,
     )
 
-    # プロジェクトデータに新しいアイテムを追加
-    project_data["Timelines"][0]["Items"].append(new_image_item)
-
-    # 新しいプロジェクトファイルとして保存
-    if not save_ymmp_project(project_data, str(output_file_path)):
+    if appendable is not None:
+        # 元ファイルのItems末尾へ新しいアイテムだけを書き込む
+        saved = append_project_items(
+            project_file_path,
+            [new_image_item],
+            str(output_file_path),
+            appendable,
+            loaded_version,
+        )
+    elif project_data is not None:
+        # 新しいアイテムを追加して保存 (他の処理が先に保存していれば、その結果に追加する)
+        get_timeline(project_data, timeline)["Items"].append(new_image_item)
+        saved = (
+            commit_project_items(
+                project_data,
+                [(timeline, new_image_item)],
+                str(output_file_path),
+                loaded_version,
+            )
+            is not None
+        )
+    else:
+        return
+    if not saved:
         return
-    print(f"LaTeXシーンを追加し、{output_file_path} に保存しました。")
+    logger.info(f"LaTeXシーンを追加し、{output_file_path} に保存しました。")
 
 
 def add_latex(
@@ -8,8 +8,10 @@ from pathlib import Path
 
 import requests
 
-# プロジェクトのルートディレクトリをPythonパスに追加
-sys.path.append(str(Path(__file__).parent.parent.absolute()))
+# スクリプトとして直接実行された場合だけ、プロジェクトのルートディレクトリをPythonパスに追加
+# (パッケージとしてインポートされた場合はsys.pathを書き換えない)
+if __package__ in (None, ""):
+    sys.path.append(str(Path(__file__).parent.parent.absolute()))
 
 
 def get_latex_env_path() -> Path:
@@ -1,11 +1,17 @@
+import hashlib
+import logging
 import os
 import platform
 import subprocess
+import tempfile
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 
 from config import get_imagemagick_path
+from utils.tracing import span
+
+logger = logging.getLogger(__name__)
 
 
 def get_pdflatex_command() -> str:
@@ -61,38 +67,32 @@ def run_pdflatex(pdflatex_cmd: str, tex_file: Path) -> Path:
     Returns:
         Path: 生成されたPDFファイルのパス
     """
-    print(f"実行コマンド: {pdflatex_cmd} -interaction=nonstopmode {tex_file}")
+    logger.debug("実行コマンド: %s -interaction=nonstopmode %s", pdflatex_cmd, tex_file)
     try:
-        # カレントディレクトリを保存
-        original_dir = Path.cwd()
-        # TeXファイルのあるディレクトリに移動
-        os.chdir(tex_file.parent)
-
-        result = subprocess.run(
-            [pdflatex_cmd, "-interaction=nonstopmode", tex_file.name],
-            capture_output=True,
-            text=True,
-            check=False,
-        )
-        print("コマンドの出力:")
-        print(result.stdout)
+        # TeXファイルのあるディレクトリで実行する
+        # (os.chdirはプロセス全体に効くため、並行実行できるようcwdで指定する)
+        with span("formula.tex_compile", tex_file=str(tex_file)) as compile_span:
+            result = subprocess.run(
+                [pdflatex_cmd, "-interaction=nonstopmode", tex_file.name],
+                capture_output=True,
+                text=True,
+                check=False,
+                cwd=tex_file.parent,
+            )
+            compile_span.set(returncode=result.returncode)
+        logger.debug("コマンドの出力:\n%s", result.stdout)
         if result.stderr:
-            print("警告/エラー出力:")
-            print(result.stderr)
+            logger.warning("pdflatexの警告/エラー出力:\n%s", result.stderr)
 
         # PDFファイルが生成されているか確認
         pdf_file = tex_file.with_suffix(".pdf")
         if not pdf_file.exists():
             raise RuntimeError("PDFファイルが生成されませんでした。")
 
-        # 元のディレクトリに戻る
-        os.chdir(original_dir)
         return pdf_file
 
     except Exception as e:
-        print(f"エラーが発生しました: {e}")
-        # 元のディレクトリに戻る
-        os.chdir(original_dir)
+        logger.error(f"pdflatexの実行中にエラーが発生しました: {e}")
         raise
 
 
@@ -110,55 +110,40 @@ def convert_pdf_to_png(pdf_file: Path, output_file: Path, dpi: int) -> None:
         if not pdf_file.exists():
             raise FileNotFoundError(f"PDFファイルが見つかりません: {pdf_file}")
 
-        print(f"PDFファイルのサイズ: {pdf_file.stat().st_size} バイト")
+        logger.debug("PDFファイルのサイズ: %d バイト", pdf_file.stat().st_size)
 
         # ImageMagickのパスを取得
         magick_path = get_imagemagick_path()
-        print(f"ImageMagickのパス: {magick_path}")
+        logger.debug("ImageMagickのパス: %s", magick_path)
 
         # 出力ディレクトリが存在しない場合は作成
         output_file.parent.mkdir(parents=True, exist_ok=True)
 
         # PDFをPNGに変換
-        print("PDFの変換を開始します...")
-        subprocess.run(
-            [
-                magick_path,
-                "convert",
-                "-density",
-                str(dpi),
-                "-background",
-                "none",
-                "-trim",  # 余白を自動的に削除
-                str(pdf_file),
-                str(output_file),
-            ],
-            check=True,
-        )
-        print("PDFの変換が完了しました")
+        with span("formula.rasterize", dpi=dpi, output=str(output_file)):
+            subprocess.run(
+                [
+                    magick_path,
+                    "convert",
+                    "-density",
+                    str(dpi),
+                    "-background",
+                    "none",
+                    "-trim",  # 余白を自動的に削除
+                    str(pdf_file),
+                    str(output_file),
+                ],
+                check=True,
+            )
 
     except Exception as e:
-        print(f"PDF変換エラー: {e}")
+        logger.error(f"PDF変換エラー: {e}")
         # より詳細なエラー情報を出力
         if hasattr(e, "__cause__") and e.__cause__:
-            print(f"エラーの詳細: {type(e.__cause__).__name__}: {e.__cause__!s}")
+            logger.error(f"エラーの詳細: {type(e.__cause__).__name__}: {e.__cause__!s}")
         raise
 
 
-def cleanup_files(base_path: Path) -> None:
-    """
-    一時ファイルを削除する関数
-
-    Args:
-        base_path (Path): ファイルの基本パス (拡張子なし)
-    """
-    for ext in [".aux", ".log", ".pdf"]:
-        try:
-            (base_path.with_suffix(ext)).unlink()
-        except FileNotFoundError:
-            pass
-
-
 @dataclass
 class LaTeXConfig:
     """LaTeX変換の設定を保持するクラス"""
@@ -190,51 +175,48 @@ def latex_to_png(
     if config is None:
         config = LaTeXConfig()
 
-    # デバッグ情報の出力
-    print("=== デバッグ情報 ===")
     pdflatex_cmd = get_pdflatex_command()
-    print(f"pdflatexコマンド: {pdflatex_cmd}")
+    logger.debug("pdflatexコマンド: %s", pdflatex_cmd)
 
-    # 出力パスが指定されていない場合は一時ファイルを作成
+    # 出力パスが指定されていない場合は数式から決まるファイル名にする
     if output_path is None:
-        output_path = f"formula_{hash(text)}.png"
+        output_path = f"formula_{hashlib.sha1(text.encode()).hexdigest()[:16]}.png"
 
     # パスをPathオブジェクトに変換
     output_path = Path(output_path)
-    base_path = output_path.with_suffix("")
-    tex_file = base_path.with_suffix(".tex")
-    pdf_file = base_path.with_suffix(".pdf")
-
-    print(f"TeXファイルのパス: {tex_file}")
-    print(f"PDFファイルのパス: {pdf_file}")
-    print(f"出力ファイルのパス: {output_path}")
+    output_path.parent.mkdir(parents=True, exist_ok=True)
 
     try:
-        # LaTeXドキュメントを作成
-        tex_content = create_latex_document(text, config.font_size, config.text_color)
-        print(f"生成されたTeXドキュメント:\n{tex_content}")
-        tex_file.write_text(tex_content, encoding="utf-8")
-        print("TeXファイルの作成完了")
-
-        # pdflatexコマンドを実行
-        print("pdflatexコマンドを実行中...")
-        pdf_file = run_pdflatex(pdflatex_cmd, tex_file)
-        print("pdflatexコマンドの実行完了")
-
-        # PDFをPNGに変換
-        print("PDFをPNGに変換中...")
-        convert_pdf_to_png(pdf_file, output_path, config.dpi)
-        print("PDFの変換完了")
+        # 同じ数式を同時に変換しても中間ファイル (.tex/.aux/.log/.pdf) を
+        # 奪い合わないよう、呼び出しごとの一時ディレクトリで作業する
+        with tempfile.TemporaryDirectory(
+            prefix=".latex_", dir=output_path.parent
+        ) as work_dir:
+            tex_file = Path(work_dir) / "formula.tex"
+            png_file = Path(work_dir) / "formula.png"
+            logger.debug("作業ディレクトリ: %s", work_dir)
+            logger.debug("出力ファイルのパス: %s", output_path)
+
+            # LaTeXドキュメントを作成
+            tex_content = create_latex_document(
+                text, config.font_size, config.text_color
+            )
+            logger.debug("生成されたTeXドキュメント:\n%s", tex_content)
+            tex_file.write_text(tex_content, encoding="utf-8")
+
+            # pdflatexコマンドを実行
+            pdf_file = run_pdflatex(pdflatex_cmd, tex_file)
+
+            # PDFをPNGに変換し、完成した画像だけをアトミックに出力先へ置く
+            convert_pdf_to_png(pdf_file, png_file, config.dpi)
+            os.replace(png_file, output_path)
 
         # 文字列として返す
         return str(output_path.absolute())
 
     except Exception as e:
-        print(f"エラーの詳細: {type(e).__name__}: {e!s}")
+        logger.error(f"エラーの詳細: {type(e).__name__}: {e!s}")
         raise
-    finally:
-        # 一時ファイルを削除
-        cleanup_files(base_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+import csv
+import json
+import logging
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional, TextIO, Union
+
+from utils import parse_timeline_ref
+
+logger = logging.getLogger(__name__)
+
+# 指示の種類ごとの必須フィールド
+REQUIRED_FIELDS = {"voice": ("text",), "latex": ("formula",)}
+INT_FIELDS = ("frame", "length", "layer")
+FLOAT_FIELDS = ("speed",)
+
+
+@dataclass
+class InstructionError:
+    """指示ファイルの1行を読み込めなかったときのエラー"""
+
+    line: int
+    message: str
+
+    def __str__(self) -> str:
+        return f"{self.line}行目: {self.message}"
+
+
+def report_instruction_error(error: InstructionError) -> None:
+    """読み込めなかった行を警告としてログに出力する (iter_instructionsのデフォルト)"""
+    logger.warning(f"指示を読み飛ばしました: {error}")
+
+
+def validate_instruction(instruction: Any) -> dict[str, Any]:
+    """
+    指示の形式を検証する関数
+
+    Raises:
+        ValueError: 指示の形式が正しくない場合
+    """
+    if not isinstance(instruction, dict):
+        raise ValueError("指示はオブジェクトである必要があります。")
+    instruction_type = instruction.get("type")
+    if instruction_type not in REQUIRED_FIELDS:
+        raise ValueError(f"未対応の指示の種類です: {instruction_type}")
+    for field in REQUIRED_FIELDS[instruction_type]:
+        value = instruction.get(field)
+        if not isinstance(value, str) or not value:
+            raise ValueError(f"{field}が指定されていません。")
+    for field in INT_FIELDS:
+        value = instruction.get(field)
+        if value is not None and (
+            isinstance(value, bool) or not isinstance(value, int)
+        ):
+            raise ValueError(f"{field}は整数である必要があります: {value!r}")
+    for field in FLOAT_FIELDS:
+        value = instruction.get(field)
+        if value is not None and (
+            isinstance(value, bool) or not isinstance(value, (int, float))
+        ):
+            raise ValueError(f"{field}は数値である必要があります: {value!r}")
+    timeline = instruction.get("timeline")
+    if timeline is not None and (
+        isinstance(timeline, bool) or not isinstance(timeline, (int, str))
+    ):
+        raise ValueError(
+            f"timelineはインデックスか名前である必要があります: {timeline!r}"
+        )
+    return instruction
+
+
+def _parse_csv_row(row: dict[str, Optional[str]]) -> dict[str, Any]:
+    """CSVの1行を指示に変換する (空のセルは未指定として扱う)"""
+    if None in row:
+        raise ValueError("列の数がヘッダーより多くなっています。")
+    instruction: dict[str, Any] = {}
+    for field, value in row.items():
+        if value is None or value == "":
+            continue
+        if field in INT_FIELDS:
+            try:
+                instruction[field] = int(value)
+            except ValueError:
+                raise ValueError(
+                    f"{field}は整数である必要があります: {value!r}"
+                ) from None
+        elif field in FLOAT_FIELDS:
+            try:
+                instruction[field] = float(value)
+            except ValueError:
+                raise ValueError(
+                    f"{field}は数値である必要があります: {value!r}"
+                ) from None
+        elif field == "timeline":
+            instruction[field] = parse_timeline_ref(value)
+        else:
+            instruction[field] = value
+    return instruction
+
+
+def _iter_jsonl(
+    f: TextIO,
+) -> Iterator[tuple[int, Union[dict[str, Any], InstructionError]]]:
+    for line_number, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, validate_instruction(json.loads(line))
+        except ValueError as e:
+            # json.JSONDecodeErrorもValueErrorのサブクラス
+            yield line_number, InstructionError(line_number, str(e))
+
+
+def _iter_csv(
+    f: TextIO,
+) -> Iterator[tuple[int, Union[dict[str, Any], InstructionError]]]:
+    reader = csv.DictReader(f)
+    for row in reader:
+        # 改行を含むセルがあっても、行番号はその行の終わりの位置になる
+        line_number = reader.line_num
+        try:
+            yield line_number, validate_instruction(_parse_csv_row(row))
+        except ValueError as e:
+            yield line_number, InstructionError(line_number, str(e))
+
+
+def _iter_json(
+    f: TextIO,
+) -> Iterator[tuple[int, Union[dict[str, Any], InstructionError]]]:
+    # 従来のJSON配列形式はファイル全体を読み込む (番号は配列内の位置)
+    for number, instruction in enumerate(json.load(f), start=1):
+        try:
+            yield number, validate_instruction(instruction)
+        except ValueError as e:
+            yield number, InstructionError(number, str(e))
+
+
+def iter_instructions(
+    path: Union[str, Path],
+    on_error: Optional[Callable[[InstructionError], None]] = None,
+) -> Iterator[dict[str, Any]]:
+    """
+    指示ファイルから指示を1件ずつ読み込むジェネレーター
+
+    JSONL (.jsonl) は1行1指示、CSV (.csv) はヘッダー行の列名をフィールド名として
+    1行1指示で読み込む。どちらも必要な分だけファイルを読み進めるため、
+    指示の数が多くてもメモリ使用量は一定になる。それ以外の拡張子は従来どおり
+    指示の配列を持つJSONファイルとして読み込む。
+
+    形式が正しくない行はon_errorに渡して読み飛ばし、処理は続行する。
+
+    Args:
+        path (str | Path): 指示ファイルのパス
+        on_error (Callable, optional): 読み込めなかった行を受け取る関数.
+            デフォルトは警告としてのログ出力.
+
+    Yields:
+        dict: 指示
+    """
+    on_error = on_error or report_instruction_error
+    suffix = Path(path).suffix.lower()
+    readers = {".jsonl": _iter_jsonl, ".csv": _iter_csv}
+    read = readers.get(suffix, _iter_json)
+    with open(
+        path, encoding="utf-8-sig", newline="" if suffix == ".csv" else None
+    ) as f:
+        for _, result in read(f):
+            if isinstance(result, InstructionError):
+                on_error(result)
+            else:
+                yield result
@@ -1,9 +1,217 @@
 import argparse
+import sys
+from collections.abc import Callable
 from pathlib import Path
+from typing import Any, Union
 
-from config import DEFAULT_OUTPUT_DIR
-from formula.add_latex import add_latex_scene
-from voice.add_voice import VoiceSceneConfig, add_voice_scene
+from config import DAEMON_URL, DEFAULT_OUTPUT_DIR, MEMORY_BUDGET_MB
+
+# 各サブコマンドの処理は、そのサブコマンドが選ばれたときに初めて必要なモジュールを
+# インポートする (例えばlatexではVOICEVOXクライアントやrequestsを読み込まない)。
+# main.pyの先頭では標準ライブラリとconfig以外をインポートしないこと。
+
+
+def parse_timeline_arg(value: str) -> Union[int, str]:
+    """--timelineの値をタイムラインの指定に変換する"""
+    from utils.ymmp_timeline import parse_timeline_ref
+
+    return parse_timeline_ref(value)
+
+
+def print_project_summary(project_file: str) -> None:
+    """プロジェクト全体を展開せずに、タイムラインごとの概要を表示する"""
+    from utils.ymmp_stream import get_ymmp_summary
+
+    summary = get_ymmp_summary(project_file)
+    if summary is None:
+        print(f"プロジェクトの概要を取得できませんでした: {project_file}")
+        return
+    for timeline in summary.timelines:
+        layers = ", ".join(
+            f"{layer}:{count}" for layer, count in sorted(timeline.layer_usage.items())
+        )
+        name = f" ({timeline.name})" if timeline.name else ""
+        print(f"タイムライン {timeline.index}{name}")
+        print(f"  FPS: {timeline.fps}")
+        print(f"  解像度: {timeline.width}x{timeline.height}")
+        print(f"  アイテム数: {timeline.item_count}")
+        print(f"  最後尾フレーム: {timeline.last_frame}")
+        print(f"  レイヤー使用状況 (レイヤー:アイテム数): {layers}")
+
+
+def run_daemon_command(
+    args: argparse.Namespace, base_project_path: Path, output_project_path: Path
+) -> None:
+    """コマンドを常駐プロセスに送り、結果を表示する"""
+    from daemon_client import send_daemon_command
+
+    payload: dict[str, Any] = {
+        "project": str(base_project_path.resolve()),
+        "output": str(output_project_path.resolve()),
+        "timeline": args.timeline,
+    }
+    if args.command == "voice":
+        payload.update(text=args.text, speaker_name=args.speaker)
+    elif args.command == "latex":
+        payload.update(formula=args.formula)
+    elif args.command == "batch":
+        payload.update(instructions_file=str(Path(args.instructions).resolve()))
+
+    try:
+        result = send_daemon_command(args.command, payload, url=args.daemon_url)
+    except RuntimeError as e:
+        print(e)
+        return
+
+    if args.command == "flush":
+        for saved in result["saved"]:
+            print(f"プロジェクトファイルを保存しました: {saved}")
+    elif args.command == "batch":
+        for error in result["errors"]:
+            print(f"指示を読み飛ばしました: {error}")
+        print(f"{result['added']}件のシーンを追加しました。")
+    else:
+        print(f"{result['frame']}フレーム目に追加しました。")
+
+
+def run_info(args: argparse.Namespace, base: Path, _output: Path) -> None:
+    print_project_summary(str(base))
+
+
+def run_merge(args: argparse.Namespace, base: Path, output: Path) -> None:
+    from utils.ymmp_merge import merge_ymmp_projects
+
+    merge_ymmp_projects(
+        [str(base), *args.projects],
+        str(output),
+        timeline=args.timeline,
+        gap_frames=args.gap,
+    )
+
+
+def run_split(args: argparse.Namespace, base: Path, _output: Path) -> None:
+    from utils.ymmp_merge import split_ymmp_project
+
+    split_ymmp_project(
+        str(base), args.at, str(DEFAULT_OUTPUT_DIR), timeline=args.timeline
+    )
+
+
+def run_batch(args: argparse.Namespace, base: Path, output: Path) -> None:
+    from instruction_reader import iter_instructions
+    from scene_adder import add_scenes_from_instructions
+
+    add_scenes_from_instructions(
+        str(base),
+        iter_instructions(args.instructions),
+        str(output),
+        jobs=args.jobs,
+        show_progress=not args.no_progress,
+        resume=not args.no_resume,
+        rebuild=args.rebuild,
+    )
+
+
+def run_voice(args: argparse.Namespace, base: Path, output: Path) -> None:
+    from voice.add_voice import VoiceSceneConfig, add_voice_scene
+
+    print(f"音声アイテムを追加中: {args.text}")
+    config = VoiceSceneConfig(
+        project_file=str(base),
+        text=args.text,
+        output_file=str(output),
+        speaker_name=args.speaker,
+        append=args.append,
+        timeline=args.timeline,
+    )
+    add_voice_scene(config)
+
+
+def run_latex(args: argparse.Namespace, base: Path, output: Path) -> None:
+    from formula.add_latex import add_latex_scene
+
+    print(f"数式アイテムを追加中: {args.formula}")
+    add_latex_scene(
+        str(base),
+        args.formula,
+        str(output),
+        append=args.append,
+        timeline=args.timeline,
+    )
+
+
+def run_flush(args: argparse.Namespace, base: Path, output: Path) -> None:
+    print("flushは--daemonと組み合わせて使用してください。")
+
+
+# サブコマンド名と処理 (引数, ベースのパス, 出力先のパス) の対応
+CommandHandler = Callable[[argparse.Namespace, Path, Path], None]
+COMMAND_HANDLERS: dict[str, CommandHandler] = {
+    "info": run_info,
+    "merge": run_merge,
+    "split": run_split,
+    "batch": run_batch,
+    "voice": run_voice,
+    "latex": run_latex,
+    "flush": run_flush,
+}
+
+# --daemonを指定したときに常駐プロセスへ送るサブコマンド
+DAEMON_COMMANDS = ("voice", "latex", "batch", "flush")
+
+
+def configure_logging(args: argparse.Namespace) -> None:
+    """-v/-qに応じてログの出力レベルを設定する (デフォルトはINFO)"""
+    import logging
+
+    if args.verbose:
+        log_level = logging.DEBUG
+    elif args.quiet:
+        log_level = logging.WARNING
+    else:
+        log_level = logging.INFO
+    logging.basicConfig(level=log_level, format="%(message)s")
+
+
+def run_command(args: argparse.Namespace, base: Path, output: Path) -> None:
+    """
+    サブコマンドを実行する
+
+    --traceを指定した場合は処理区間を記録して書き出し、--memory-profileを
+    指定した場合は区間ごとのメモリ使用量を表示する。メモリの使用量が予算を
+    超えた場合は終了コード1で終了する。
+    """
+    if args.trace is None and not args.memory_profile:
+        COMMAND_HANDLERS[args.command](args, base, output)
+        return
+
+    from utils.memory_profile import MemoryBudgetExceededError, MemoryProfiler
+    from utils.tracing import enable_tracing
+
+    tracer = enable_tracing()
+    profiler = None
+    if args.memory_profile:
+        budget_mb = args.memory_budget
+        profiler = MemoryProfiler(
+            budget_bytes=int(budget_mb * 1024 * 1024) if budget_mb else None
+        )
+        profiler.start()
+    try:
+        with tracer.span(f"command.{args.command}"):
+            COMMAND_HANDLERS[args.command](args, base, output)
+    except MemoryBudgetExceededError as e:
+        print(e, file=sys.stderr)
+    finally:
+        if args.trace is not None:
+            tracer.export(args.trace)
+            print(tracer.format_summary(), file=sys.stderr)
+            print(f"トレースを書き出しました: {args.trace}", file=sys.stderr)
+        if profiler is not None:
+            profiler.stop()
+            print(profiler.format_report(), file=sys.stderr)
+    # 予算超過の例外が途中で握りつぶされていても、終了コードで失敗を伝える
+    if profiler is not None and profiler.exceeded:
+        sys.exit(1)
 
 
 def main() -> None:
@@ -11,14 +219,97 @@ def main() -> None:
     # 音声を追加
     python main.py ./base.ymmp voice --text "これはテストなのだ"
 
+    # プロジェクト全体を書き直さずに追記
+    python main.py ./base.ymmp --append voice --text "これはテストなのだ"
+
     # 数式を追加
     python main.py ./base.ymmp latex --formula "$e^{i\pi}=-1$"
+
+    # プロジェクトの概要を表示
+    python main.py ./base.ymmp info
+
+    # チャプターごとのプロジェクトを連結
+    python main.py ./chapter1.ymmp merge ./chapter2.ymmp ./chapter3.ymmp
+
+    # 600フレーム目と1200フレーム目で分割
+    python main.py ./base.ymmp split --at 600 1200
+
+    # 指示リスト (JSON) に基づいて複数のシーンを並行に生成
+    python main.py ./base.ymmp batch ./instructions.json --jobs 4
+
+    # 1行1指示のJSONLやCSVは少しずつ読み込みながら生成
+    python main.py ./base.ymmp batch ./instructions.jsonl
+
+    # 指示を編集した後、変更のあった指示だけを作り直す
+    python main.py ./base.ymmp batch ./instructions.jsonl --rebuild
+
+    # 常駐プロセス (python daemon.py) に追加を依頼し、まとめて保存
+    python main.py ./base.ymmp --daemon voice --text "これはテストなのだ"
+    python main.py ./base.ymmp --daemon flush
+
+    # 処理区間ごとの所要時間を記録 (chrome://tracing や Perfetto で表示できる)
+    python main.py ./base.ymmp --trace ./trace.json batch ./instructions.jsonl
+
+    # 処理区間ごとのピークメモリを計測し、512MBを超えたら失敗させる
+    python main.py ./base.ymmp --memory-profile --memory-budget 512 batch ./a.jsonl
     """
 
     parser = argparse.ArgumentParser(
         description="YMM4プロジェクトにアイテムを自動で追加します。"
     )
     parser.add_argument("base_project", help="ベースとなる.ymmpファイルのパス")
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="プロジェクト全体を書き直さず、Items末尾へ新しいアイテムだけを追記します。",
+    )
+
+    parser.add_argument(
+        "--timeline",
+        type=parse_timeline_arg,
+        default=0,
+        help="追加先のタイムラインのインデックスまたは名前 (デフォルト: 0)",
+    )
+
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="常駐プロセス (daemon.py) にvoice/latex/batch/flushを依頼します。",
+    )
+    parser.add_argument(
+        "--daemon-url",
+        default=DAEMON_URL,
+        help=f"常駐プロセスのURL (デフォルト: {DAEMON_URL})",
+    )
+
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        "-v", "--verbose", action="store_true", help="詳細なログを表示します。"
+    )
+    verbosity.add_argument(
+        "-q", "--quiet", action="store_true", help="警告とエラーだけを表示します。"
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        default=None,
+        help="処理区間ごとの所要時間を記録して書き出します"
+        " (.jsonlはJSON Lines、それ以外はChromeのトレース形式)。",
+    )
+    parser.add_argument(
+        "--memory-profile",
+        action="store_true",
+        help="tracemallocで処理区間ごとのピークメモリと割り当て箇所を表示します"
+        " (計測中は処理が数倍遅くなります)。",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        metavar="MB",
+        default=MEMORY_BUDGET_MB,
+        help="--memory-profile時に許容するメモリ使用量。超えた場合は終了コード1で"
+        "終了します (デフォルト: 環境変数YMM4_MEMORY_BUDGET_MB)",
+    )
 
     # サブコマンドで機能を選択できるようにする
     subparsers = parser.add_subparsers(dest="command", required=True)
@@ -32,25 +323,73 @@ def main() -> None:
     parser_latex = subparsers.add_parser("latex", help="数式アイテムを追加します。")
     parser_latex.add_argument("-f", "--formula", required=True, help="LaTeX形式の数式")
 
+    # 概要表示コマンド
+    subparsers.add_parser("info", help="プロジェクトの概要を表示します。")
+
+    # 連結コマンド
+    parser_merge = subparsers.add_parser(
+        "merge",
+        help="ベースの後ろに他のプロジェクトを順番に連結します。"
+        "連結するのは--timelineで指定したタイムラインだけで、"
+        "2つ目以降のプロジェクトの他のタイムラインは含まれません。",
+    )
+    parser_merge.add_argument("projects", nargs="+", help="連結する.ymmpファイルのパス")
+    parser_merge.add_argument(
+        "--gap", type=int, default=0, help="チャプター間に空けるフレーム数"
+    )
+
+    # 分割コマンド
+    parser_split = subparsers.add_parser(
+        "split",
+        help="指定したフレームでプロジェクトを分割します。"
+        "分割するのは--timelineで指定したタイムラインだけで、"
+        "他のタイムラインはすべての出力にそのまま含まれます。",
+    )
+    parser_split.add_argument(
+        "--at", type=int, nargs="+", required=True, help="分割位置のフレーム"
+    )
+
+    # 一括追加コマンド
+    parser_batch = subparsers.add_parser(
+        "batch", help="指示リストに基づいて複数のシーンを追加します。"
+    )
+    parser_batch.add_argument(
+        "instructions", help="指示リストのファイルのパス (.json / .jsonl / .csv)"
+    )
+    parser_batch.add_argument(
+        "-j", "--jobs", type=int, default=None, help="並行して描画する最大数"
+    )
+    parser_batch.add_argument(
+        "--no-progress", action="store_true", help="進捗を表示しません。"
+    )
+    parser_batch.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="前回の途中経過 (ジャーナル) を使わず、最初から生成します。",
+    )
+    parser_batch.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="前回の出力から内容が変わっていない指示は再利用し、差分だけを生成します。",
+    )
+
+    # 保存コマンド (常駐プロセス用)
+    subparsers.add_parser(
+        "flush", help="常駐プロセスが保持しているプロジェクトを保存します。"
+    )
+
     args = parser.parse_args()
+    configure_logging(args)
 
     base_project_path = Path(args.base_project)
     output_project_path = (
         Path(DEFAULT_OUTPUT_DIR) / f"{base_project_path.stem}_output.ymmp"
     )
 
-    if args.command == "voice":
-        print(f"音声アイテムを追加中: {args.text}")
-        config = VoiceSceneConfig(
-            project_file=str(base_project_path),
-            text=args.text,
-            output_file=str(output_project_path),
-            speaker_name=args.speaker,
-        )
-        add_voice_scene(config)
-    elif args.command == "latex":
-        print(f"数式アイテムを追加中: {args.formula}")
-        add_latex_scene(str(base_project_path), args.formula, str(output_project_path))
+    if args.daemon and args.command in DAEMON_COMMANDS:
+        run_daemon_command(args, base_project_path, output_project_path)
+        return
+    run_command(args, base_project_path, output_project_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import torch
+from model import (
+    MAX_LENGTH,
+    NORMALIZATION_VERSION,
+    CachedEmbeddingDataset,
+    DataProcessor,
+    MathVideoGenerator,
+    PairedTokenDataset,
+)
+
+logger = logging.getLogger(__name__)
+
+# キャッシュの形式を変えたら上げる
+CACHE_FORMAT_VERSION = 1
+
+_ARRAY_NAMES = ["voice_tokens", "voice_offsets", "tex_tokens", "tex_offsets"]
+
+
+def file_digest(path: str) -> str:
+    """ファイルのSHA-256 (読み込めない場合は'missing')"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    except OSError:
+        return "missing"
+    return digest.hexdigest()
+
+
+def referenced_tex_paths(csv_path: str) -> list[str]:
+    """CSVのtex_paths列から参照されているTeXファイルのパスを重複なく返す"""
+    df = pd.read_csv(csv_path, usecols=lambda column: column == "tex_paths")
+    if "tex_paths" not in df.columns:
+        return []
+    paths = set()
+    for value in df["tex_paths"].dropna():
+        paths.update(p.strip() for p in str(value).split(",") if p.strip())
+    return sorted(paths)
+
+
+def compute_cache_key(csv_path: str, tokenizer_name: str) -> tuple[str, dict]:
+    """
+    前処理の結果を決める入力すべてからキャッシュのキーを計算する
+
+    CSVの内容、参照しているTeXファイルの内容、トークナイザー名、正規化のバージョン、
+    最大トークン長のどれかが変わればキーも変わる。
+
+    Returns:
+        tuple[str, dict]: キー (16進数) と、キーの元になった情報
+    """
+    source = {
+        "format_version": CACHE_FORMAT_VERSION,
+        "normalization_version": NORMALIZATION_VERSION,
+        "tokenizer_name": tokenizer_name,
+        "max_length": MAX_LENGTH,
+        "csv_digest": file_digest(csv_path),
+        "tex_digests": {p: file_digest(p) for p in referenced_tex_paths(csv_path)},
+    }
+    key = hashlib.sha256(json.dumps(source, sort_keys=True).encode("utf-8")).hexdigest()
+    return key, source
+
+
+def load_cached_dataset(
+    entry: Path,
+) -> Optional[tuple[PairedTokenDataset, pd.DataFrame, pd.DataFrame]]:
+    """キャッシュを読み込む (トークン列はメモリマップで開くためコピーしない)"""
+    try:
+        meta = json.loads((entry / "meta.json").read_text(encoding="utf-8"))
+        arrays = [
+            np.load(entry / f"{name}.npy", mmap_mode="r") for name in _ARRAY_NAMES
+        ]
+        voice_data = pd.read_pickle(entry / "voice_data.pkl")
+        image_data = pd.read_pickle(entry / "image_data.pkl")
+    except (OSError, ValueError) as e:
+        logger.warning(f"データセットのキャッシュを読み込めませんでした: {entry} ({e})")
+        return None
+    dataset = PairedTokenDataset(
+        *arrays, pad_token_id=meta["pad_token_id"], cache_key=entry.name
+    )
+    return dataset, voice_data, image_data
+
+
+def save_cached_dataset(
+    entry: Path,
+    dataset: PairedTokenDataset,
+    voice_data: pd.DataFrame,
+    image_data: pd.DataFrame,
+    source: dict,
+) -> None:
+    """キャッシュを書き出す (一時ディレクトリに書いてから名前を変えるため、途中の状態は見えない)"""
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp_", dir=entry.parent))
+    try:
+        for name in _ARRAY_NAMES:
+            np.save(
+                tmp_dir / f"{name}.npy", np.ascontiguousarray(getattr(dataset, name))
+            )
+        voice_data.to_pickle(tmp_dir / "voice_data.pkl")
+        image_data.to_pickle(tmp_dir / "image_data.pkl")
+        meta = {
+            **source,
+            "pad_token_id": dataset.pad_token_id,
+            "examples": len(dataset),
+        }
+        (tmp_dir / "meta.json").write_text(
+            json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # 他のプロセスが先に同じキャッシュを書き出した
+            logger.debug(f"データセットのキャッシュは既に存在します: {entry}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_or_create_training_data(
+    data_processor: DataProcessor, cache_dir: Optional[str]
+) -> tuple[PairedTokenDataset, pd.DataFrame, pd.DataFrame]:
+    """
+    前処理・トークナイズ済みのデータセットをキャッシュから読み込み、なければ作成して保存する
+
+    Args:
+        data_processor (DataProcessor): CSVとトークナイザーを指定したDataProcessor
+        cache_dir (Optional[str]): キャッシュのディレクトリ (Noneの場合はキャッシュしない)
+
+    Returns:
+        tuple[PairedTokenDataset, pd.DataFrame, pd.DataFrame]: 学習データ、音声データ、画像データ
+    """
+    entry = None
+    if cache_dir is not None:
+        key, source = compute_cache_key(
+            data_processor.csv_path, data_processor.tokenizer_name
+        )
+        entry = Path(cache_dir) / key
+        if entry.is_dir():
+            cached = load_cached_dataset(entry)
+            if cached is not None:
+                logger.info(
+                    f"データセットのキャッシュを読み込みました: {entry} ({len(cached[0])}件)"
+                )
+                return cached
+
+    voice_data, image_data = data_processor.create_dataset()
+    dataset = data_processor.create_training_data(voice_data, image_data)
+    if entry is not None:
+        save_cached_dataset(entry, dataset, voice_data, image_data, source)
+        dataset.cache_key = key
+        logger.info(f"データセットのキャッシュを保存しました: {entry}")
+    return dataset, voice_data, image_data
+
+
+def load_or_compute_cls_embeddings(  # noqa: PLR0913
+    model: MathVideoGenerator,
+    dataset: PairedTokenDataset,
+    cache_dir: Optional[str],
+    weights_id: str,
+    batch_size: int = 64,
+    device: Optional[torch.device] = None,
+) -> CachedEmbeddingDataset:
+    """
+    エンコーダーを凍結した学習用に、重複のないテキストのCLS出力を計算してキャッシュする
+
+    CLS出力はデータセットのキャッシュの中に、BERTの重み (weights_id) ごとの.npyとして
+    保存し、次回からはメモリマップで開く。データセットがキャッシュされていない場合は
+    メモリ上で計算するだけにする。
+
+    Args:
+        model (MathVideoGenerator): CLS出力を計算するモデル
+        dataset (PairedTokenDataset): 学習データ
+        cache_dir (Optional[str]): データセットのキャッシュディレクトリ
+        weights_id (str): BERTの重みを識別する文字列 (重みが変わればキャッシュも変わる)
+        batch_size (int): CLS出力を計算するバッチサイズ
+        device (Optional[torch.device]): 計算するデバイス
+
+    Returns:
+        CachedEmbeddingDataset: CLS出力のデータセット
+    """
+    sequences, voice_index, tex_index = dataset.unique_sequences()
+    shape = (len(sequences), model.bert.config.hidden_size)
+    if cache_dir is None or dataset.cache_key is None:
+        embeddings = model.compute_cls_embeddings(
+            sequences, np.empty(shape, dtype=np.float32), batch_size, device
+        )
+        return CachedEmbeddingDataset(embeddings, voice_index, tex_index)
+
+    weights_key = hashlib.sha256(weights_id.encode("utf-8")).hexdigest()[:16]
+    path = Path(cache_dir) / dataset.cache_key / f"cls_{weights_key}.npy"
+    if path.exists():
+        embeddings = np.load(path, mmap_mode="r")
+        if embeddings.shape == shape:
+            logger.info(f"CLS出力のキャッシュを読み込みました: {path}")
+            return CachedEmbeddingDataset(embeddings, voice_index, tex_index)
+
+    logger.info(f"CLS出力を計算します ({len(sequences)}件)...")
+    fd, tmp_name = tempfile.mkstemp(prefix=".tmp_", suffix=".npy", dir=path.parent)
+    os.close(fd)
+    try:
+        out = np.lib.format.open_memmap(
+            tmp_name, mode="w+", dtype=np.float32, shape=shape
+        )
+        model.compute_cls_embeddings(sequences, out, batch_size, device)
+        out.flush()
+        del out
+        os.replace(tmp_name, path)
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+    logger.info(f"CLS出力のキャッシュを保存しました: {path}")
+    return CachedEmbeddingDataset(np.load(path, mmap_mode="r"), voice_index, tex_index)
@@ -0,0 +1,108 @@
+import logging
+import os
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus() -> list[int]:
+    """このプロセスが使えるCPUコアの番号"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def bind_worker_cpus(
+    rank: int, world_size: int, threads_per_process: Optional[int] = None
+) -> list[int]:
+    """
+    使えるコアをworld_size個の連続した組に分け、rank番目の組にこのプロセスを割り当てる
+
+    PyTorchの演算スレッド数 (intra-op) も割り当てたコア数 (threads_per_process指定時はその値) にする。
+    コアの割り当て (sched_setaffinity) ができないOSではスレッド数だけを設定する。
+
+    Returns:
+        list[int]: 割り当てたコアの番号
+    """
+    cpus = available_cpus()
+    per_process = max(1, len(cpus) // world_size)
+    start = (rank * per_process) % len(cpus)
+    assigned = cpus[start : start + per_process]
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, assigned)
+    torch.set_num_threads(threads_per_process or len(assigned))
+    return assigned
+
+
+def init_worker(
+    rank: int,
+    world_size: int,
+    master_port: int,
+    threads_per_process: Optional[int] = None,
+) -> None:
+    """ワーカープロセスのコアを割り当て、glooバックエンドのプロセスグループに参加する"""
+    cpus = bind_worker_cpus(rank, world_size, threads_per_process)
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(master_port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    if rank != 0:
+        # ログはrank 0だけが出す
+        logging.getLogger().setLevel(logging.WARNING)
+    logger.info(
+        f"{world_size}プロセスで学習します (rank 0: コア{cpus[0]}-{cpus[-1]}, "
+        f"{torch.get_num_threads()}スレッド)"
+    )
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process() -> bool:
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def barrier() -> None:
+    if is_distributed():
+        dist.barrier()
+
+
+@contextmanager
+def main_process_first() -> Iterator[None]:
+    """rank 0が先に処理 (キャッシュの作成など) を終えてから、他のプロセスが処理する"""
+    if not is_main_process():
+        barrier()
+    try:
+        yield
+    finally:
+        if is_main_process():
+            barrier()
+
+
+def all_reduce_mean(value: float) -> float:
+    """全プロセスの値の平均"""
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item() / dist.get_world_size()
+
+
+def cleanup() -> None:
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def launch(worker: Callable, world_size: int, *args) -> None:
+    """
+    worker(rank, world_size, *args) をworld_size個のプロセスで実行し、全て終わるまで待つ
+
+    workerはモジュールの最上位に定義された関数であること (spawnで子プロセスに渡すため)。
+    """
+    mp.spawn(worker, args=(world_size, *args), nprocs=world_size, join=True)
@@ -0,0 +1,499 @@
+"""
+学習済みのMathVideoGeneratorをCPU推論向けに書き出すスクリプト
+
+次の成果物を出力ディレクトリに書き出し、fp32のモデルとの精度の比較と
+レイテンシの計測結果をexport_meta.jsonに記録する。
+
+- model_int8.pt: Linear層を動的にint8量子化したモデルのTorchScript
+- model_fp32.onnx: fp32のモデルのONNX
+- model_int8.onnx: ONNXを動的にint8量子化したもの (onnxruntimeがある場合)
+
+load_exported_modelは、精度の確認に合格してこの環境で使える実行方法のうち、
+計測で最も速かったものを選んで読み込む。
+
+使い方:
+    python export.py --model_path best_model_epoch_3.pt --output_dir exported
+    python export.py --model_path best_model_epoch_3.pt --output_dir exported --csv_path data.csv
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import time
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+from inference import batched
+from model import (
+    BERT_MODEL_NAME,
+    MAX_LENGTH,
+    MathVideoGenerator,
+    collate_padded,
+    load_tokenizer,
+)
+from torch import nn
+
+try:
+    import onnxruntime
+    from onnxruntime.quantization import QuantType
+    from onnxruntime.quantization import quantize_dynamic as onnx_quantize_dynamic
+except ImportError:
+    onnxruntime = None
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "export_meta.json"
+# trace用に1件以上、確認用にバッチサイズの異なる2件以上が必要
+MIN_VALIDATION_PAIRS = 3
+INPUT_NAMES = [
+    "voice_input_ids",
+    "voice_attention_mask",
+    "tex_input_ids",
+    "tex_attention_mask",
+]
+
+# 精度の確認に使う既定の入力 (--csv_pathを指定しない場合)
+SAMPLE_PAIRS = [
+    ("二次方程式の解の公式を確認するのだ", r"x = \frac{-b \pm \sqrt{b^2 - 4ac}}{2a}"),
+    ("オイラーの等式はとても美しいのだ", r"e^{i\pi} + 1 = 0"),
+    ("微分の定義から始めるのだ", r"f\'(x) = \lim_{h \to 0} \frac{f(x+h) - f(x)}{h}"),
+    ("ピタゴラスの定理なのだ", r"a^2 + b^2 = c^2"),
+    ("積分で面積を求めるのだ", r"\int_0^1 x^2 \, dx = \frac{1}{3}"),
+    (
+        "行列の積を計算するのだ",
+        r"\begin{equation} AB = \sum_k a_{ik} b_{kj} \end{equation}",
+    ),
+    ("級数の和を考えるのだ", r"\sum_{n=1}^{\infty} \frac{1}{n^2} = \frac{\pi^2}{6}"),
+    (
+        "正規分布の密度関数なのだ",
+        r"\frac{1}{\sqrt{2\pi\sigma^2}} e^{-\frac{(x-\mu)^2}{2\sigma^2}}",
+    ),
+]
+
+
+class ExportWrapper(nn.Module):
+    """書き出し用に、テンソルだけを受け取ってテンソルを返す形にしたモデル"""
+
+    def __init__(self, model: MathVideoGenerator):
+        super().__init__()
+        self.model = model
+
+    def forward(
+        self,
+        voice_input_ids: torch.Tensor,
+        voice_attention_mask: torch.Tensor,
+        tex_input_ids: torch.Tensor,
+        tex_attention_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        return self.model(
+            {"input_ids": voice_input_ids, "attention_mask": voice_attention_mask},
+            {"input_ids": tex_input_ids, "attention_mask": tex_attention_mask},
+        )
+
+
+Runner = Callable[[tuple[torch.Tensor, ...]], np.ndarray]
+
+
+def torch_runner(module: nn.Module) -> Runner:
+    @torch.inference_mode()
+    def run(inputs: tuple[torch.Tensor, ...]) -> np.ndarray:
+        return module(*inputs).float().numpy()
+
+    return run
+
+
+def onnx_runner(path: Path) -> Runner:
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(
+        str(path), options, providers=["CPUExecutionProvider"]
+    )
+
+    def run(inputs: tuple[torch.Tensor, ...]) -> np.ndarray:
+        return session.run(
+            None, {name: t.numpy() for name, t in zip(INPUT_NAMES, inputs)}
+        )[0]
+
+    return run
+
+
+def load_fp32_model(
+    model_path: Optional[str], bert_model_name: str = BERT_MODEL_NAME
+) -> MathVideoGenerator:
+    model = MathVideoGenerator(bert_model_name)
+    if model_path:
+        model.load_state_dict(torch.load(model_path, map_location="cpu"))
+    return model.eval()
+
+
+def quantize_model(model: MathVideoGenerator) -> nn.Module:
+    """Linear層 (BERTの計算の大部分) の重みをint8にし、活性は実行時に量子化する"""
+    quantization = getattr(torch, "ao", torch).quantization
+    return quantization.quantize_dynamic(
+        ExportWrapper(model), {nn.Linear}, dtype=torch.qint8
+    )
+
+
+def tokenize_pairs(
+    pairs: list[tuple[str, str]], bert_model_name: str = BERT_MODEL_NAME
+) -> tuple[torch.Tensor, ...]:
+    """(音声テキスト, TeX) の組み合わせを、バッチ内の最大長までパディングした入力にする"""
+    tokenizer = load_tokenizer(bert_model_name)
+    voice = tokenizer(
+        [voice for voice, _ in pairs], truncation=True, max_length=MAX_LENGTH
+    )["input_ids"]
+    tex = tokenizer([tex for _, tex in pairs], truncation=True, max_length=MAX_LENGTH)[
+        "input_ids"
+    ]
+    batch = [(torch.tensor(v), torch.tensor(t)) for v, t in zip(voice, tex)]
+    return collate_padded(batch, pad_token_id=tokenizer.pad_token_id)
+
+
+def extend_padding(
+    inputs: tuple[torch.Tensor, ...], pad_token_id: int, extra: int
+) -> tuple[torch.Tensor, ...]:
+    """音声とTeXの入力の右側にextra個のパディングを足す (attention_maskは0のため出力は変わらない)"""
+    voice_ids, voice_mask, tex_ids, tex_mask = inputs
+    return (
+        nn.functional.pad(voice_ids, (0, extra), value=pad_token_id),
+        nn.functional.pad(voice_mask, (0, extra)),
+        nn.functional.pad(tex_ids, (0, extra), value=pad_token_id),
+        nn.functional.pad(tex_mask, (0, extra)),
+    )
+
+
+def split_trace_and_validation(
+    pairs: list[tuple[str, str]], bert_model_name: str = BERT_MODEL_NAME
+) -> tuple[tuple[torch.Tensor, ...], tuple[torch.Tensor, ...]]:
+    """
+    書き出し (torch.jit.trace・ONNX) に使う入力と、精度の確認・計測に使う入力を重ならないように作る
+
+    書き出したモデルがtraceした形に固定されていないことを確かめるため、確認用の入力は
+    バッチサイズも系列長 (音声・TeXとも) もtrace用の入力と変える。
+    """
+    if len(pairs) < MIN_VALIDATION_PAIRS:
+        raise ValueError(
+            f"精度の確認には{MIN_VALIDATION_PAIRS}件以上の組み合わせが必要です: {len(pairs)}件"
+        )
+    trace_size = max(1, len(pairs) // 4)
+    trace_inputs = tokenize_pairs(pairs[:trace_size], bert_model_name)
+    validation_inputs = tokenize_pairs(pairs[trace_size:], bert_model_name)
+    extra = 0
+    while any(
+        trace_inputs[i].size(1) == validation_inputs[i].size(1) + extra for i in (0, 2)
+    ):
+        extra += 1
+    if (
+        extra
+        and max(validation_inputs[0].size(1), validation_inputs[2].size(1)) + extra
+        <= MAX_LENGTH
+    ):
+        pad_token_id = load_tokenizer(bert_model_name).pad_token_id
+        validation_inputs = extend_padding(validation_inputs, pad_token_id, extra)
+    return trace_inputs, validation_inputs
+
+
+def describe_shape(inputs: tuple[torch.Tensor, ...]) -> dict[str, int]:
+    """export_meta.jsonに記録する入力の形"""
+    return {
+        "batch_size": int(inputs[0].size(0)),
+        "voice_length": int(inputs[0].size(1)),
+        "tex_length": int(inputs[2].size(1)),
+    }
+
+
+def load_sample_pairs(
+    csv_path: Optional[str], num_samples: int
+) -> list[tuple[str, str]]:
+    """精度の確認とレイテンシの計測に使う組み合わせ"""
+    if csv_path is None:
+        return (SAMPLE_PAIRS * (num_samples // len(SAMPLE_PAIRS) + 1))[:num_samples]
+    from model import DataProcessor
+
+    processor = DataProcessor(csv_path)
+    voice_data, image_data = processor.create_dataset()
+    paired = processor.pair_voice_and_image(voice_data, image_data).head(num_samples)
+    return list(zip(paired["voice_text"], paired["image_tex"]))
+
+
+def compare_outputs(reference: np.ndarray, outputs: np.ndarray) -> dict[str, float]:
+    """fp32の出力との差 (最大絶対誤差と、例ごとのコサイン類似度の最小値・平均)"""
+    dot = (reference * outputs).sum(axis=1)
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(outputs, axis=1)
+    cosine = dot / np.maximum(norms, 1e-12)
+    return {
+        "max_abs_error": float(np.abs(reference - outputs).max()),
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+    }
+
+
+def measure_latency(
+    runner: Runner, inputs: tuple[torch.Tensor, ...], repeat: int, warmup: int = 2
+) -> dict[str, float]:
+    """1バッチの推論時間 (ミリ秒) の中央値と最小値"""
+    for _ in range(warmup):
+        runner(inputs)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        runner(inputs)
+        times.append((time.perf_counter() - start) * 1000)
+    return {"median_ms": statistics.median(times), "min_ms": min(times)}
+
+
+def export_model(  # noqa: PLR0913
+    model_path: Optional[str],
+    output_dir: str,
+    csv_path: Optional[str] = None,
+    num_samples: int = 32,
+    repeat: int = 10,
+    min_cosine: float = 0.99,
+    bert_model_name: str = BERT_MODEL_NAME,
+) -> dict:
+    """
+    int8量子化・TorchScript・ONNXの成果物を書き出し、精度とレイテンシを記録する
+
+    組み合わせの先頭の1/4で書き出し (trace) を行い、残りの組み合わせ (バッチサイズと系列長が
+    traceと異なる入力) でfp32との精度の比較とレイテンシの計測を行う。traceした形でしか
+    動かない成果物は、実行に失敗するか精度が合わずに不合格になる。
+
+    Args:
+        model_path (Optional[str]): 学習済みモデルのstate_dict (Noneの場合は事前学習済みの重み)
+        output_dir (str): 出力ディレクトリ
+        csv_path (Optional[str]): 精度の確認に使うCSV (Noneの場合は組み込みのサンプル)
+        num_samples (int): 書き出しと精度の確認・レイテンシの計測に使う組み合わせの数 (3以上)
+        repeat (int): レイテンシの計測回数
+        min_cosine (float): 合格とするfp32の出力とのコサイン類似度の最小値
+
+    Returns:
+        Dict: export_meta.jsonに書き出した内容
+    """
+    output = Path(output_dir)
+    output.mkdir(parents=True, exist_ok=True)
+    model = load_fp32_model(model_path, bert_model_name)
+    inputs, validation_inputs = split_trace_and_validation(
+        load_sample_pairs(csv_path, num_samples), bert_model_name
+    )
+
+    runners = {"torch_fp32": torch_runner(ExportWrapper(model).eval())}
+    artifacts = {}
+
+    # 動的int8量子化とTorchScript
+    quantized = quantize_model(model).eval()
+    with torch.inference_mode():
+        scripted = torch.jit.trace(quantized, inputs, strict=False)
+    scripted = torch.jit.freeze(scripted)
+    torch.jit.save(scripted, output / "model_int8.pt")
+    artifacts["torchscript_int8"] = "model_int8.pt"
+    runners["torchscript_int8"] = torch_runner(
+        torch.jit.load(str(output / "model_int8.pt"))
+    )
+
+    # ONNX (バッチサイズと系列長は可変)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES}
+    dynamic_axes["output"] = {0: "batch"}
+    torch.onnx.export(
+        ExportWrapper(model).eval(),
+        inputs,
+        str(output / "model_fp32.onnx"),
+        input_names=INPUT_NAMES,
+        output_names=["output"],
+        dynamic_axes=dynamic_axes,
+        opset_version=17,
+    )
+    artifacts["onnx_fp32"] = "model_fp32.onnx"
+    if onnxruntime is not None:
+        onnx_quantize_dynamic(
+            str(output / "model_fp32.onnx"),
+            str(output / "model_int8.onnx"),
+            weight_type=QuantType.QInt8,
+        )
+        artifacts["onnx_int8"] = "model_int8.onnx"
+        runners["onnx_fp32"] = onnx_runner(output / "model_fp32.onnx")
+        runners["onnx_int8"] = onnx_runner(output / "model_int8.onnx")
+    else:
+        logger.warning("onnxruntimeがないため、ONNXの量子化と計測を省略します")
+
+    # traceと異なる形の入力で、fp32との精度の比較とレイテンシの計測
+    reference = runners["torch_fp32"](validation_inputs)
+    results = {}
+    for runtime, runner in runners.items():
+        try:
+            outputs = runner(validation_inputs)
+        except Exception as e:
+            logger.warning(
+                f"{runtime}: traceと異なる形の入力で実行できませんでした (不合格): {e}"
+            )
+            results[runtime] = {"passed": False, "error": str(e)}
+            continue
+        if outputs.shape != reference.shape:
+            logger.warning(
+                f"{runtime}: 出力の形 {outputs.shape} がfp32の {reference.shape} と異なります (不合格)"
+            )
+            results[runtime] = {
+                "passed": False,
+                "error": f"出力の形が異なります: {outputs.shape}",
+            }
+            continue
+        result = {
+            **compare_outputs(reference, outputs),
+            **measure_latency(runner, validation_inputs, repeat),
+        }
+        result["passed"] = result["min_cosine"] >= min_cosine
+        results[runtime] = result
+        logger.info(
+            f"{runtime}: {result['median_ms']:.1f} ms/バッチ, 最小コサイン類似度 {result['min_cosine']:.4f}"
+            f"{'' if result['passed'] else ' (不合格)'}"
+        )
+
+    meta = {
+        "bert_model_name": bert_model_name,
+        "model_path": model_path,
+        "batch_size": int(validation_inputs[0].size(0)),
+        "trace_shape": describe_shape(inputs),
+        "validation_shape": describe_shape(validation_inputs),
+        "num_threads": torch.get_num_threads(),
+        "min_cosine": min_cosine,
+        "artifacts": artifacts,
+        "results": results,
+    }
+    (output / META_FILE).write_text(
+        json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8"
+    )
+    return meta
+
+
+class ExportedModel:
+    """書き出したモデルを実行方法によらず同じ形で呼び出すためのクラス"""
+
+    def __init__(
+        self, runtime: str, runner: Runner, bert_model_name: str = BERT_MODEL_NAME
+    ):
+        self.runtime = runtime
+        self.runner = runner
+        self.bert_model_name = bert_model_name
+
+    def __call__(
+        self,
+        voice_input_ids: torch.Tensor,
+        voice_attention_mask: torch.Tensor,
+        tex_input_ids: torch.Tensor,
+        tex_attention_mask: torch.Tensor,
+    ) -> np.ndarray:
+        return self.runner(
+            (voice_input_ids, voice_attention_mask, tex_input_ids, tex_attention_mask)
+        )
+
+    def iter_scores(
+        self, pairs: Iterable[tuple[str, str]], batch_size: int = 64
+    ) -> Iterator[float]:
+        """(音声テキスト, TeX) の組み合わせのスコア (SceneScorerと同じく、大きいほどよく対応している)"""
+        for chunk in batched(pairs, batch_size):
+            outputs = self(*tokenize_pairs(chunk, self.bert_model_name))
+            yield from (-np.square(outputs).mean(axis=1)).tolist()
+
+
+def load_exported_model(
+    export_dir: str, runtime: Optional[str] = None
+) -> ExportedModel:
+    """
+    書き出したモデルのうち、この環境で使えて最も速いものを読み込む
+
+    Args:
+        export_dir (str): export_modelの出力ディレクトリ
+        runtime (Optional[str]): 実行方法を指定する場合の名前 (torchscript_int8, onnx_int8など)
+
+    Raises:
+        RuntimeError: 使える実行方法がない場合
+    """
+    directory = Path(export_dir)
+    meta = json.loads((directory / META_FILE).read_text(encoding="utf-8"))
+    candidates = sorted(
+        (result["median_ms"], name)
+        for name, result in meta["results"].items()
+        if result["passed"] and name in meta["artifacts"]
+    )
+    if runtime is not None:
+        candidates = [(ms, name) for ms, name in candidates if name == runtime]
+    for _, name in candidates:
+        path = directory / meta["artifacts"][name]
+        if name.startswith("onnx"):
+            if onnxruntime is None:
+                continue
+            runner = onnx_runner(path)
+        else:
+            runner = torch_runner(torch.jit.load(str(path)))
+        logger.info(f"書き出したモデルを読み込みました: {path} ({name})")
+        return ExportedModel(name, runner, meta["bert_model_name"])
+    raise RuntimeError(f"使える書き出し済みのモデルがありません: {export_dir}")
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(
+        description="学習済みモデルをCPU推論向けに書き出す"
+    )
+    parser.add_argument(
+        "--model_path",
+        type=str,
+        help="学習済みモデルのパス (省略時は事前学習済みの重み)",
+    )
+    parser.add_argument(
+        "--output_dir", type=str, required=True, help="出力ディレクトリ"
+    )
+    parser.add_argument(
+        "--csv_path", type=str, help="精度の確認に使うCSVファイルのパス"
+    )
+    parser.add_argument(
+        "--num_samples",
+        type=int,
+        default=32,
+        help="書き出しと精度の確認・レイテンシの計測に使う組み合わせの数 (3以上)",
+    )
+    parser.add_argument("--repeat", type=int, default=10, help="レイテンシの計測回数")
+    parser.add_argument(
+        "--min_cosine",
+        type=float,
+        default=0.99,
+        help="合格とするfp32の出力とのコサイン類似度の最小値",
+    )
+    parser.add_argument("--threads", type=int, help="演算スレッド数")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.model_path and not os.path.exists(args.model_path):
+        parser.error(f"モデルが見つかりません: {args.model_path}")
+    meta = export_model(
+        args.model_path,
+        args.output_dir,
+        args.csv_path,
+        args.num_samples,
+        args.repeat,
+        args.min_cosine,
+    )
+    passed = [
+        name
+        for name, result in meta["results"].items()
+        if result["passed"] and name in meta["artifacts"]
+    ]
+    if not passed:
+        logger.error("精度の確認に合格した成果物がありません")
+        raise SystemExit(1)
+    fastest = min(passed, key=lambda name: meta["results"][name]["median_ms"])
+    logger.info(
+        f"最速: {fastest} ({meta['results'][fastest]['median_ms']:.1f} ms/バッチ, "
+        f"fp32: {meta['results']['torch_fp32']['median_ms']:.1f} ms/バッチ)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import logging
+from collections.abc import Iterable, Iterator, Sequence
+from itertools import islice
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+import torch
+from model import MAX_LENGTH, MathVideoGenerator
+
+logger = logging.getLogger(__name__)
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """iterableをsize個ずつのリストに分ける"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class SceneScorer:
+    """
+    MathVideoGeneratorで音声とTeXの組み合わせをバッチ推論して採点するクラス
+
+    スコアは学習の損失 (出力を0に近づけるMSE) の符号を反転した値で、大きいほど
+    音声とTeXがよく対応している。BERTの計算はテキストごとに1回だけ行い、
+    組み合わせごとにはヘッド (forward_from_cls) だけを計算する。
+
+    使い方:
+        scorer = SceneScorer(model, batch_size=64, num_threads=8)
+        for score in scorer.iter_scores(pairs):
+            ...
+    """
+
+    def __init__(
+        self,
+        model: MathVideoGenerator,
+        batch_size: int = 64,
+        num_threads: Optional[int] = None,
+        device: Optional[torch.device] = None,
+    ):
+        """
+        Args:
+            model (MathVideoGenerator): 採点に使うモデル
+            batch_size (int): 1回の推論で処理する数
+            num_threads (Optional[int]): PyTorchの演算スレッド数 (Noneの場合は変更しない)
+            device (Optional[torch.device]): 推論するデバイス (Noneの場合はモデルのデバイス)
+        """
+        if batch_size <= 0:
+            raise ValueError(f"batch_sizeは1以上を指定してください: {batch_size}")
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.model = model.eval()
+        self.batch_size = batch_size
+        self.device = device or next(model.parameters()).device
+
+    def encode(self, texts: Sequence[str]) -> torch.Tensor:
+        """テキストごとのBERTのCLS出力 (長さでソートしたバッチで計算する)"""
+        encodings = self.model.tokenizer(
+            list(texts), truncation=True, max_length=MAX_LENGTH
+        )
+        hidden_size = self.model.bert.config.hidden_size
+        embeddings = np.empty((len(texts), hidden_size), dtype=np.float32)
+        self.model.compute_cls_embeddings(
+            encodings["input_ids"], embeddings, self.batch_size, self.device
+        )
+        return torch.from_numpy(embeddings)
+
+    @torch.inference_mode()
+    def score_embeddings(
+        self, voice_cls: torch.Tensor, tex_cls: torch.Tensor
+    ) -> torch.Tensor:
+        """CLS出力の組み合わせごとのスコア"""
+        outputs = self.model(voice_cls.to(self.device), tex_cls.to(self.device))
+        return -outputs.float().pow(2).mean(dim=1).cpu()
+
+    def iter_scores(self, pairs: Iterable[tuple[str, str]]) -> Iterator[float]:
+        """
+        (音声テキスト, TeX) の組み合わせをbatch_size個ずつ読み込んで採点し、順番にスコアを返す
+
+        pairsはジェネレーターでもよく、全体をメモリに持たずに処理できる。
+        """
+        for chunk in batched(pairs, self.batch_size):
+            texts = list(dict.fromkeys(text for pair in chunk for text in pair))
+            position = {text: i for i, text in enumerate(texts)}
+            embeddings = self.encode(texts)
+            voice_cls = embeddings[[position[voice] for voice, _ in chunk]]
+            tex_cls = embeddings[[position[tex] for _, tex in chunk]]
+            yield from self.score_embeddings(voice_cls, tex_cls).tolist()
+
+
+def score_scenes(
+    scorer: SceneScorer, voice_data: pd.DataFrame, image_data: pd.DataFrame
+) -> Iterator[dict[str, Any]]:
+    """
+    音声データと画像データをYMMPGenerator.process_model_outputに渡せる形で返し、画像にはモデルのスコアを付ける
+
+    追加するシーンはCSVの行と同じで、音声データの順にすべての音声を、続いて画像データの順に
+    すべての画像を1件ずつ返す (各画像は1回だけ、元のフレームのまま)。画像のスコアは、
+    同じチャプター・セクションの音声の中で最もよく対応するものとのスコアで、
+    対応する音声がない画像はNoneになる。
+
+    音声と画像のテキストはそれぞれ1回だけBERTに通し、組み合わせの採点は
+    batch_size個ずつまとめて行う。
+    """
+    keys = ["chapter", "section"]
+    voices = voice_data.reset_index(drop=True)
+    # (chapter, section) ごとの音声の位置
+    candidates = {
+        key: group.index.to_numpy() for key, group in voices.groupby(keys, sort=False)
+    }
+
+    # テキストごとのCLS出力 (音声とTeXで重複のないテキストだけを計算する)
+    voice_texts = voices["text"].tolist()
+    tex_texts = image_data["tex_content"].tolist()
+    texts = list(dict.fromkeys(voice_texts + tex_texts))
+    position = {text: i for i, text in enumerate(texts)}
+    logger.info(f"{len(texts)}件のテキストをエンコードします...")
+    embeddings = scorer.encode(texts)
+
+    def iter_pairs() -> Iterator[tuple[int, int]]:
+        for image_pos, key in enumerate(
+            zip(image_data["chapter"], image_data["section"])
+        ):
+            for voice_pos in candidates.get(key, ()):
+                yield voice_pos, image_pos
+
+    def iter_scores() -> Iterator[float]:
+        for chunk in batched(iter_pairs(), scorer.batch_size):
+            voice_cls = embeddings[[position[voice_texts[v]] for v, _ in chunk]]
+            tex_cls = embeddings[[position[tex_texts[i]] for _, i in chunk]]
+            yield from scorer.score_embeddings(voice_cls, tex_cls).tolist()
+
+    for voice in voices.itertuples(index=False):
+        yield {
+            "type": "voice",
+            "content": voice.text,
+            "speaker": voice.speaker,
+            "duration": voice.length,
+            "frame": voice.frame,
+            "chapter": voice.chapter,
+            "section": voice.section,
+        }
+
+    scores = iter_scores()
+    for image in image_data.itertuples(index=False):
+        voice_positions = candidates.get((image.chapter, image.section), ())
+        yield {
+            "type": "image",
+            "file_path": image.file_path,
+            "tex_content": getattr(image, "remark", image.tex_content),
+            "duration": image.length,
+            "frame": image.frame,
+            "score": max((next(scores) for _ in voice_positions), default=None),
+        }
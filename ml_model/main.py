@@ -1,11 +1,20 @@
 import torch
-from model import MathVideoGenerator, DataProcessor, train_model
+from model import BERT_MODEL_NAME, MathVideoGenerator, DataProcessor, LengthBucketSampler, PairedTokenDataset, TrainingOptions, collate_padded, train_model
+from dataset_cache import file_digest, load_or_compute_cls_embeddings, load_or_create_training_data
 from ymmp_generator import YMMPGenerator
+import distributed
+from inference import SceneScorer, score_scenes
 import argparse
-from torch.utils.data import DataLoader
+from functools import partial
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
 import os
 from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts
 import logging
+import json
+import time
+from typing import Any, Optional, Union
+from torch import nn
 
 # ロギングの設定
 logging.basicConfig(
@@ -22,102 +31,239 @@ def main():
     parser.add_argument('--batch_size', type=int, default=32, help='バッチサイズ')
     parser.add_argument('--epochs', type=int, default=10, help='学習エポック数')
     parser.add_argument('--learning_rate', type=float, default=1e-5, help='学習率')
+    parser.add_argument('--bucket_size', type=int, default=50, help='長さでソートしてバッチを作る範囲（バッチ何個分か）')
+    parser.add_argument('--shared_encoder_pass', action='store_true', help='音声とTeXの入力をまとめてBERTを1回だけ実行する')
+    parser.add_argument('--freeze_encoder', action='store_true', help='BERTを凍結し、キャッシュしたCLS出力でヘッドだけを学習する')
+    parser.add_argument('--embedding_batch_size', type=int, default=64, help='CLS出力を計算するときのバッチサイズ')
+    parser.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32', help='順伝播の精度（bf16はCPUでも自動混合精度で計算する）')
+    parser.add_argument('--accumulation_steps', type=int, default=1, help='勾配を累積するバッチ数（実質のバッチサイズはbatch_size×この値）')
+    parser.add_argument('--compile', action='store_true', help='torch.compileでモデルをコンパイルする')
+    parser.add_argument('--throughput_report', type=str, help='学習のスループットを追記するJSON Linesファイルのパス')
+    parser.add_argument('--cache_dir', type=str, default='.dataset_cache', help='前処理済みデータセットのキャッシュディレクトリ')
+    parser.add_argument('--no_cache', action='store_true', help='データセットのキャッシュを使わない')
     parser.add_argument('--warmup_epochs', type=int, default=2, help='ウォームアップエポック数')
+    parser.add_argument('--inference_batch_size', type=int, default=64, help='YMMP生成時の推論のバッチサイズ')
+    parser.add_argument('--inference_threads', type=int, help='YMMP生成時の推論の演算スレッド数（デフォルト: PyTorchの既定値）')
+    parser.add_argument('--num_processes', type=int, default=1, help='CPUでデータ並列学習するプロセス数（2以上でglooバックエンドのDDP）')
+    parser.add_argument('--threads_per_process', type=int, help='プロセスごとの演算スレッド数（デフォルト: 割り当てたコア数）')
+    parser.add_argument('--master_port', type=int, default=29500, help='プロセス間通信に使うポート')
     args = parser.parse_args()
 
-    # デバイスの設定
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    logger.info(f'使用デバイス: {device}')
+    if args.num_processes > 1:
+        distributed.launch(run, args.num_processes, args)
+    else:
+        run(0, 1, args)
 
-    # データの読み込みと前処理
-    logger.info('データの読み込みを開始します...')
-    data_processor = DataProcessor(args.csv_path)
-    voice_data, image_data = data_processor.create_dataset()
-    
-    # 学習データの作成
-    logger.info('学習データの作成を開始します...')
-    encodings = data_processor.create_training_data(voice_data, image_data)
-    
-    # データローダーの作成
-    train_dataset = torch.utils.data.TensorDataset(
-        encodings['voice']['input_ids'],
-        encodings['voice']['attention_mask'],
-        encodings['image']['input_ids'],
-        encodings['image']['attention_mask']
-    )
-    train_loader = DataLoader(
-        train_dataset, 
-        batch_size=args.batch_size, 
-        shuffle=True,
-        num_workers=4,
-        pin_memory=True
-    )
+def run(rank: int, world_size: int, args: argparse.Namespace) -> None:
+    """学習とYMMPファイルの生成を行う（データ並列の場合は各プロセスで実行され、保存とログはrank 0だけが行う）"""
+    if world_size > 1:
+        distributed.init_worker(rank, world_size, args.master_port, args.threads_per_process)
+    try:
+        train_and_generate(rank, world_size, args)
+    finally:
+        distributed.cleanup()
+
+def loader_options(world_size: int, device: torch.device) -> dict[str, Any]:
+    """
+    学習データのDataLoaderの読み込みプロセス数とピン留めメモリの設定
+
+    データ並列の場合は各プロセスにコアを割り当てているため、読み込みプロセスを増やすと
+    --threads_per_processで分けたコアを奪い合う。CPUで学習する場合もGPUへの転送がなく
+    ピン留めメモリは不要なため、どちらの場合もメインプロセスで読み込む。
+    """
+    if world_size > 1 or device.type == 'cpu':
+        return {'num_workers': 0, 'pin_memory': False}
+    return {'num_workers': 4, 'pin_memory': True}
 
-    # モデルの初期化
+
+def load_model(args: argparse.Namespace, device: torch.device) -> tuple[MathVideoGenerator, str]:
+    """モデルと、CLS出力のキャッシュのキーに含める重みの識別子を返す"""
     logger.info('モデルの初期化を開始します...')
-    model = MathVideoGenerator().to(device)
+    model = MathVideoGenerator(shared_encoder_pass=args.shared_encoder_pass).to(device)
+    weights_id = BERT_MODEL_NAME
     if args.model_path and os.path.exists(args.model_path):
         model.load_state_dict(torch.load(args.model_path))
+        weights_id += f':{file_digest(args.model_path)}'
         logger.info(f'学習済みモデルを読み込みました: {args.model_path}')
+    return model, weights_id
+
+
+def create_train_loader(  # noqa: PLR0913
+    args: argparse.Namespace, model: MathVideoGenerator, train_dataset: PairedTokenDataset,
+    weights_id: str, device: torch.device, rank: int, world_size: int
+) -> tuple[DataLoader, Optional[Union[DistributedSampler, LengthBucketSampler]]]:
+    """学習データのDataLoaderと、エポックごとにset_epochを呼ぶサンプラーを返す"""
+    if args.freeze_encoder:
+        # BERTのCLS出力を一度だけ計算し、ヘッドだけを学習する
+        model.freeze_encoder()
+        with distributed.main_process_first():
+            embedding_dataset = load_or_compute_cls_embeddings(
+                model,
+                train_dataset,
+                None if args.no_cache else args.cache_dir,
+                weights_id,
+                batch_size=args.embedding_batch_size,
+                device=device
+            )
+        train_sampler = None
+        if world_size > 1:
+            train_sampler = DistributedSampler(embedding_dataset, num_replicas=world_size, rank=rank, shuffle=True)
+        train_loader = DataLoader(
+            embedding_dataset,
+            batch_size=args.batch_size,
+            shuffle=train_sampler is None,
+            sampler=train_sampler
+        )
+        return train_loader, train_sampler
+
+    # 長さの近い例をまとめ、バッチごとにその最大長までパディングする
+    train_sampler = LengthBucketSampler(
+        train_dataset.lengths,
+        batch_size=args.batch_size,
+        bucket_size=args.bucket_size,
+        shuffle=True,
+        num_replicas=world_size,
+        rank=rank
+    )
+    train_loader = DataLoader(
+        train_dataset,
+        batch_sampler=train_sampler,
+        collate_fn=partial(collate_padded, pad_token_id=train_dataset.pad_token_id),
+        **loader_options(world_size, device)
+    )
+    return train_loader, train_sampler
+
+
+def wrap_train_target(model: MathVideoGenerator, args: argparse.Namespace, world_size: int) -> nn.Module:
+    """
+    学習に使うモデルを返す (保存は元のモデルから行う)
+
+    データ並列の場合はDDPで包み、--compileの場合はDDPで包んだものをコンパイルする。
+    この順番にするとDynamoがDDPの勾配のバケットの境界でグラフを分け (DDPOptimizer)、
+    逆伝播と勾配の通信を重ねられる (PyTorchのドキュメントが推奨する順番)。
+    コンパイル済みのモデルの属性は元のモデルに委譲されるため、no_syncもそのまま使える。
+    """
+    train_target: nn.Module = model
+    if world_size > 1:
+        train_target = DistributedDataParallel(model)
+    if args.compile:
+        if hasattr(torch, 'compile'):
+            train_target = torch.compile(train_target)
+            logger.info('torch.compileでモデルをコンパイルします (最初のバッチは遅くなります)')
+        else:
+            logger.warning('このバージョンのPyTorchはtorch.compileに対応していません')
+    return train_target
+
 
-    # オプティマイザと損失関数の設定
+def create_training_options(args: argparse.Namespace, model: MathVideoGenerator,
+                            device: torch.device) -> tuple[torch.optim.Optimizer, TrainingOptions]:
+    """オプティマイザと、学習率スケジューラーなどの学習の設定を作る"""
     optimizer = torch.optim.AdamW(
-        model.parameters(),
+        [param for param in model.parameters() if param.requires_grad],
         lr=args.learning_rate,
         weight_decay=0.01
     )
-    criterion = torch.nn.MSELoss()
-    
-    # 学習率スケジューラーの設定
     scheduler = CosineAnnealingWarmRestarts(
         optimizer,
         T_0=args.epochs // 2,  # 最初のリスタートまでのエポック数
         T_mult=2,  # リスタートごとの周期の倍率
         eta_min=args.learning_rate * 0.1  # 最小学習率
     )
+    options = TrainingOptions(
+        device,
+        scheduler=scheduler,
+        autocast_dtype=torch.bfloat16 if args.precision == 'bf16' else None,
+        accumulation_steps=args.accumulation_steps
+    )
+    return optimizer, options
+
+
+def report_throughput(args: argparse.Namespace, world_size: int, throughputs: list[float]) -> None:
+    """スループットをログに出し、--throughput_reportのファイルに追記する"""
+    if not throughputs:
+        return
+    training_config = {
+        'precision': args.precision,
+        'batch_size': args.batch_size,
+        'accumulation_steps': args.accumulation_steps,
+        'effective_batch_size': args.batch_size * args.accumulation_steps,
+        'compile': args.compile,
+        'freeze_encoder': args.freeze_encoder,
+        'shared_encoder_pass': args.shared_encoder_pass,
+        'num_processes': world_size,
+        'num_threads': torch.get_num_threads()
+    }
+    # 最初のエポックはコンパイルやキャッシュの準備を含むため、2エポック目以降で集計する
+    steady = throughputs[1:] or throughputs
+    report = {**training_config, 'samples_per_sec': sum(steady) / len(steady), 'first_epoch_samples_per_sec': throughputs[0]}
+    logger.info('スループット: ' + ', '.join(f'{key}={value}' for key, value in training_config.items())
+                + f' -> {report["samples_per_sec"]:.1f} サンプル/秒')
+    if args.throughput_report:
+        with open(args.throughput_report, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False) + '\n')
+
+
+def train_and_generate(rank: int, world_size: int, args: argparse.Namespace) -> None:
+    # デバイスの設定（データ並列はCPUのみ）
+    device = torch.device('cuda' if torch.cuda.is_available() and world_size == 1 else 'cpu')
+    logger.info(f'使用デバイス: {device}')
+
+    # データの読み込みと前処理（同じ入力の前処理済みデータセットがあればキャッシュから読み込む）
+    logger.info('学習データの作成を開始します...')
+    data_processor = DataProcessor(args.csv_path)
+    with distributed.main_process_first():
+        train_dataset, voice_data, image_data = load_or_create_training_data(
+            data_processor,
+            None if args.no_cache else args.cache_dir
+        )
+
+    model, weights_id = load_model(args, device)
+    train_loader, train_sampler = create_train_loader(
+        args, model, train_dataset, weights_id, device, rank, world_size
+    )
+    train_target = wrap_train_target(model, args, world_size)
+    optimizer, options = create_training_options(args, model, device)
+    criterion = torch.nn.MSELoss()
 
     # モデルの学習
     logger.info('モデルの学習を開始します...')
+    num_samples = len(train_loader.dataset)
+    throughputs = []
     best_loss = float('inf')
     for epoch in range(args.epochs):
-        loss = train_model(model, train_loader, optimizer, criterion, device, scheduler)
-        logger.info(f'エポック {epoch+1}/{args.epochs}, 損失: {loss:.4f}')
-        
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        start_time = time.perf_counter()
+        loss = train_model(train_target, train_loader, optimizer, criterion, options)
+        elapsed = time.perf_counter() - start_time
+        # 損失は全プロセスの平均（全プロセスで同じ値になるため、ベストモデルの判定も揃う）
+        loss = distributed.all_reduce_mean(loss)
+        throughputs.append(num_samples / elapsed)
+        logger.info(f'エポック {epoch+1}/{args.epochs}, 損失: {loss:.4f}, {throughputs[-1]:.1f} サンプル/秒')
+
         # ベストモデルの保存
         if loss < best_loss:
             best_loss = loss
-            torch.save(model.state_dict(), f'best_model_epoch_{epoch+1}.pt')
-            logger.info(f'ベストモデルを保存しました（損失: {loss:.4f}）')
+            if distributed.is_main_process():
+                torch.save(model.state_dict(), f'best_model_epoch_{epoch+1}.pt')
+                logger.info(f'ベストモデルを保存しました（損失: {loss:.4f}）')
+
+    if not distributed.is_main_process():
+        return
+
+    report_throughput(args, world_size, throughputs)
 
     # YMMPファイル生成
     logger.info('YMMPファイルの生成を開始します...')
     ymmp_generator = YMMPGenerator()
-    
-    # モデルの推論とYMMPファイル生成
-    model.eval()
-    with torch.no_grad():
-        # 音声データの処理
-        for voice_item in voice_data.itertuples():
-            ymmp_generator.add_voice_content(
-                text=voice_item.text,
-                speaker=voice_item.speaker,
-                duration=voice_item.length,
-                frame=voice_item.frame
-            )
-            # チャプターとセクションの情報を追加
-            ymmp_generator.create_chapter_section(
-                chapter=voice_item.chapter,
-                section=voice_item.section
-            )
-        
-        # 画像データの処理
-        for image_item in image_data.itertuples():
-            ymmp_generator.add_image_content(
-                file_path=image_item.file_path,
-                tex_content=image_item.remark,
-                duration=image_item.length,
-                frame=image_item.frame
-            )
+
+    # モデルの推論とYMMPファイル生成（すべての音声と画像を追加し、画像には同じセクションの音声とのスコアをバッチ推論で付ける）
+    scorer = SceneScorer(
+        model,
+        batch_size=args.inference_batch_size,
+        num_threads=args.inference_threads
+    )
+    ymmp_generator.process_model_output(score_scenes(scorer, voice_data, image_data))
 
     # YMMPファイルの生成
     ymmp_generator.generate_ymmp(args.output_path)
@@ -1,27 +1,50 @@
-import torch
-import torch.nn as nn
-from transformers import BertModel, BertTokenizer
-import pandas as pd
-import numpy as np
-from typing import Dict, List, Tuple, Optional
+import logging
 import re
 import unicodedata
+from contextlib import nullcontext
+from dataclasses import dataclass
+from functools import cache
 from pathlib import Path
-import logging
-import json
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+import torch
+from pairing import pair_voice_and_image
+from torch import nn
+from transformers import BertModel, BertTokenizer
 
 logger = logging.getLogger(__name__)
 
+BERT_MODEL_NAME = 'cl-tohoku/bert-base-japanese-whole-word-masking'
+MAX_LENGTH = 512
+
+# normalize_text・normalize_math_content・create_datasetの前処理を変えたら上げる
+# (データセットのキャッシュのキーに含まれる)
+NORMALIZATION_VERSION = 1
+
+@cache
+def load_tokenizer(name: str = BERT_MODEL_NAME) -> BertTokenizer:
+    """トークナイザーを読み込む (同じ名前なら同じインスタンスを共有する)"""
+    return BertTokenizer.from_pretrained(name)
+
 class MathVideoGenerator(nn.Module):
-    def __init__(self, bert_model_name: str = 'cl-tohoku/bert-base-japanese-whole-word-masking'):
+    def __init__(self, bert_model_name: str = BERT_MODEL_NAME, shared_encoder_pass: bool = False):
+        """
+        Args:
+            bert_model_name (str): BERTのモデル名
+            shared_encoder_pass (bool): 音声とTeXの入力を1つのバッチにまとめ、BERTを1回だけ実行する
+                (評価モードでは2回に分けた場合と浮動小数点の誤差の範囲で同じ出力になる。学習時はドロップアウトの乱数だけが異なる)
+        """
         super().__init__()
         self.bert = BertModel.from_pretrained(bert_model_name)
-        self.tokenizer = BertTokenizer.from_pretrained(bert_model_name)
-        
+        self.tokenizer = load_tokenizer(bert_model_name)
+        self.shared_encoder_pass = shared_encoder_pass
+
         # 音声とTeXコンテンツ用の別々のエンコーダー
         self.voice_encoder = nn.Linear(768, 512)
         self.tex_encoder = nn.Linear(768, 512)
-        
+
         # 出力層
         self.output_layer = nn.Sequential(
             nn.Linear(1024, 512),
@@ -29,44 +52,124 @@ class MathVideoGenerator(nn.Module):
             nn.Dropout(0.1),
             nn.Linear(512, 256)
         )
-        
-    def forward(self, voice_input: Dict[str, torch.Tensor], tex_input: Dict[str, torch.Tensor]) -> torch.Tensor:
-        # 音声テキストの処理
-        voice_outputs = self.bert(**voice_input)
-        voice_features = self.voice_encoder(voice_outputs.last_hidden_state[:, 0, :])
-        
-        # TeXコンテンツの処理
-        tex_outputs = self.bert(**tex_input)
-        tex_features = self.tex_encoder(tex_outputs.last_hidden_state[:, 0, :])
-        
+
+    def _pad_input(self, inputs: dict[str, torch.Tensor], key: str, length: int) -> torch.Tensor:
+        """入力を右側にパディングしてlengthの長さにする (attention_maskなどは0で埋める)"""
+        tensor = inputs[key]
+        value = self.bert.config.pad_token_id if key == 'input_ids' else 0
+        return nn.functional.pad(tensor, (0, length - tensor.size(1)), value=value or 0)
+
+    def encode_pair(self, voice_input: dict[str, torch.Tensor], tex_input: dict[str, torch.Tensor]) -> tuple[torch.Tensor, torch.Tensor]:
+        """音声とTeXそれぞれのBERTのCLS出力を返す"""
+        if not self.shared_encoder_pass:
+            voice_cls = self.bert(**voice_input).last_hidden_state[:, 0, :]
+            tex_cls = self.bert(**tex_input).last_hidden_state[:, 0, :]
+            return voice_cls, tex_cls
+
+        if voice_input.keys() != tex_input.keys():
+            raise ValueError("音声とTeXの入力の項目が一致しません。")
+        # 長い方に合わせてパディングし、バッチ方向に連結して1回で処理する
+        # (追加したパディングはattention_maskで無視されるため、CLS出力は変わらない)
+        batch_size = voice_input['input_ids'].size(0)
+        length = max(voice_input['input_ids'].size(1), tex_input['input_ids'].size(1))
+        combined = {
+            key: torch.cat([self._pad_input(voice_input, key, length), self._pad_input(tex_input, key, length)])
+            for key in voice_input
+        }
+        cls = self.bert(**combined).last_hidden_state[:, 0, :]
+        return cls[:batch_size], cls[batch_size:]
+
+    def forward(self, voice_input: Union[dict[str, torch.Tensor], torch.Tensor],
+                tex_input: Union[dict[str, torch.Tensor], torch.Tensor]) -> torch.Tensor:
+        # CLS出力が渡された場合 (エンコーダーを凍結した学習) はヘッドだけを計算する
+        # (DistributedDataParallelやtorch.compileを通すため、forwardから呼ぶ)
+        if isinstance(voice_input, torch.Tensor):
+            return self.forward_from_cls(voice_input, tex_input)
+
+        # 音声テキストとTeXコンテンツのBERT出力
+        voice_cls, tex_cls = self.encode_pair(voice_input, tex_input)
+        return self.forward_from_cls(voice_cls, tex_cls)
+
+    def forward_from_cls(self, voice_cls: torch.Tensor, tex_cls: torch.Tensor) -> torch.Tensor:
+        """BERTのCLS出力からモデルの出力を計算する (エンコーダーを凍結した学習で使う)"""
+        voice_features = self.voice_encoder(voice_cls)
+        tex_features = self.tex_encoder(tex_cls)
+
         # 特徴量の結合
         combined_features = torch.cat([voice_features, tex_features], dim=1)
-        
+
         # 出力層
         return self.output_layer(combined_features)
 
+    def freeze_encoder(self) -> None:
+        """BERTのパラメータを学習しないようにする (ヘッドだけを学習する)"""
+        for param in self.bert.parameters():
+            param.requires_grad = False
+
+    @torch.no_grad()
+    def compute_cls_embeddings(self, sequences: list[np.ndarray], out: np.ndarray,
+                               batch_size: int = 64, device: Optional[torch.device] = None) -> np.ndarray:
+        """
+        トークン列ごとのBERTのCLS出力を、長さでソートしたバッチ推論で計算する
+
+        Args:
+            sequences (list[np.ndarray]): トークン列
+            out (np.ndarray): 結果を書き込む (len(sequences), hidden_size) の配列 (np.memmapでもよい)
+            batch_size (int): 1回の推論で処理する数
+            device (Optional[torch.device]): 推論するデバイス (Noneの場合はモデルのデバイス)
+
+        Returns:
+            np.ndarray: out
+        """
+        device = device or next(self.bert.parameters()).device
+        pad_token_id = self.bert.config.pad_token_id or 0
+        was_training = self.bert.training
+        self.bert.eval()
+        try:
+            order = np.argsort([len(seq) for seq in sequences], kind='stable')
+            for start in range(0, len(order), batch_size):
+                indices = order[start:start + batch_size]
+                input_ids, attention_mask = pad_sequences(
+                    [torch.from_numpy(np.asarray(sequences[i], dtype=np.int64)) for i in indices],
+                    pad_token_id
+                )
+                outputs = self.bert(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device))
+                out[indices] = outputs.last_hidden_state[:, 0, :].float().cpu().numpy()
+        finally:
+            self.bert.train(was_training)
+        return out
+
 class DataProcessor:
-    def __init__(self, csv_path: str):
+    def __init__(self, csv_path: str, tokenizer_name: str = BERT_MODEL_NAME,
+                 tokenizer: Optional[BertTokenizer] = None):
         self.csv_path = csv_path
+        self.tokenizer_name = tokenizer_name
         self.required_fields = ['ymmp_path', 'tex_paths', 'instruction_type', 'speaker', 'text', 'file_path', 'frame', 'length', 'layer']
         self.numeric_fields = ['frame', 'length', 'layer', 'chapter', 'section']
-        self.tokenizer = BertTokenizer.from_pretrained('cl-tohoku/bert-base-japanese-whole-word-masking')
-        
+        self._tokenizer = tokenizer
+
+    @property
+    def tokenizer(self) -> BertTokenizer:
+        """トークナイザー (キャッシュから読み込む場合は不要なため、初めて使うときに読み込む)"""
+        if self._tokenizer is None:
+            self._tokenizer = load_tokenizer(self.tokenizer_name)
+        return self._tokenizer
+
     def normalize_text(self, text: str) -> str:
         """テキストの正規化を行う"""
         if not isinstance(text, str):
             return ""
-            
+
         # 全角文字を半角に変換
         text = unicodedata.normalize('NFKC', text)
-        
+
         # 特殊文字の処理
         text = re.sub(r'[\r\n\t]', ' ', text)
         text = re.sub(r'\s+', ' ', text)
-        
+
         # 前後の空白を削除
         return text.strip()
-    
+
     def normalize_math_content(self, tex_content: str) -> str:
         """数式コンテンツの正規化を行う"""
         if not isinstance(tex_content, str):
@@ -77,26 +180,26 @@ class DataProcessor:
         tex_content = re.sub(r'\\begin\{.*?\}', r'\\begin{equation}', tex_content)
         tex_content = re.sub(r'\\end\{.*?\}', r'\\end{equation}', tex_content)
         return tex_content.strip()
-    
+
     def validate_data(self, df: pd.DataFrame) -> pd.DataFrame:
         """データの検証とクリーニングを行う"""
         # 必須フィールドのチェック
         missing_fields = [field for field in self.required_fields if field not in df.columns]
         if missing_fields:
             raise ValueError(f"必須フィールドが不足しています: {missing_fields}")
-        
+
         # 数値フィールドの検証
         for field in self.numeric_fields:
             if field in df.columns:
                 df[field] = pd.to_numeric(df[field], errors='coerce')
                 df[field] = df[field].fillna(0)
-        
+
         # ファイルパスの検証
         if 'file_path' in df.columns:
             df['file_path'] = df['file_path'].apply(lambda x: str(Path(x)) if pd.notna(x) else '')
-        
+
         return df
-    
+
     def load_data(self) -> pd.DataFrame:
         """CSVファイルからデータを読み込む"""
         try:
@@ -105,24 +208,24 @@ class DataProcessor:
             logger.info(f"データを読み込みました: {len(df)}行")
             return df
         except Exception as e:
-            logger.error(f"データの読み込みに失敗しました: {str(e)}")
+            logger.error(f"データの読み込みに失敗しました: {e!s}")
             raise
-    
+
     def preprocess_text(self, text: str) -> str:
         """テキストの前処理を行う"""
         return self.normalize_text(text)
-    
-    def create_dataset(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+
+    def create_dataset(self) -> tuple[pd.DataFrame, pd.DataFrame]:
         """データセットを作成する"""
         df = self.load_data()
-        
+
         # 音声データと画像データを分離
         voice_data = df[df['instruction_type'] == 'voice'].copy()
         image_data = df[df['instruction_type'] == 'image'].copy()
-        
+
         # テキストの前処理
         voice_data['text'] = voice_data['text'].apply(self.preprocess_text)
-        
+
         # tex_pathsで示されるファイルの内容を読み込んでtex_content列を作成
         def read_tex_file(path):
             def try_open(p, encodings):
@@ -137,8 +240,8 @@ class DataProcessor:
                 if pd.isna(path) or not str(path).strip():
                     return ''
                 contents = []
-                for p in str(path).split(','):
-                    p = p.strip()
+                for part in str(path).split(','):
+                    p = part.strip()
                     if not p:
                         continue
                     # utf-8, cp932, euc-jpの順で試す
@@ -152,92 +255,297 @@ class DataProcessor:
         image_data['tex_content'] = image_data['tex_content'].apply(lambda x: re.sub(r'\\begin\{.*?\}', r'\\begin{equation}', x))
         image_data['tex_content'] = image_data['tex_content'].apply(lambda x: re.sub(r'\\end\{.*?\}', r'\\end{equation}', x))
         image_data['tex_content'] = image_data['tex_content'].apply(self.normalize_math_content)
-        
+
         # データの並び替え
         voice_data = voice_data.sort_values(['chapter', 'section', 'frame'])
         image_data = image_data.sort_values(['chapter', 'section', 'frame'])
-        
+
         return voice_data, image_data
-    
-    def create_training_data(self, voice_data: pd.DataFrame, image_data: pd.DataFrame) -> Dict[str, torch.Tensor]:
-        """学習用データを作成する"""
+
+    def pair_voice_and_image(self, voice_data: pd.DataFrame, image_data: pd.DataFrame) -> pd.DataFrame:
+        """音声データごとに、同じチャプター・セクションで最も近いフレームの画像データを対応付ける (pairing.pair_voice_and_imageを参照)"""
+        return pair_voice_and_image(voice_data, image_data)
+
+    def create_training_data(self, voice_data: pd.DataFrame, image_data: pd.DataFrame) -> 'PairedTokenDataset':
+        """学習用データを作成する (パディングはバッチごとにcollate_paddedで行う)"""
         # 音声データと画像データをペアにする
-        paired_data = []
-        for _, voice_row in voice_data.iterrows():
-            # 同じチャプターとセクションの画像データを探す
-            matching_images = image_data[
-                (image_data['chapter'] == voice_row['chapter']) & 
-                (image_data['section'] == voice_row['section'])
-            ]
-            if not matching_images.empty:
-                # 最も近いフレームの画像を選択
-                frame_diffs = (matching_images['frame'] - voice_row['frame']).abs()
-                closest_idx = frame_diffs.idxmin()
-                closest_image = matching_images.loc[closest_idx]
-                paired_data.append({
-                    'voice_text': voice_row['text'],
-                    'image_tex': closest_image['tex_content']
-                })
-        
-        if not paired_data:
+        paired_data = self.pair_voice_and_image(voice_data, image_data)
+
+        if paired_data.empty:
             raise ValueError("ペアになるデータが見つかりませんでした。")
-        
+
         # ペアになったデータをエンコード
-        voice_texts = [pair['voice_text'] for pair in paired_data]
-        image_texs = [pair['image_tex'] for pair in paired_data]
-        
-        # 音声データのエンコード
+        voice_texts = paired_data['voice_text'].tolist()
+        image_texs = paired_data['image_tex'].tolist()
+
+        # 音声データのエンコード (例ごとの長さのまま保持する)
         voice_encodings = self.tokenizer(
             voice_texts,
-            padding=True,
             truncation=True,
-            max_length=512,
-            return_tensors='pt'
+            max_length=MAX_LENGTH
         )
-        
+
         # 画像データのエンコード
         image_encodings = self.tokenizer(
             image_texs,
-            padding=True,
             truncation=True,
-            max_length=512,
-            return_tensors='pt'
+            max_length=MAX_LENGTH
         )
-        
-        return {
-            'voice': voice_encodings,
-            'image': image_encodings
-        }
 
-def train_model(model: MathVideoGenerator, train_loader: torch.utils.data.DataLoader, 
-                optimizer: torch.optim.Optimizer, criterion: nn.Module, device: torch.device,
-                scheduler: Optional[torch.optim.lr_scheduler._LRScheduler] = None) -> float:
-    """モデルの学習を行う"""
+        return PairedTokenDataset.from_sequences(
+            voice_encodings['input_ids'],
+            image_encodings['input_ids'],
+            pad_token_id=self.tokenizer.pad_token_id
+        )
+
+class PairedTokenDataset(torch.utils.data.Dataset):
+    """
+    音声とTeXのトークン列のペアを、パディングせずに例ごとに保持するデータセット
+
+    トークン列は全例を連結した1次元配列と、各例の開始位置 (offsets, 例の数+1) で持つ。
+    np.memmapをそのまま渡せば、ディスク上のキャッシュをコピーせずに使える。
+    """
+    def __init__(self, voice_tokens: np.ndarray, voice_offsets: np.ndarray,  # noqa: PLR0913
+                 tex_tokens: np.ndarray, tex_offsets: np.ndarray, pad_token_id: int = 0,
+                 cache_key: Optional[str] = None):
+        if len(voice_offsets) != len(tex_offsets):
+            raise ValueError("音声とTeXのトークン列の数が一致しません。")
+        # キャッシュから読み込んだ (またはキャッシュに保存した) 場合のキー
+        self.cache_key = cache_key
+        self.voice_tokens = voice_tokens
+        self.voice_offsets = voice_offsets
+        self.tex_tokens = tex_tokens
+        self.tex_offsets = tex_offsets
+        self.pad_token_id = pad_token_id
+
+    @classmethod
+    def from_sequences(cls, voice_ids: list[list[int]], tex_ids: list[list[int]],
+                       pad_token_id: int = 0) -> 'PairedTokenDataset':
+        """例ごとのトークン列のリストから作成する"""
+        def flatten(sequences):
+            offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(ids) for ids in sequences])
+            tokens = np.fromiter((token for ids in sequences for token in ids),
+                                 dtype=np.int32, count=int(offsets[-1]))
+            return tokens, offsets
+        if len(voice_ids) != len(tex_ids):
+            raise ValueError("音声とTeXのトークン列の数が一致しません。")
+        return cls(*flatten(voice_ids), *flatten(tex_ids), pad_token_id=pad_token_id)
+
+    def __len__(self) -> int:
+        return len(self.voice_offsets) - 1
+
+    @staticmethod
+    def _slice(tokens: np.ndarray, offsets: np.ndarray, idx: int) -> torch.Tensor:
+        # memmapは読み取り専用のため、int64への変換でコピーしてからテンソルにする
+        return torch.from_numpy(tokens[offsets[idx]:offsets[idx + 1]].astype(np.int64))
+
+    def __getitem__(self, idx: int) -> tuple[torch.Tensor, torch.Tensor]:
+        return (self._slice(self.voice_tokens, self.voice_offsets, idx),
+                self._slice(self.tex_tokens, self.tex_offsets, idx))
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """例ごとの長さ (音声とTeXの長い方) で、バケット分けに使う"""
+        return np.maximum(np.diff(self.voice_offsets), np.diff(self.tex_offsets))
+
+    def unique_sequences(self) -> tuple[list[np.ndarray], np.ndarray, np.ndarray]:
+        """
+        音声とTeXを合わせた重複のないトークン列と、各例がそのどれに当たるかを返す
+
+        Returns:
+            tuple[list[np.ndarray], np.ndarray, np.ndarray]: 重複のないトークン列、
+                音声のインデックス、TeXのインデックス
+        """
+        sequences = []
+        positions = {}
+        def index_of(tokens: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+            indices = np.empty(len(self), dtype=np.int64)
+            for i in range(len(self)):
+                seq = tokens[offsets[i]:offsets[i + 1]]
+                key = seq.tobytes()
+                if key not in positions:
+                    positions[key] = len(sequences)
+                    sequences.append(np.asarray(seq))
+                indices[i] = positions[key]
+            return indices
+        voice_index = index_of(self.voice_tokens, self.voice_offsets)
+        tex_index = index_of(self.tex_tokens, self.tex_offsets)
+        return sequences, voice_index, tex_index
+
+class CachedEmbeddingDataset(torch.utils.data.Dataset):
+    """重複のないテキストのCLS出力の表と、各例の音声・TeXがどの行に当たるかで持つデータセット"""
+    def __init__(self, embeddings: np.ndarray, voice_index: np.ndarray, tex_index: np.ndarray):
+        if len(voice_index) != len(tex_index):
+            raise ValueError("音声とTeXの数が一致しません。")
+        self.embeddings = embeddings
+        self.voice_index = voice_index
+        self.tex_index = tex_index
+
+    def __len__(self) -> int:
+        return len(self.voice_index)
+
+    def __getitem__(self, idx: int) -> tuple[torch.Tensor, torch.Tensor]:
+        return (torch.from_numpy(np.array(self.embeddings[self.voice_index[idx]])),
+                torch.from_numpy(np.array(self.embeddings[self.tex_index[idx]])))
+
+def pad_sequences(sequences: list[torch.Tensor], pad_token_id: int = 0) -> tuple[torch.Tensor, torch.Tensor]:
+    """トークン列をその中の最大長までパディングし、input_idsとattention_maskを返す"""
+    max_length = max(len(seq) for seq in sequences)
+    input_ids = torch.full((len(sequences), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_length), dtype=torch.long)
+    for i, seq in enumerate(sequences):
+        input_ids[i, :len(seq)] = seq
+        attention_mask[i, :len(seq)] = 1
+    return input_ids, attention_mask
+
+def collate_padded(batch: list[tuple[torch.Tensor, torch.Tensor]], pad_token_id: int = 0) -> tuple[torch.Tensor, ...]:
+    """
+    バッチ内の最大長までだけパディングするcollate関数
+
+    Returns:
+        tuple[torch.Tensor, ...]: 音声のinput_ids・attention_mask、TeXのinput_ids・attention_mask
+    """
+    voice_ids, tex_ids = zip(*batch)
+    return (*pad_sequences(list(voice_ids), pad_token_id), *pad_sequences(list(tex_ids), pad_token_id))
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """
+    長さの近い例を同じバッチにまとめるバッチサンプラー
+
+    エポックごとに全体をシャッフルしてから batch_size * bucket_size 件ずつのバケットに分け、
+    バケット内を長さでソートしてバッチを作る。バッチの順番もシャッフルするため、
+    パディングを減らしつつ学習順のランダム性を保てる。
+
+    num_replicas > 1 の場合は、全プロセスで同じ順番に作ったバッチをrankごとに分担する
+    (プロセス間でバッチの数を揃えるため、足りない分は先頭のバッチを繰り返す)。
+    """
+    def __init__(self, lengths: list[int], batch_size: int, bucket_size: int = 50,  # noqa: PLR0913
+                 shuffle: bool = True, drop_last: bool = False, seed: int = 0,
+                 num_replicas: int = 1, rank: int = 0):
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rankは0以上num_replicas未満を指定してください: {rank}")
+        if batch_size <= 0:
+            raise ValueError(f"batch_sizeは1以上を指定してください: {batch_size}")
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = max(1, bucket_size)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """シャッフルの乱数をエポックごとに変える"""
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        chunk = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), chunk):
+            bucket = indices[start:start + chunk]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1 and batches:
+            padding = -len(batches) % self.num_replicas
+            batches += [batches[i % len(batches)] for i in range(padding)]
+            batches = batches[self.rank::self.num_replicas]
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return -(-self._num_batches() // self.num_replicas)
+
+    def _num_batches(self) -> int:
+        chunk = self.batch_size * self.bucket_size
+        full, rest = divmod(len(self.lengths), chunk)
+        per_bucket = chunk // self.batch_size
+        if self.drop_last:
+            return full * per_bucket + rest // self.batch_size
+        return full * per_bucket + -(-rest // self.batch_size)
+
+# CachedEmbeddingDatasetのバッチのテンソル数 (音声とTeXのCLS出力)
+CLS_BATCH_FIELDS = 2
+
+
+@dataclass
+class TrainingOptions:
+    """
+    train_modelの学習の設定
+
+    Attributes:
+        device (torch.device): 学習するデバイス
+        scheduler (Optional[torch.optim.lr_scheduler._LRScheduler]): パラメータの更新ごとに進める学習率スケジューラー
+        autocast_dtype (Optional[torch.dtype]): 順伝播を自動混合精度で計算する型
+            (CPUではtorch.bfloat16。Noneの場合はfp32のまま)
+        accumulation_steps (int): 勾配を累積するバッチ数 (実質のバッチサイズはbatch_sizeのこの値倍)
+    """
+    device: torch.device
+    scheduler: Optional[torch.optim.lr_scheduler._LRScheduler] = None
+    autocast_dtype: Optional[torch.dtype] = None
+    accumulation_steps: int = 1
+
+    def __post_init__(self) -> None:
+        if self.accumulation_steps < 1:
+            raise ValueError(f"accumulation_stepsは1以上を指定してください: {self.accumulation_steps}")
+
+
+def train_model(model: MathVideoGenerator, train_loader: torch.utils.data.DataLoader,
+                optimizer: torch.optim.Optimizer, criterion: nn.Module, options: TrainingOptions) -> float:
+    """
+    モデルの学習を行う
+
+    バッチが4つのテンソル (音声とTeXのinput_ids・attention_mask) の場合はBERTから、
+    2つのテンソル (CachedEmbeddingDatasetのCLS出力) の場合はヘッドだけを計算する。
+    """
     model.train()
     total_loss = 0
-    
-    for batch in train_loader:
-        optimizer.zero_grad()
-        
-        # バッチデータの準備
-        voice_input_ids, voice_attention_mask, image_input_ids, image_attention_mask = [b.to(device) for b in batch]
-        
-        # モデルの出力
-        outputs = model(
-            {'input_ids': voice_input_ids, 'attention_mask': voice_attention_mask},
-            {'input_ids': image_input_ids, 'attention_mask': image_attention_mask}
-        )
-        
-        # 損失の計算（この例では音声と画像の特徴量の差分を損失として使用）
-        loss = criterion(outputs, torch.zeros_like(outputs))  # 仮のターゲット
-        
-        # バックプロパゲーション
-        loss.backward()
-        optimizer.step()
-        
-        if scheduler is not None:
-            scheduler.step()
-        
+    optimizer.zero_grad()
+
+    for step, batch in enumerate(train_loader, start=1):
+        # 勾配を累積する途中のバッチでは、DistributedDataParallelのプロセス間の勾配の同期を省く
+        update = step % options.accumulation_steps == 0 or step == len(train_loader)
+        sync_context = model.no_sync() if hasattr(model, 'no_sync') and not update else nullcontext()
+
+        with sync_context:
+            # バッチデータの準備とモデルの出力
+            tensors = [b.to(options.device) for b in batch]
+            autocast = torch.autocast(device_type=options.device.type, dtype=options.autocast_dtype,
+                                      enabled=options.autocast_dtype is not None)
+            with autocast:
+                if len(tensors) == CLS_BATCH_FIELDS:
+                    voice_cls, tex_cls = tensors
+                    outputs = model(voice_cls, tex_cls)
+                else:
+                    voice_input_ids, voice_attention_mask, image_input_ids, image_attention_mask = tensors
+                    outputs = model(
+                        {'input_ids': voice_input_ids, 'attention_mask': voice_attention_mask},
+                        {'input_ids': image_input_ids, 'attention_mask': image_attention_mask}
+                    )
+
+            # 損失の計算 (この例では音声と画像の特徴量の差分を損失として使用)
+            outputs = outputs.float()
+            loss = criterion(outputs, torch.zeros_like(outputs))  # 仮のターゲット
+
+            # バックプロパゲーション (accumulation_stepsバッチ分の勾配を累積してから更新する)
+            (loss / options.accumulation_steps).backward()
+
+        if update:
+            optimizer.step()
+            optimizer.zero_grad()
+
+            if options.scheduler is not None:
+                options.scheduler.step()
+
         total_loss += loss.item()
-    
-    return total_loss / len(train_loader) 
\ No newline at end of file
+
+    return total_loss / len(train_loader)
@@ -0,0 +1,69 @@
+"""
+音声データと画像データの対応付け
+
+torchやtransformersに依存しない前処理だけを置き、DataProcessorから使う。
+"""
+
+import numpy as np
+import pandas as pd
+
+PAIR_KEYS = ["chapter", "section"]
+
+
+def pair_voice_and_image(
+    voice_data: pd.DataFrame, image_data: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    音声データごとに、同じチャプター・セクションで最も近いフレームの画像データを対応付ける
+
+    (chapter, section) ごとにフレームでソートした最近傍の結合 (merge_asof) を前後の
+    両方向で求め、近い方を選ぶ。距離が同じ画像が複数ある場合は、以前の実装
+    (音声ごとにidxminで探すループ) と同じくimage_dataで先に現れる画像を選ぶ。
+    対応する画像がない音声データは含めない。
+
+    Returns:
+        pd.DataFrame: voice_text列とimage_tex列を持つ、voice_dataの順に並んだペア
+    """
+    voices = pd.DataFrame(
+        {
+            "chapter": voice_data["chapter"].to_numpy(),
+            "section": voice_data["section"].to_numpy(),
+            "frame": voice_data["frame"].to_numpy(),
+            "voice_text": voice_data["text"].to_numpy(),
+            "_order": np.arange(len(voice_data)),
+        }
+    )
+    images = pd.DataFrame(
+        {
+            "chapter": image_data["chapter"].to_numpy(),
+            "section": image_data["section"].to_numpy(),
+            "frame": image_data["frame"].to_numpy(),
+            "image_frame": image_data["frame"].to_numpy(),
+            "image_tex": image_data["tex_content"].to_numpy(),
+            "_position": np.arange(len(image_data)),
+        }
+    )
+    # 同じフレームの画像は先に現れるものだけを残す
+    images = images.drop_duplicates([*PAIR_KEYS, "frame"], keep="first")
+
+    # merge_asofは結合キー全体がソートされている必要がある
+    voices = voices.sort_values("frame", kind="stable").reset_index(drop=True)
+    images = images.sort_values("frame", kind="stable")
+    backward, forward = (
+        pd.merge_asof(voices, images, on="frame", by=PAIR_KEYS, direction=direction)
+        for direction in ("backward", "forward")
+    )
+    # 前後で近い方を選ぶ (同じ距離ならimage_dataで先に現れる方、片方しかなければそちら)
+    backward_distance = backward["frame"] - backward["image_frame"]
+    forward_distance = forward["image_frame"] - forward["frame"]
+    use_forward = (
+        backward["_position"].isna()
+        | (forward_distance < backward_distance)
+        | (
+            (forward_distance == backward_distance)
+            & (forward["_position"] < backward["_position"])
+        )
+    )
+    paired = backward.mask(use_forward, forward)
+    paired = paired[paired["_position"].notna()].sort_values("_order")
+    return paired[["voice_text", "image_tex"]].reset_index(drop=True)
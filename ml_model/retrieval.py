@@ -0,0 +1,319 @@
+"""
+ナレーションの1行に合う数式を探す検索インデックス
+
+既知のTeXをMathVideoGeneratorのtex_encoderの経路 (BERTのCLS出力→tex_encoder) で
+ベクトルにし、正規化してNumPyの配列として保存する。検索ではセリフを
+voice_encoderの経路でベクトルにし、インデックス全体との内積 (コサイン類似度) を
+行列積でまとめて計算して上位k件を返す。大きなコーパスでは行ごとの
+スケールを持つint8のインデックスにしてメモリを1/4にできる。
+
+使い方:
+    python retrieval.py build --csv_path data.csv --index_dir formula_index --model_path best.pt
+    python retrieval.py add --index_dir formula_index --tex "$e^{i\\pi}+1=0$" --model_path best.pt
+    python retrieval.py query --index_dir formula_index --text "オイラーの等式なのだ" -k 5 --model_path best.pt
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+from dataset_cache import file_digest
+from inference import SceneScorer
+from model import BERT_MODEL_NAME, MathVideoGenerator
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT_VERSION = 1
+
+# 検索で一度に内積を計算するインデックスの行数 (メモリの使用量を抑える)
+SEARCH_CHUNK_ROWS = 65536
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def quantize_rows(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """行ごとに対称なスケールでint8に量子化する (vectors ≒ codes * scales)"""
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales = np.maximum(scales, 1e-12).astype(np.float32)
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+class FormulaIndex:
+    """
+    TeXのベクトルと元のテキストを持つ検索インデックス
+
+    Attributes:
+        texts (list[str]): 登録したTeX (ベクトルの行と同じ順)
+        vectors (np.ndarray): 正規化したベクトル (quantizedの場合はint8のコード)
+        scales (Optional[np.ndarray]): int8のコードの行ごとのスケール
+        weights_id (str): ベクトルを計算したモデルの識別子
+    """
+
+    def __init__(self, dim: int, weights_id: str, quantized: bool = False):
+        self.dim = dim
+        self.weights_id = weights_id
+        self.quantized = quantized
+        self.texts: list[str] = []
+        self.vectors = np.empty((0, dim), dtype=np.int8 if quantized else np.float32)
+        self.scales: Optional[np.ndarray] = (
+            np.empty(0, dtype=np.float32) if quantized else None
+        )
+        self._positions: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __contains__(self, text: str) -> bool:
+        return text in self._positions
+
+    def add(self, texts: Sequence[str], vectors: np.ndarray) -> int:
+        """
+        TeXとそのベクトルを追加する (登録済みのTeXは追加しない)
+
+        Returns:
+            int: 追加した件数
+        """
+        if vectors.shape != (len(texts), self.dim):
+            raise ValueError(f"ベクトルの形が正しくありません: {vectors.shape}")
+        rows = []
+        seen = set()
+        for i, text in enumerate(texts):
+            if text not in self._positions and text not in seen:
+                seen.add(text)
+                rows.append(i)
+        if not rows:
+            return 0
+        added = normalize_rows(np.asarray(vectors)[rows])
+        if self.quantized:
+            codes, scales = quantize_rows(added)
+            self.vectors = np.concatenate([self.vectors, codes])
+            self.scales = np.concatenate([self.scales, scales])
+        else:
+            self.vectors = np.concatenate([self.vectors, added])
+        for row in rows:
+            self._positions[texts[row]] = len(self.texts)
+            self.texts.append(texts[row])
+        return len(rows)
+
+    def search(self, queries: np.ndarray, k: int = 5) -> list[list[tuple[str, float]]]:
+        """
+        クエリのベクトルごとに、コサイン類似度が高い上位k件のTeXを返す
+
+        全クエリとインデックスの内積を、インデックスSEARCH_CHUNK_ROWS行ずつの行列積で計算する。
+        """
+        queries = normalize_rows(np.atleast_2d(queries))
+        k = min(k, len(self))
+        if k == 0:
+            return [[] for _ in range(len(queries))]
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), SEARCH_CHUNK_ROWS):
+            chunk = self.vectors[start : start + SEARCH_CHUNK_ROWS]
+            scores = queries @ chunk.astype(np.float32).T
+            if self.quantized:
+                scores *= self.scales[start : start + SEARCH_CHUNK_ROWS]
+            # これまでの上位k件とこのチャンクを合わせて、上位k件だけを残す
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate(
+                [
+                    best_rows,
+                    np.broadcast_to(
+                        np.arange(start, start + len(chunk)), (len(queries), len(chunk))
+                    ),
+                ],
+                axis=1,
+            )
+            top = np.argpartition(-scores, min(k, scores.shape[1]) - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_rows = np.take_along_axis(rows, top, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return [
+            [(self.texts[row], float(score)) for row, score in zip(rows, scores)]
+            for rows, scores in zip(best_rows, best_scores)
+        ]
+
+    def save(self, directory: str) -> None:
+        """インデックスを保存する (ファイルごとに一時ファイルから置き換える)"""
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        meta = {
+            "format_version": INDEX_FORMAT_VERSION,
+            "dim": self.dim,
+            "weights_id": self.weights_id,
+            "quantized": self.quantized,
+            "size": len(self),
+        }
+        files = {"vectors.npy": self.vectors}
+        if self.quantized:
+            files["scales.npy"] = self.scales
+        for name, array in files.items():
+            fd, tmp_name = tempfile.mkstemp(prefix=".tmp_", suffix=".npy", dir=path)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_name, path / name)
+        for name, content in (("texts.json", self.texts), ("meta.json", meta)):
+            fd, tmp_name = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=path)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(content, f, ensure_ascii=False)
+            os.replace(tmp_name, path / name)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "FormulaIndex":
+        """保存したインデックスを読み込む (mmapの場合はベクトルをメモリマップで開く)"""
+        path = Path(directory)
+        meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+        if meta.get("format_version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"インデックスの形式が異なります: {directory}")
+        index = cls(meta["dim"], meta["weights_id"], meta["quantized"])
+        mmap_mode = "r" if mmap else None
+        index.vectors = np.load(path / "vectors.npy", mmap_mode=mmap_mode)
+        if index.quantized:
+            index.scales = np.load(path / "scales.npy", mmap_mode=mmap_mode)
+        index.texts = json.loads((path / "texts.json").read_text(encoding="utf-8"))
+        index._positions = {text: i for i, text in enumerate(index.texts)}
+        if len(index.texts) != len(index.vectors):
+            raise ValueError(
+                f"インデックスのテキストとベクトルの数が一致しません: {directory}"
+            )
+        return index
+
+
+class FormulaRetriever:
+    """MathVideoGeneratorでTeXとセリフをベクトルにし、FormulaIndexに登録・検索するクラス"""
+
+    def __init__(
+        self,
+        model: MathVideoGenerator,
+        index: FormulaIndex,
+        weights_id: str,
+        batch_size: int = 64,
+    ):
+        if index.weights_id != weights_id:
+            raise ValueError(
+                f"インデックスは別のモデルで作成されています: {index.weights_id}"
+            )
+        self.model = model.eval()
+        self.index = index
+        self.scorer = SceneScorer(model, batch_size=batch_size)
+
+    @torch.inference_mode()
+    def embed_tex(self, texts: Sequence[str]) -> np.ndarray:
+        """TeXのベクトル (BERTのCLS出力→tex_encoder)"""
+        cls = self.scorer.encode(texts).to(self.scorer.device)
+        return self.model.tex_encoder(cls).float().cpu().numpy()
+
+    @torch.inference_mode()
+    def embed_voice(self, texts: Sequence[str]) -> np.ndarray:
+        """セリフのベクトル (BERTのCLS出力→voice_encoder)"""
+        cls = self.scorer.encode(texts).to(self.scorer.device)
+        return self.model.voice_encoder(cls).float().cpu().numpy()
+
+    def add_formulas(self, texts: Sequence[str]) -> int:
+        """未登録のTeXだけをベクトルにして追加する"""
+        new = [text for text in dict.fromkeys(texts) if text and text not in self.index]
+        if not new:
+            return 0
+        return self.index.add(new, self.embed_tex(new))
+
+    def query(
+        self, voice_lines: Sequence[str], k: int = 5
+    ) -> list[list[tuple[str, float]]]:
+        """セリフごとに、合いそうなTeXを上位k件返す"""
+        return self.index.search(self.embed_voice(voice_lines), k)
+
+
+def load_model(model_path: Optional[str]) -> tuple[MathVideoGenerator, str]:
+    """モデルと、インデックスに記録する重みの識別子を返す"""
+    model = MathVideoGenerator()
+    weights_id = BERT_MODEL_NAME
+    if model_path:
+        model.load_state_dict(torch.load(model_path, map_location="cpu"))
+        weights_id += f":{file_digest(model_path)}"
+    return model, weights_id
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(
+        description="ナレーションに合う数式を探す検索インデックス"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (
+        ("build", "CSVのTeXからインデックスを作成"),
+        ("add", "TeXを追加"),
+        ("query", "数式を検索"),
+    ):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument(
+            "--index_dir", type=str, required=True, help="インデックスのディレクトリ"
+        )
+        sub.add_argument(
+            "--model_path",
+            type=str,
+            help="学習済みモデルのパス (省略時は事前学習済みの重み)",
+        )
+        sub.add_argument(
+            "--batch_size", type=int, default=64, help="推論のバッチサイズ"
+        )
+        if name == "build":
+            sub.add_argument(
+                "--csv_path", type=str, required=True, help="入力CSVファイルのパス"
+            )
+            sub.add_argument(
+                "--quantize", action="store_true", help="int8のインデックスにする"
+            )
+        elif name == "add":
+            sub.add_argument(
+                "--tex", type=str, nargs="+", required=True, help="追加するTeX"
+            )
+        else:
+            sub.add_argument(
+                "--text", type=str, nargs="+", required=True, help="検索するセリフ"
+            )
+            sub.add_argument("-k", type=int, default=5, help="返す件数")
+    args = parser.parse_args()
+
+    model, weights_id = load_model(args.model_path)
+    if args.command == "build":
+        from model import DataProcessor
+
+        _, image_data = DataProcessor(args.csv_path).create_dataset()
+        index = FormulaIndex(
+            model.tex_encoder.out_features, weights_id, quantized=args.quantize
+        )
+        retriever = FormulaRetriever(model, index, weights_id, args.batch_size)
+        added = retriever.add_formulas(image_data["tex_content"].tolist())
+        index.save(args.index_dir)
+        logger.info(f"インデックスを作成しました: {args.index_dir} ({added}件)")
+    elif args.command == "add":
+        index = FormulaIndex.load(args.index_dir, mmap=False)
+        retriever = FormulaRetriever(model, index, weights_id, args.batch_size)
+        added = retriever.add_formulas(args.tex)
+        index.save(args.index_dir)
+        logger.info(f"{added}件を追加しました (合計{len(index)}件)")
+    else:
+        index = FormulaIndex.load(args.index_dir)
+        retriever = FormulaRetriever(model, index, weights_id, args.batch_size)
+        for text, results in zip(args.text, retriever.query(args.text, args.k)):
+            print(text)
+            for rank, (tex, score) in enumerate(results, start=1):
+                print(f"  {rank}. {score:.4f}  {tex}")
+
+
+if __name__ == "__main__":
+    main()
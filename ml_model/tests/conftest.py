@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# ml_model内のモジュールは `from model import ...` の形で互いをインポートする
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
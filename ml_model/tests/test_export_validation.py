@@ -0,0 +1,68 @@
+"""
+export.split_trace_and_validationが、traceに使う入力とバッチサイズ・系列長の
+異なる確認用の入力を作ることを確認する
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import export  # noqa: E402
+
+
+class CharTokenizer:
+    """1文字を1トークンにする、テスト用のトークナイザー"""
+
+    pad_token_id = 0
+
+    def __call__(
+        self, texts: list[str], truncation: bool, max_length: int
+    ) -> dict[str, list[list[int]]]:
+        return {"input_ids": [[ord(c) % 97 + 1 for c in t][:max_length] for t in texts]}
+
+
+@pytest.fixture(autouse=True)
+def tokenizer(monkeypatch: pytest.MonkeyPatch) -> CharTokenizer:
+    tokenizer = CharTokenizer()
+    monkeypatch.setattr(export, "load_tokenizer", lambda name: tokenizer)
+    return tokenizer
+
+
+def shape(inputs: tuple[torch.Tensor, ...]) -> SimpleNamespace:
+    return SimpleNamespace(**export.describe_shape(inputs))
+
+
+@pytest.mark.parametrize(
+    "pairs",
+    [
+        # traceと確認用で同じ文章を繰り返す (既定のサンプルと同じ状況)
+        [("abcd", "xyz")] * 8,
+        # 音声だけ長さが一致する
+        [("abcd", "xy")] * 2 + [("abcd", "xyz")] * 6,
+        # 1つ足すと今度は音声の長さが一致する
+        [("abcde", "xyz")] * 2 + [("abcd", "xyz")] * 6,
+    ],
+)
+def test_validation_shape_differs_from_trace(pairs: list[tuple[str, str]]) -> None:
+    trace_inputs, validation_inputs = export.split_trace_and_validation(pairs)
+    trace, validation = shape(trace_inputs), shape(validation_inputs)
+    assert trace.batch_size + validation.batch_size == len(pairs)
+    assert validation.batch_size != trace.batch_size
+    assert validation.voice_length != trace.voice_length
+    assert validation.tex_length != trace.tex_length
+
+
+def test_extra_padding_is_masked() -> None:
+    _, validation_inputs = export.split_trace_and_validation([("abcd", "xyz")] * 8)
+    voice_ids, voice_mask, tex_ids, tex_mask = validation_inputs
+    assert voice_mask[:, 4:].sum() == 0
+    assert tex_mask[:, 3:].sum() == 0
+    assert (voice_ids[:, 4:] == 0).all()
+    assert (tex_ids[:, 3:] == 0).all()
+
+
+def test_too_few_pairs() -> None:
+    with pytest.raises(ValueError):
+        export.split_trace_and_validation([("a", "b")] * 2)
@@ -0,0 +1,124 @@
+"""
+pairing.pair_voice_and_imageが以前の実装 (音声ごとのループ) と同じペアを返すことを確認する
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from pairing import pair_voice_and_image
+
+
+def pair_with_loop(voice_data: pd.DataFrame, image_data: pd.DataFrame) -> pd.DataFrame:
+    """以前の実装: 音声ごとに同じチャプター・セクションの画像から最も近いフレームのものを選ぶ"""
+    paired_data = []
+    for _, voice_row in voice_data.iterrows():
+        matching_images = image_data[
+            (image_data["chapter"] == voice_row["chapter"])
+            & (image_data["section"] == voice_row["section"])
+        ]
+        if not matching_images.empty:
+            frame_diffs = (matching_images["frame"] - voice_row["frame"]).abs()
+            closest_image = matching_images.loc[frame_diffs.idxmin()]
+            paired_data.append(
+                {
+                    "voice_text": voice_row["text"],
+                    "image_tex": closest_image["tex_content"],
+                }
+            )
+    return pd.DataFrame(paired_data, columns=["voice_text", "image_tex"])
+
+
+def make_rows(
+    rng: np.random.Generator, count: int, chapters: int, column: str, prefix: str
+) -> pd.DataFrame:
+    """フレームの範囲を狭くして、同じ距離や同じフレームが起きやすいデータを作る"""
+    return pd.DataFrame(
+        {
+            "chapter": rng.integers(1, chapters + 1, count),
+            "section": rng.integers(1, 3, count),
+            "frame": rng.integers(0, 20, count),
+            column: [f"{prefix}{number}" for number in range(count)],
+        }
+    )
+
+
+def assert_same_pairs(voice_data: pd.DataFrame, image_data: pd.DataFrame) -> None:
+    actual = pair_voice_and_image(voice_data, image_data)
+    expected = pair_with_loop(voice_data, image_data)
+    assert actual.values.tolist() == expected.values.tolist()
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_loop_on_random_data(seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    # 音声側だけにあるチャプター (対応する画像がない音声) も含める
+    voice_data = make_rows(rng, int(rng.integers(0, 15)), 3, "text", "voice")
+    image_data = make_rows(rng, int(rng.integers(0, 15)), 2, "tex_content", "tex")
+    if seed % 2:
+        # create_datasetと同じく、チャプター・セクション・フレームの順に並べた場合
+        image_data = image_data.sort_values(["chapter", "section", "frame"])
+    assert_same_pairs(voice_data, image_data)
+
+
+def test_equal_distance_prefers_image_that_appears_first() -> None:
+    voice_data = pd.DataFrame(
+        {"chapter": [1, 1], "section": [1, 1], "frame": [10, 30], "text": ["a", "b"]}
+    )
+    image_data = pd.DataFrame(
+        {
+            "chapter": [1, 1, 1],
+            "section": [1, 1, 1],
+            "frame": [15, 5, 25],
+            "tex_content": ["later", "earlier", "last"],
+        }
+    )
+    assert_same_pairs(voice_data, image_data)
+    pairs = pair_voice_and_image(voice_data, image_data)
+    assert pairs["image_tex"].tolist() == ["later", "last"]
+
+
+def test_duplicate_frames_use_first_image() -> None:
+    voice_data = pd.DataFrame(
+        {"chapter": [1], "section": [1], "frame": [7], "text": ["a"]}
+    )
+    image_data = pd.DataFrame(
+        {
+            "chapter": [1, 1],
+            "section": [1, 1],
+            "frame": [5, 5],
+            "tex_content": ["first", "second"],
+        }
+    )
+    assert_same_pairs(voice_data, image_data)
+
+
+def test_voice_without_matching_chapter_or_section_is_dropped() -> None:
+    voice_data = pd.DataFrame(
+        {
+            "chapter": [1, 2, 1],
+            "section": [1, 1, 2],
+            "frame": [0, 0, 0],
+            "text": ["kept", "no chapter", "no section"],
+        }
+    )
+    image_data = pd.DataFrame(
+        {"chapter": [1], "section": [1], "frame": [3], "tex_content": ["x"]}
+    )
+    assert_same_pairs(voice_data, image_data)
+    pairs = pair_voice_and_image(voice_data, image_data)
+    assert pairs["voice_text"].tolist() == ["kept"]
+
+
+def test_no_images() -> None:
+    voice_data = pd.DataFrame(
+        {"chapter": [1], "section": [1], "frame": [0], "text": ["a"]}
+    )
+    image_data = pd.DataFrame(
+        {
+            "chapter": pd.Series([], dtype=int),
+            "section": pd.Series([], dtype=int),
+            "frame": pd.Series([], dtype=int),
+            "tex_content": pd.Series([], dtype=object),
+        }
+    )
+    assert_same_pairs(voice_data, image_data)
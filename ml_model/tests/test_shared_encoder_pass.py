@@ -0,0 +1,88 @@
+"""
+MathVideoGenerator.encode_pairの1回のBERT実行 (shared_encoder_pass) が、
+音声とTeXを別々に実行した場合と数値的に一致することを確認する
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+import model  # noqa: E402
+
+
+@pytest.fixture
+def generator(monkeypatch: pytest.MonkeyPatch) -> model.MathVideoGenerator:
+    """事前学習済みの重みをダウンロードせずに済むよう、小さなBERTで作成する"""
+    config = transformers.BertConfig(
+        vocab_size=100,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=64,
+        pad_token_id=0,
+    )
+    torch.manual_seed(0)
+    bert = transformers.BertModel(config)
+    monkeypatch.setattr(
+        model, "BertModel", SimpleNamespace(from_pretrained=lambda name: bert)
+    )
+    monkeypatch.setattr(model, "load_tokenizer", lambda name: None)
+    return model.MathVideoGenerator("tiny-bert").eval()
+
+
+def make_input(
+    rng: torch.Generator, lengths: list[int], width: int
+) -> dict[str, torch.Tensor]:
+    """例ごとに長さの異なる、右側をパディングした入力を作る"""
+    attention_mask = (
+        torch.arange(width)[None, :] < torch.tensor(lengths)[:, None]
+    ).long()
+    input_ids = torch.randint(1, 100, (len(lengths), width), generator=rng)
+    return {
+        "input_ids": input_ids * attention_mask,
+        "attention_mask": attention_mask,
+        "token_type_ids": torch.zeros_like(input_ids),
+    }
+
+
+@pytest.mark.parametrize(
+    ("voice_lengths", "tex_lengths"),
+    [
+        ([7, 3, 5], [12, 9, 2]),
+        ([16, 4, 11], [6, 6, 3]),
+        ([8, 8, 8], [8, 1, 8]),
+    ],
+)
+def test_shared_pass_matches_two_passes(
+    generator: model.MathVideoGenerator,
+    voice_lengths: list[int],
+    tex_lengths: list[int],
+) -> None:
+    rng = torch.Generator().manual_seed(sum(voice_lengths) + sum(tex_lengths))
+    voice_input = make_input(rng, voice_lengths, max(voice_lengths))
+    tex_input = make_input(rng, tex_lengths, max(tex_lengths))
+
+    with torch.no_grad():
+        generator.shared_encoder_pass = False
+        expected = generator.encode_pair(voice_input, tex_input)
+        generator.shared_encoder_pass = True
+        actual = generator.encode_pair(voice_input, tex_input)
+
+    for shared, separate in zip(actual, expected):
+        assert shared.shape == separate.shape
+        torch.testing.assert_close(shared, separate, rtol=1e-4, atol=1e-5)
+
+
+def test_shared_pass_rejects_mismatched_inputs(
+    generator: model.MathVideoGenerator,
+) -> None:
+    rng = torch.Generator().manual_seed(0)
+    voice_input = make_input(rng, [3, 2], 3)
+    tex_input = make_input(rng, [4, 4], 4)
+    del tex_input["token_type_ids"]
+    generator.shared_encoder_pass = True
+    with pytest.raises(ValueError):
+        generator.encode_pair(voice_input, tex_input)
@@ -1,11 +1,32 @@
 import json
-from typing import List, Dict, Any, Optional
-import os
-from pathlib import Path
 import logging
+import os
+from collections.abc import Iterable
+from dataclasses import dataclass
+from typing import Any, Optional
 
 logger = logging.getLogger(__name__)
 
+
+@dataclass
+class ImageContent:
+    """
+    add_image_contentで追加する画像
+
+    Attributes:
+        file_path (str): 画像ファイルのパス
+        tex_content (str): 画像のTeX
+        duration (float): 表示する長さ
+        frame (int): 開始フレーム
+        score (Optional[float]): 同じセクションの音声とのモデルのスコア
+    """
+    file_path: str
+    tex_content: str
+    duration: float
+    frame: int = 0
+    score: Optional[float] = None
+
+
 class YMMPGenerator:
     def __init__(self):
         self.scene_data = []
@@ -16,8 +37,8 @@ class YMMPGenerator:
             "generator": "MathVideoGenerator",
             "generator_version": "1.0.0"
         }
-        
-    def create_scene(self, duration: float, content: Dict[str, Any]) -> None:
+
+    def create_scene(self, duration: float, content: dict[str, Any]) -> None:
         """新しいシーンを作成する"""
         try:
             scene = {
@@ -29,9 +50,9 @@ class YMMPGenerator:
             self.scene_data.append(scene)
             self.current_scene += 1
         except Exception as e:
-            logger.error(f"シーンの作成に失敗しました: {str(e)}")
+            logger.error(f"シーンの作成に失敗しました: {e!s}")
             raise
-    
+
     def add_voice_content(self, text: str, speaker: str, duration: float, frame: int) -> None:
         """音声コンテンツを追加する"""
         try:
@@ -43,7 +64,7 @@ class YMMPGenerator:
                 "font_size": 24,
                 "layer": self.current_layer
             }
-            
+
             # フェードイン/アウトアニメーション
             animations = [
                 {
@@ -61,30 +82,32 @@ class YMMPGenerator:
                     "to": 0
                 }
             ]
-            
+
             self.create_scene(duration, content)
             self.scene_data[-1]["animations"] = animations
             self.current_layer += 1
-            
+
         except Exception as e:
-            logger.error(f"音声コンテンツの追加に失敗しました: {str(e)}")
+            logger.error(f"音声コンテンツの追加に失敗しました: {e!s}")
             raise
-    
-    def add_image_content(self, file_path: str, tex_content: str, duration: float, frame: int) -> None:
+
+    def add_image_content(self, image: ImageContent) -> None:
         """画像コンテンツを追加する"""
         try:
-            if not os.path.exists(file_path):
-                raise FileNotFoundError(f"ファイルが見つかりません: {file_path}")
-            
+            if not os.path.exists(image.file_path):
+                raise FileNotFoundError(f"ファイルが見つかりません: {image.file_path}")
+
             content = {
                 "type": "image",
-                "file_path": file_path,
-                "tex_content": tex_content,
+                "file_path": image.file_path,
+                "tex_content": image.tex_content,
                 "position": {"x": 0, "y": 0},
                 "scale": 1.0,
                 "layer": self.current_layer
             }
-            
+            if image.score is not None:
+                content["score"] = image.score
+
             # スケールアニメーション
             animations = [
                 {
@@ -95,15 +118,15 @@ class YMMPGenerator:
                     "to": 1.0
                 }
             ]
-            
-            self.create_scene(duration, content)
+
+            self.create_scene(image.duration, content)
             self.scene_data[-1]["animations"] = animations
             self.current_layer += 1
-            
+
         except Exception as e:
-            logger.error(f"画像コンテンツの追加に失敗しました: {str(e)}")
+            logger.error(f"画像コンテンツの追加に失敗しました: {e!s}")
             raise
-    
+
     def create_chapter_section(self, chapter: Optional[int] = None, section: Optional[int] = None) -> None:
         """チャプターとセクションの情報を追加する"""
         if chapter is not None or section is not None:
@@ -112,10 +135,10 @@ class YMMPGenerator:
                 metadata["chapter"] = chapter
             if section is not None:
                 metadata["section"] = section
-            
+
             if self.scene_data:
                 self.scene_data[-1]["metadata"] = metadata
-    
+
     def generate_ymmp(self, output_path: str) -> None:
         """YMMPファイルを生成する"""
         try:
@@ -123,23 +146,23 @@ class YMMPGenerator:
             output_dir = os.path.dirname(output_path)
             if output_dir and not os.path.exists(output_dir):
                 os.makedirs(output_dir)
-            
+
             ymmp_data = {
                 "metadata": self.metadata,
                 "scenes": self.scene_data
             }
-            
+
             with open(output_path, 'w', encoding='utf-8') as f:
                 json.dump(ymmp_data, f, ensure_ascii=False, indent=2)
-            
+
             logger.info(f"YMMPファイルを生成しました: {output_path}")
-            
+
         except Exception as e:
-            logger.error(f"YMMPファイルの生成に失敗しました: {str(e)}")
+            logger.error(f"YMMPファイルの生成に失敗しました: {e!s}")
             raise
-    
-    def process_model_output(self, model_output: List[Dict[str, Any]]) -> None:
-        """モデルの出力を処理してYMMPファイルを生成する"""
+
+    def process_model_output(self, model_output: Iterable[dict[str, Any]]) -> None:
+        """モデルの出力を処理してYMMPファイルを生成する (ジェネレーターから1件ずつ受け取ってもよい)"""
         try:
             for item in model_output:
                 if item["type"] == "voice":
@@ -150,20 +173,21 @@ class YMMPGenerator:
                         frame=item.get("frame", 0)
                     )
                 elif item["type"] == "image":
-                    self.add_image_content(
+                    self.add_image_content(ImageContent(
                         file_path=item["file_path"],
                         tex_content=item.get("tex_content", ""),
                         duration=item["duration"],
-                        frame=item.get("frame", 0)
-                    )
-                
+                        frame=item.get("frame", 0),
+                        score=item.get("score")
+                    ))
+
                 # チャプターとセクションの情報を追加
                 if "chapter" in item or "section" in item:
                     self.create_chapter_section(
                         chapter=item.get("chapter"),
                         section=item.get("section")
                     )
-                    
+
         except Exception as e:
-            logger.error(f"モデル出力の処理に失敗しました: {str(e)}")
-            raise 
\ No newline at end of file
+            logger.error(f"モデル出力の処理に失敗しました: {e!s}")
+            raise
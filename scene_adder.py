@@ -1,87 +1,174 @@
-from typing import Any
+import difflib
+import itertools
+import logging
+from collections import deque
+from collections.abc import Iterable, Iterator
+from typing import Any, Optional
 
-from formula.add_latex import create_latex_item
-from utils.ymmp_utils import load_ymmp_project, save_ymmp_project
-from voice.add_voice import create_voice_item
+from scene_journal import SceneJournal, SceneManifest, get_content_key
+from scene_pipeline import ScenePipeline, get_asset_key, place_item
+from utils import YmmpItemWriter, get_file_version, load_ymmp_project
 
+logger = logging.getLogger(__name__)
 
-def _add_voice_item(
-    project_data: dict[str, Any], instruction: dict[str, Any]
-) -> dict[str, Any]:
-    """音声アイテムを追加するロジック (ファイルI/Oはしない)
+# (指示の番号, 指示)
+NumberedInstruction = tuple[int, dict[str, Any]]
 
-    Args:
-        project_data (dict): プロジェクトデータ
-        instruction (dict): 音声アイテムの設定
-            - text (str): 読み上げるセリフ
-            - speaker_name (str, optional): 話者名. デフォルトは"ずんだもん".
-            - frame (int, optional): 開始フレーム. デフォルトは0.
-            - length (int, optional): 表示フレーム数. デフォルトは60.
-            - speed (float, optional): 話速. デフォルトは1.0.
 
-    Returns:
-        dict: 更新されたプロジェクトデータ
+def _replay_journal(
+    journal: SceneJournal,
+    instructions: Iterator[NumberedInstruction],
+    writer: YmmpItemWriter,
+) -> Iterator[NumberedInstruction]:
     """
-    new_item = create_voice_item(
-        text=instruction["text"],
-        speaker_name=instruction.get("speaker_name", "ずんだもん"),
-        frame=instruction.get("frame", 0),
-        length=instruction.get("length", 60),
-        speed=instruction.get("speed", 1.0),
-    )
-    project_data["Timelines"][0]["Items"].append(new_item)
-    return project_data
+    ジャーナルに記録済みの指示はアイテムをそのまま書き出し、残りの指示を返す
 
+    記録と一致しない指示が現れた時点で、それ以降の記録は破棄する。
+    """
+    entries = journal.replay()
+    replayed = 0
+    for number, instruction in instructions:
+        entry = next(entries, None)
+        if entry is None or not entry.matches(instruction):
+            remaining = itertools.chain([(number, instruction)], instructions)
+            break
+        writer.write(entry.item, instruction.get("timeline", 0))
+        journal.accept()
+        replayed += 1
+    else:
+        remaining = iter(())
+    journal.truncate()
+    if replayed:
+        logger.info(f"前回の続きから再開します ({replayed}件の指示は生成済み)。")
+    return remaining
 
-def _add_latex_item(
-    project_data: dict[str, Any], instruction: dict[str, Any]
-) -> dict[str, Any]:
-    """数式アイテムを追加するロジック (ファイルI/Oはしない)
 
-    Args:
-        project_data (dict): プロジェクトデータ
-        instruction (dict): 数式アイテムの設定
-            - formula (str): LaTeX形式の数式
-            - frame (int, optional): 開始フレーム. デフォルトは0.
-            - length (int, optional): 表示フレーム数. デフォルトは300.
-            - layer (int, optional): レイヤー番号. デフォルトは1.
+def _plan_rebuild(
+    manifest: SceneManifest, instructions: list[dict[str, Any]]
+) -> dict[int, int]:
+    """
+    前回の指示と内容が変わっていない指示を探す
 
     Returns:
-        dict: 更新されたプロジェクトデータ
+        dict[int, int]: 指示の番号から、再利用するマニフェストの記録の番号への対応
     """
-    new_item = create_latex_item(
-        latex_formula=instruction["formula"],
-        frame=instruction.get("frame", 0),
-        length=instruction.get("length", 300),
-        layer=instruction.get("layer", 1),
-    )
-    project_data["Timelines"][0]["Items"].append(new_item)
-    return project_data
+    contents = [get_content_key(instruction) for instruction in instructions]
+    matcher = difflib.SequenceMatcher(None, manifest.contents, contents, autojunk=False)
+    reused: dict[int, int] = {}
+    for tag, old_start, old_end, new_start, _ in matcher.get_opcodes():
+        if tag != "equal":
+            continue
+        for offset in range(old_end - old_start):
+            if manifest.is_reusable(old_start + offset):
+                reused[new_start + offset] = old_start + offset
+    return reused
 
 
-def add_scenes_from_instructions(
-    base_project_path: str, instructions: list[dict[str, Any]], output_project_path: str
+def _generate_items(
+    pipeline: ScenePipeline,
+    instructions: Iterator[NumberedInstruction],
+    manifest: SceneManifest,
+    reused: dict[int, int],
+) -> Iterator[tuple[dict[str, Any], dict[str, Any]]]:
+    """
+    再利用できる指示はマニフェストのアイテムを置き直し、それ以外は描画して
+    (指示, アイテム) を指示の順番どおりに返す
+    """
+    order: deque[NumberedInstruction] = deque()
+
+    def feed() -> Iterator[dict[str, Any]]:
+        for number, instruction in instructions:
+            order.append((number, instruction))
+            if number not in reused:
+                yield instruction
+
+    def reuse(number: int, instruction: dict[str, Any]) -> dict[str, Any]:
+        return place_item(instruction, manifest.item(reused[number]))
+
+    for instruction, item in pipeline.run(feed()):
+        number, head = order.popleft()
+        while number in reused:
+            yield head, reuse(number, head)
+            number, head = order.popleft()
+        yield instruction, item
+    while order:
+        number, head = order.popleft()
+        yield head, reuse(number, head)
+
+
+def add_scenes_from_instructions(  # noqa: PLR0913
+    base_project_path: str,
+    instructions: Iterable[dict[str, Any]],
+    output_project_path: str,
+    jobs: Optional[int] = None,
+    show_progress: bool = False,
+    resume: bool = True,
+    rebuild: bool = False,
 ) -> None:
     """指示リストを元に、YMM4プロジェクトに複数のシーンを追加する
 
+    音声合成や数式の画像化はScenePipelineで並行に行い、
+    タイムラインへの追加は指示の順番どおりに行う。
+    出来上がったアイテムはYmmpItemWriterで順次ファイルに書き出すため、
+    instructionsにジェネレーターを渡せば指示の数によらずメモリ使用量は一定になる。
+
+    完了した指示は出力先の隣のジャーナル (<出力先>.journal.jsonl) に記録し、
+    途中で失敗しても同じ入力で再実行すれば続きから再開する。
+    実行中に他の処理が同じ出力先へ保存していた場合は、その結果を読み込み直して
+    追加したアイテムを足し直す (Guidが同じアイテムは追加しない)。
+    保存が完了したジャーナルはマニフェスト (<出力先>.manifest.jsonl) として残し、
+    rebuildを指定すると、前回から内容が変わっていない指示はマニフェストの
+    アイテム (Guidと素材を含む) を現在の配置に置き直して再利用し、
+    変更・追加された指示だけを描画する。
+
     Args:
         base_project_path (str): ベースとなる.ymmpファイルのパス
-        instructions (List[dict]): 追加するシーンの指示リスト
+        instructions (Iterable[dict]): 追加するシーンの指示 (リストでもジェネレーターでもよい)
             各指示は以下の形式:
             - type (str): "voice" または "latex"
-            - その他のパラメータは _add_voice_item または _add_latex_item のドキュメントを参照
+            - その他のパラメータは scene_pipeline.build_item のドキュメントを参照
         output_project_path (str): 出力先の.ymmpファイルのパス
+        jobs (int, optional): 並行して描画する最大数. デフォルトはCPU数.
+        show_progress (bool): 進捗を表示するかどうか
+        resume (bool): ジャーナルがあれば続きから再開するかどうか
+        rebuild (bool): 前回の出力のマニフェストと比較して差分だけを描画するかどうか
+            (比較のため指示はすべてメモリに読み込む)
     """
+    # 他の処理が同じ出力先へ同時に書き込んでいないか、保存時に確認するため記録しておく
+    loaded_version = get_file_version(output_project_path)
     project_data = load_ymmp_project(base_project_path)
     if not project_data:
         return
 
-    for instruction in instructions:
-        if instruction["type"] == "voice":
-            project_data = _add_voice_item(project_data, instruction)
-        elif instruction["type"] == "latex":
-            project_data = _add_latex_item(project_data, instruction)
-        # elif instruction["type"] == "telop": ... 将来の拡張
+    manifest = SceneManifest(output_project_path, base_project_path)
+    journal = SceneJournal(output_project_path, base_project_path, reset=not resume)
+    with manifest, journal:
+        reused: dict[int, int] = {}
+        if rebuild:
+            instructions = list(instructions)
+            reused = _plan_rebuild(manifest, instructions)
+            logger.info(f"{len(reused)}件の指示は前回のアイテムを再利用します。")
+        # アイテムを作らない指示は読み飛ばす
+        numbered = (
+            (number, instruction)
+            for number, instruction in enumerate(instructions)
+            if get_asset_key(instruction) is not None
+        )
+        with YmmpItemWriter(
+            project_data,
+            output_project_path,
+            loaded_version=loaded_version,
+            merge=True,
+        ) as writer:
+            remaining = _replay_journal(journal, numbered, writer)
+            with ScenePipeline(jobs=jobs, show_progress=show_progress) as pipeline:
+                for instruction, item in _generate_items(
+                    pipeline, remaining, manifest, reused
+                ):
+                    writer.write(item, instruction.get("timeline", 0))
+                    journal.record(instruction, item)
+    journal.complete()
 
-    save_ymmp_project(project_data, output_project_path)
-    print(f"指示リストに基づいてシーンを追加し、{output_project_path}に保存しました。")
+    logger.info(
+        f"指示リストに基づいてシーンを追加し、{output_project_path}に保存しました。"
+    )
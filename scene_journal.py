@@ -0,0 +1,288 @@
+import hashlib
+import json
+import os
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path
+from types import TracebackType
+from typing import IO, Any, Optional
+
+from scene_pipeline import PLACEMENT_FIELDS
+from utils.ymmp_cache import get_snapshot_key
+
+_JOURNAL_VERSION = 2
+JOURNAL_SUFFIX = ".journal.jsonl"
+MANIFEST_SUFFIX = ".manifest.jsonl"
+
+
+def get_journal_path(output_file: str) -> str:
+    """出力先の.ymmpファイルに対応するジャーナルのパスを返す"""
+    return f"{output_file}{JOURNAL_SUFFIX}"
+
+
+def get_manifest_path(output_file: str) -> str:
+    """出力先の.ymmpファイルに対応するマニフェスト (完了したジャーナル) のパスを返す"""
+    return f"{output_file}{MANIFEST_SUFFIX}"
+
+
+def _get_header(base_project_path: str) -> dict[str, Any]:
+    return {
+        "version": _JOURNAL_VERSION,
+        "base": get_snapshot_key(base_project_path).digest,
+    }
+
+
+def get_instruction_key(instruction: dict[str, Any]) -> str:
+    """指示の内容を識別するキーを返す (フィールドの順番には依存しない)"""
+    text = json.dumps(instruction, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_content_key(instruction: dict[str, Any]) -> str:
+    """配置 (フレーム位置・長さ・レイヤー・タイムライン) を除いた指示の内容のキーを返す"""
+    return get_instruction_key(
+        {k: v for k, v in instruction.items() if k not in PLACEMENT_FIELDS}
+    )
+
+
+@dataclass
+class JournalEntry:
+    """
+    完了した指示1件分の記録
+
+    Attributes:
+        key (str): 指示のキー (get_instruction_key)
+        item (dict): 指示から作られたアイテム
+        asset (str, optional): アイテムが参照する素材のパス
+    """
+
+    key: str
+    item: dict[str, Any]
+    asset: Optional[str] = None
+
+    def matches(self, instruction: dict[str, Any]) -> bool:
+        """同じ指示の記録で、参照する素材も残っているかどうか"""
+        if self.key != get_instruction_key(instruction):
+            return False
+        return self.asset is None or Path(self.asset).exists()
+
+
+class SceneJournal:
+    """
+    一括生成の進捗を記録するジャーナル
+
+    完了した指示ごとに、指示のキー・内容のキー・アイテム・素材のパスを1行ずつ追記する。
+    1行目にはベースプロジェクトのダイジェストを持つヘッダーを置き、
+    ベースプロジェクトが変わっていればジャーナルは破棄する。
+    書き込みはflush_every件ごと、またはflush_interval秒ごとにディスクへ同期する。
+    プロジェクトの保存が完了したら、ジャーナルは次回の再構築用のマニフェストになる。
+
+    使い方:
+        with SceneJournal(output_file, base_project_path) as journal:
+            for entry in journal.replay():
+                ...  # 使えた記録はjournal.accept()、使えなければbreak
+            journal.truncate()
+            journal.record(instruction, item)
+        journal.complete()
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        output_file: str,
+        base_project_path: str,
+        reset: bool = False,
+        flush_every: int = 50,
+        flush_interval: float = 5.0,
+    ):
+        """
+        Args:
+            output_file (str): 出力先の.ymmpファイルのパス
+            base_project_path (str): ベースとなる.ymmpファイルのパス
+            reset (bool): 既存のジャーナルを破棄して最初から記録するかどうか
+            flush_every (int): ディスクへ同期する間隔 (件数)
+            flush_interval (float): ディスクへ同期する間隔 (秒)
+        """
+        self.path = get_journal_path(output_file)
+        self.manifest_path = get_manifest_path(output_file)
+        self.reset = reset
+        self.flush_every = max(flush_every, 1)
+        self.flush_interval = flush_interval
+        self._header = _get_header(base_project_path)
+        self._file: Optional[IO[bytes]] = None
+        self._replay_offset = 0
+        self._entry_end = 0
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def __enter__(self) -> "SceneJournal":
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        mode = "r+b" if os.path.exists(self.path) and not self.reset else "w+b"
+        self._file = open(self.path, mode)
+        try:
+            header = json.loads(self._file.readline())
+        except ValueError:
+            header = None
+        if header != self._header:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(self._encode(self._header))
+            self._sync()
+        self._replay_offset = self._file.tell()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _encode(data: dict[str, Any]) -> bytes:
+        return (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _require_file(self) -> IO[bytes]:
+        if self._file is None:
+            raise RuntimeError("SceneJournalはwith文の中で使用してください。")
+        return self._file
+
+    def _sync(self) -> None:
+        f = self._require_file()
+        f.flush()
+        os.fsync(f.fileno())
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def replay(self) -> Iterator[JournalEntry]:
+        """
+        記録済みの指示を先頭から順に返す
+
+        受け取った記録を使った場合はacceptを呼ぶこと。
+        途中で書き込みが途切れた行があれば、そこで終了する。
+        """
+        f = self._require_file()
+        f.seek(self._replay_offset)
+        while True:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                return
+            try:
+                data = json.loads(line)
+                entry = JournalEntry(data["key"], data["item"], data.get("asset"))
+            except (ValueError, KeyError, TypeError):
+                return
+            self._entry_end = f.tell()
+            yield entry
+
+    def accept(self) -> None:
+        """replayで最後に受け取った記録を使ったことを記録する"""
+        self._replay_offset = self._entry_end
+
+    def truncate(self) -> None:
+        """acceptした記録より後ろを破棄し、以降の記録を追記できるようにする"""
+        f = self._require_file()
+        f.seek(self._replay_offset)
+        f.truncate()
+        self._sync()
+
+    def record(self, instruction: dict[str, Any], item: dict[str, Any]) -> None:
+        """完了した指示とアイテムを記録する"""
+        f = self._require_file()
+        entry = {
+            "key": get_instruction_key(instruction),
+            "content": get_content_key(instruction),
+            "item": item,
+            "asset": item.get("FilePath"),
+        }
+        f.write(self._encode(entry))
+        self._unflushed += 1
+        if (
+            self._unflushed >= self.flush_every
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self._sync()
+
+    def complete(self) -> None:
+        """プロジェクトの保存が完了したので、ジャーナルをマニフェストとして残す"""
+        if os.path.exists(self.path):
+            os.replace(self.path, self.manifest_path)
+
+
+class SceneManifest:
+    """
+    前回の出力を作ったときの記録 (完了したジャーナル) を読み込むクラス
+
+    各記録の内容のキー・素材のパス・ファイル内の位置だけを保持し、
+    アイテム本体は必要になったときにファイルから読み直す。
+    マニフェストが無い場合やベースプロジェクトが変わっている場合は記録は空になる。
+
+    使い方:
+        with SceneManifest(output_file, base_project_path) as manifest:
+            item = manifest.item(manifest.contents.index(key))
+    """
+
+    def __init__(self, output_file: str, base_project_path: str):
+        """
+        Args:
+            output_file (str): 出力先の.ymmpファイルのパス
+            base_project_path (str): ベースとなる.ymmpファイルのパス
+        """
+        self.path = get_manifest_path(output_file)
+        self._header = _get_header(base_project_path)
+        self.contents: list[str] = []
+        self._assets: list[Optional[str]] = []
+        self._offsets: list[int] = []
+        self._file: Optional[IO[bytes]] = None
+
+    def __enter__(self) -> "SceneManifest":
+        if not os.path.exists(self.path):
+            return self
+        self._file = open(self.path, "rb")
+        try:
+            header = json.loads(self._file.readline())
+        except ValueError:
+            header = None
+        if header != self._header:
+            return self
+        while True:
+            offset = self._file.tell()
+            line = self._file.readline()
+            if not line.endswith(b"\n"):
+                break
+            try:
+                data = json.loads(line)
+                content = data["content"]
+            except (ValueError, KeyError, TypeError):
+                break
+            self.contents.append(content)
+            self._assets.append(data.get("asset"))
+            self._offsets.append(offset)
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def is_reusable(self, index: int) -> bool:
+        """記録したアイテムが参照する素材が残っているかどうか"""
+        asset = self._assets[index]
+        return asset is None or Path(asset).exists()
+
+    def item(self, index: int) -> dict[str, Any]:
+        """記録したアイテムを読み込む"""
+        if self._file is None:
+            raise RuntimeError("SceneManifestはwith文の中で使用してください。")
+        self._file.seek(self._offsets[index])
+        item: dict[str, Any] = json.loads(self._file.readline())["item"]
+        return item
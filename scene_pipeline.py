@@ -0,0 +1,272 @@
+import os
+import sys
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Optional
+
+from config import VOICEVOX_MAX_CONCURRENCY
+from formula.add_latex import build_latex_item, render_latex_asset
+from utils.tracing import span
+from voice.add_voice import build_voice_item, get_voice_asset_path, render_voice_asset
+from voice.voicevox_client import VoicevoxClient
+
+# 指示の種類ごとのワーカープール名
+VOICE_POOL = "voice"
+LATEX_POOL = "latex"
+
+
+def get_asset_key(instruction: dict[str, Any]) -> Optional[tuple[Any, ...]]:
+    """指示が必要とする素材を識別するキーを返す (素材が不要な指示はNone)
+
+    同じキーの指示は1回だけ描画し、結果の素材を共有する。
+    """
+    if instruction["type"] == "voice":
+        return (VOICE_POOL, instruction["text"], instruction.get("speed", 1.0))
+    if instruction["type"] == "latex":
+        return (LATEX_POOL, instruction["formula"])
+    return None
+
+
+def render_asset(
+    instruction: dict[str, Any], voice_client: Optional[VoicevoxClient] = None
+) -> str:
+    """指示に対応する素材 (音声ファイル・数式画像) を生成し、そのパスを返す"""
+    with span("scene.render", type=instruction["type"]):
+        if instruction["type"] == "voice":
+            speed = instruction.get("speed", 1.0)
+            return render_voice_asset(
+                instruction["text"],
+                speed,
+                get_voice_asset_path(instruction["text"], speed),
+                voice_client,
+            )
+        return render_latex_asset(instruction["formula"])
+
+
+# アイテムの配置を決めるフィールド (素材の内容には影響しない)
+PLACEMENT_FIELDS = ("frame", "length", "layer", "timeline")
+
+
+def get_placement(instruction: dict[str, Any]) -> dict[str, int]:
+    """指示からアイテムの配置 (開始フレーム・長さ・レイヤー) を取り出す"""
+    if instruction["type"] == "voice":
+        return {
+            "frame": instruction.get("frame", 0),
+            "length": instruction.get("length", 60),
+        }
+    return {
+        "frame": instruction.get("frame", 0),
+        "length": instruction.get("length", 300),
+        "layer": instruction.get("layer", 1),
+    }
+
+
+def build_item(instruction: dict[str, Any], asset_path: str) -> dict[str, Any]:
+    """指示と生成済みの素材からタイムラインに置くアイテムを組み立てる
+
+    Args:
+        instruction (dict): 指示
+            - type (str): "voice" または "latex"
+            - voiceの場合: text, speaker_name (デフォルト"ずんだもん"),
+              frame (デフォルト0), length (デフォルト60), speed (デフォルト1.0)
+            - latexの場合: formula, frame (デフォルト0), length (デフォルト300),
+              layer (デフォルト1)
+            - timeline (int | str, optional): 追加先のタイムライン. デフォルトは0.
+        asset_path (str): render_assetで生成した素材のパス
+
+    Returns:
+        dict: アイテム
+    """
+    if instruction["type"] == "voice":
+        return build_voice_item(
+            instruction["text"],
+            asset_path,
+            speaker_name=instruction.get("speaker_name", "ずんだもん"),
+            **get_placement(instruction),
+        )
+    return build_latex_item(
+        instruction["formula"], asset_path, **get_placement(instruction)
+    )
+
+
+def place_item(instruction: dict[str, Any], item: dict[str, Any]) -> dict[str, Any]:
+    """既存のアイテムを指示の配置に合わせて置き直す (Guidや素材はそのまま)"""
+    placement = get_placement(instruction)
+    placed = dict(item)
+    placed["Frame"] = placement["frame"]
+    placed["Length"] = placement["length"]
+    if "layer" in placement:
+        placed["Layer"] = placement["layer"]
+    return placed
+
+
+def _has_failed(future: "Future[str]") -> bool:
+    """描画が例外で終わったか、キャンセルされたかどうか"""
+    return future.done() and (future.cancelled() or future.exception() is not None)
+
+
+class ProgressDisplay:
+    """素材の描画とタイムラインへの組み立ての進捗を標準エラー出力に表示するクラス"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.submitted = 0
+        self.rendered = 0
+        self.assembled = 0
+        self._lock = threading.Lock()
+
+    def _show(self) -> None:
+        if self.enabled:
+            sys.stderr.write(
+                f"\r描画: {self.rendered}/{self.submitted}  組立: {self.assembled}"
+            )
+            sys.stderr.flush()
+
+    def on_submitted(self) -> None:
+        with self._lock:
+            self.submitted += 1
+            self._show()
+
+    def on_rendered(self, _future: "Future[str]") -> None:
+        with self._lock:
+            self.rendered += 1
+            self._show()
+
+    def on_assembled(self) -> None:
+        with self._lock:
+            self.assembled += 1
+            self._show()
+
+    def close(self) -> None:
+        if self.enabled:
+            sys.stderr.write("\n")
+            sys.stderr.flush()
+
+
+class ScenePipeline:
+    """
+    指示ごとの素材の描画を並行に行い、指示の順番どおりにアイテムを組み立てるエンジン
+
+    音声はVOICEVOXエンジンが律速になるため少数のワーカーで、数式はpdflatexと
+    ImageMagickのプロセスが律速になるためCPU数に応じたワーカーで描画する。
+    未完了の描画はmax_pending件までに抑え、それを超えると先頭の指示の完了を
+    待ってから次の指示を受け付ける。同じ素材の重複描画を避けるための記録も
+    直近のasset_cache_size件までに抑えるため、指示の数が多くてもメモリ使用量は
+    一定になる。
+
+    使い方:
+        with ScenePipeline(jobs=4) as pipeline:
+            for instruction, item in pipeline.run(instructions):
+                ...
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        jobs: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        show_progress: bool = False,
+        asset_cache_size: int = 4096,
+        voice_client: Optional[VoicevoxClient] = None,
+    ):
+        """
+        Args:
+            jobs (int, optional): 並行して描画する最大数. デフォルトはCPU数.
+            max_pending (int, optional): 未完了の描画を保持する上限. デフォルトはjobsの4倍.
+            show_progress (bool): 進捗を表示するかどうか
+            asset_cache_size (int): 重複描画を避けるために記録しておく素材の数
+            voice_client (VoicevoxClient, optional): 音声の描画で使い回すクライアント.
+                指定しない場合は最初の音声の指示で1つ作成して使い回す.
+        """
+        jobs = max(jobs or os.cpu_count() or 1, 1)
+        self.max_pending = max(max_pending or jobs * 4, 1)
+        self.progress = ProgressDisplay(show_progress)
+        self._pools = {
+            VOICE_POOL: ThreadPoolExecutor(
+                max_workers=min(jobs, VOICEVOX_MAX_CONCURRENCY),
+                thread_name_prefix="voice",
+            ),
+            LATEX_POOL: ThreadPoolExecutor(
+                max_workers=jobs, thread_name_prefix="latex"
+            ),
+        }
+        self.asset_cache_size = max(asset_cache_size, 1)
+        self.voice_client = voice_client
+        self._futures: OrderedDict[tuple[Any, ...], Future[str]] = OrderedDict()
+
+    def __enter__(self) -> "ScenePipeline":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close(cancel=exc_info[0] is not None)
+
+    def close(self, cancel: bool = False) -> None:
+        """ワーカープールを停止する"""
+        for pool in self._pools.values():
+            pool.shutdown(wait=True, cancel_futures=cancel)
+        self.progress.close()
+
+    def _submit(self, instruction: dict[str, Any]) -> Optional["Future[str]"]:
+        key = get_asset_key(instruction)
+        if key is None:
+            return None
+        future = self._futures.get(key)
+        if future is not None and _has_failed(future):
+            # 一時的な失敗 (TeXやVOICEVOXのエラー) を後の指示に持ち越さず、描画し直す
+            del self._futures[key]
+            future = None
+        if future is not None:
+            self._futures.move_to_end(key)
+            return future
+        if key[0] == VOICE_POOL and self.voice_client is None:
+            # 音声ごとにクライアントを作るとVOICEVOXの起動確認が毎回走る
+            self.voice_client = VoicevoxClient()
+        future = self._pools[key[0]].submit(
+            render_asset, instruction, self.voice_client
+        )
+        future.add_done_callback(self.progress.on_rendered)
+        self._futures[key] = future
+        if len(self._futures) > self.asset_cache_size:
+            self._futures.popitem(last=False)
+        self.progress.on_submitted()
+        return future
+
+    def _assemble(
+        self, instruction: dict[str, Any], future: Optional["Future[str]"]
+    ) -> Optional[dict[str, Any]]:
+        if future is None:
+            # elif instruction["type"] == "telop": ... 将来の拡張
+            return None
+        item = build_item(instruction, future.result())
+        self.progress.on_assembled()
+        return item
+
+    def run(
+        self, instructions: Iterable[dict[str, Any]]
+    ) -> Iterator[tuple[dict[str, Any], dict[str, Any]]]:
+        """
+        指示を順に受け取り、(指示, アイテム) を指示の順番どおりに返す
+
+        素材の描画に失敗した場合は、その指示の番になった時点で例外を送出する。
+        未対応の種類の指示は読み飛ばす。
+
+        Args:
+            instructions (Iterable[dict]): 指示 (リストでもジェネレーターでもよい)
+
+        Yields:
+            tuple[dict, dict]: 指示と、それに対応するアイテム
+        """
+        pending: deque[tuple[dict[str, Any], Optional[Future[str]]]] = deque()
+        for instruction in instructions:
+            pending.append((instruction, self._submit(instruction)))
+            while len(pending) >= self.max_pending:
+                head, future = pending.popleft()
+                item = self._assemble(head, future)
+                if item is not None:
+                    yield head, item
+        while pending:
+            head, future = pending.popleft()
+            item = self._assemble(head, future)
+            if item is not None:
+                yield head, item
@@ -2,19 +2,103 @@
 YMM4プロジェクト操作用の共通ユーティリティ関数を提供するパッケージ
 """
 
-from .ymmp_templates import create_voice_item_template
-from .ymmp_utils import (
-    get_last_frame,
-    get_wav_duration_and_frames,
-    load_ymmp_project,
-    save_ymmp_project,
-)
+import importlib
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .ymmp_lock import (
+        append_project_items,
+        commit_project_items,
+        get_file_version,
+        project_lock,
+    )
+    from .ymmp_merge import merge_ymmp_projects, split_ymmp_project
+    from .ymmp_stream import (
+        TimelineRef,
+        find_appendable_timeline,
+        get_ymmp_summary,
+        scan_ymmp_project,
+    )
+    from .ymmp_templates import create_voice_item_template
+    from .ymmp_timeline import (
+        ProjectIndex,
+        TimelineIndex,
+        get_timeline,
+        get_timeline_fps,
+        parse_timeline_ref,
+    )
+    from .ymmp_utils import (
+        get_last_frame,
+        get_wav_duration_and_frames,
+        load_ymmp_project,
+        save_ymmp_project,
+        splice_ymmp_items,
+    )
+    from .ymmp_writer import YmmpItemWriter
+
+# 公開する名前と定義しているモジュール。main.pyの起動を軽くするため、
+# 各モジュールは名前が初めて参照されたときにインポートする (PEP 562)。
+_EXPORTS = {
+    "append_project_items": "ymmp_lock",
+    "commit_project_items": "ymmp_lock",
+    "get_file_version": "ymmp_lock",
+    "project_lock": "ymmp_lock",
+    "merge_ymmp_projects": "ymmp_merge",
+    "split_ymmp_project": "ymmp_merge",
+    "TimelineRef": "ymmp_stream",
+    "find_appendable_timeline": "ymmp_stream",
+    "get_ymmp_summary": "ymmp_stream",
+    "scan_ymmp_project": "ymmp_stream",
+    "create_voice_item_template": "ymmp_templates",
+    "ProjectIndex": "ymmp_timeline",
+    "TimelineIndex": "ymmp_timeline",
+    "get_timeline": "ymmp_timeline",
+    "get_timeline_fps": "ymmp_timeline",
+    "parse_timeline_ref": "ymmp_timeline",
+    "get_last_frame": "ymmp_utils",
+    "get_wav_duration_and_frames": "ymmp_utils",
+    "load_ymmp_project": "ymmp_utils",
+    "save_ymmp_project": "ymmp_utils",
+    "splice_ymmp_items": "ymmp_utils",
+    "YmmpItemWriter": "ymmp_writer",
+}
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module_name}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted([*globals(), *_EXPORTS])
+
 
 __all__ = [
     "get_last_frame",
     "get_wav_duration_and_frames",
     "load_ymmp_project",
     "save_ymmp_project",
+    "splice_ymmp_items",
+    "find_appendable_timeline",
+    "scan_ymmp_project",
+    "get_ymmp_summary",
+    "TimelineRef",
+    "ProjectIndex",
+    "TimelineIndex",
+    "get_timeline",
+    "get_timeline_fps",
+    "parse_timeline_ref",
+    "merge_ymmp_projects",
+    "split_ymmp_project",
+    "YmmpItemWriter",
+    "project_lock",
+    "get_file_version",
+    "commit_project_items",
+    "append_project_items",
     "create_voice_item_template",
 ]
 
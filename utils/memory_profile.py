@@ -0,0 +1,252 @@
+# ruff: noqa: RUF002
+import sys
+import threading
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .tracing import Span, Tracer, get_tracer
+
+try:
+    import resource
+except ImportError:  # Windowsにはresourceモジュールがない
+    resource = None  # type: ignore[assignment]
+
+# 割り当て箇所の一覧から除外するファイル (計測のための割り当て)
+_IGNORED_FILTERS = [
+    tracemalloc.Filter(False, filename)
+    for filename in (tracemalloc.__file__, __file__, "<frozen importlib._bootstrap>")
+]
+
+# ステージのピークがこの倍率を超えて更新されたときだけスナップショットを取り直す
+# (メモリが少しずつ増える処理で、区間ごとにスナップショットを取らないようにする)
+_SNAPSHOT_GROWTH = 1.1
+
+_MB = 1024 * 1024
+
+
+class MemoryBudgetExceededError(MemoryError):
+    """メモリの使用量が予算を超えた場合に送出される例外"""
+
+
+@dataclass
+class AllocationSite:
+    """
+    メモリを確保したソースコード上の位置
+
+    Attributes:
+        location (str): "ファイル:行番号"
+        size_bytes (int): 計測開始時からの増加量
+        count (int): 計測開始時からのブロック数の増加量
+    """
+
+    location: str
+    size_bytes: int
+    count: int
+
+
+@dataclass
+class StageMemory:
+    """
+    同じ名前の区間をまとめたメモリ使用量の集計
+
+    Attributes:
+        name (str): 区間の名前
+        count (int): 区間の数
+        peak_bytes (int): 区間の実行中に観測した最大の使用量
+        growth_bytes (int): 1つの区間で増えたまま残った使用量の最大値
+        top_sites (list[AllocationSite]): ピークを記録した区間の終了時点で、
+            計測開始時から多く増えていた割り当て箇所
+    """
+
+    name: str
+    count: int = 0
+    peak_bytes: int = 0
+    growth_bytes: int = 0
+    top_sites: list[AllocationSite] = field(default_factory=list)
+
+
+@dataclass
+class _ActiveSpan:
+    start_bytes: int
+    peak_bytes: int
+
+
+def get_max_rss_bytes() -> Optional[int]:
+    """プロセスの最大RSSを返す (取得できない環境ではNone)"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSはバイト単位、Linuxはキロバイト単位
+    return int(max_rss if sys.platform == "darwin" else max_rss * 1024)
+
+
+class MemoryProfiler:
+    """
+    tracemallocで区間 (Span) ごとのメモリ使用量を計測するクラス
+
+    Tracerのリスナーとして登録し、区間の開始と終了のたびにtracemallocの
+    ピークを読み取ってリセットする。入れ子の区間や別スレッドの区間が
+    重なっていても、実行中の全区間にピークを反映するため、外側の区間の
+    ピークが失われることはない。
+
+    計測されるのはPythonのオブジェクトが確保したメモリで、RSSには
+    インタープリター自体やC拡張が確保したメモリも含まれる。
+
+    使い方:
+        with MemoryProfiler(budget_bytes=512 * 1024 * 1024) as profiler:
+            add_scenes_from_instructions(...)
+        print(profiler.format_report())
+    """
+
+    def __init__(
+        self,
+        budget_bytes: Optional[int] = None,
+        top: int = 5,
+        frames: int = 1,
+        tracer: Optional[Tracer] = None,
+    ):
+        """
+        Args:
+            budget_bytes (Optional[int]): 区間の実行中に許容する最大の使用量
+                (超えた時点でMemoryBudgetExceededErrorを送出する)
+            top (int): ステージごとに記録する割り当て箇所の数
+            frames (int): 割り当て箇所として記録するスタックの深さ
+            tracer (Optional[Tracer]): 監視するTracer (デフォルトは共有のTracer)
+        """
+        self.budget_bytes = budget_bytes
+        self.top = top
+        self.frames = frames
+        self.tracer = tracer or get_tracer()
+        self.stages: dict[str, StageMemory] = {}
+        self.peak_bytes = 0
+        self.exceeded = False
+        self._active: dict[int, _ActiveSpan] = {}
+        self._snapshot_peaks: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._started_tracemalloc = False
+
+    def __enter__(self) -> "MemoryProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """計測を開始する (共有のTracerでの記録も有効にする)"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracemalloc = True
+        tracemalloc.reset_peak()
+        self._baseline = tracemalloc.take_snapshot().filter_traces(_IGNORED_FILTERS)
+        self.tracer.enabled = True
+        self.tracer.add_listener(self)
+
+    def stop(self) -> None:
+        """計測を終了する (区間の外で確保されたメモリもピークに反映する)"""
+        self.tracer.remove_listener(self)
+        with self._lock:
+            self._fold_peak()
+        self._baseline = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        if self.budget_bytes is not None and self.peak_bytes > self.budget_bytes:
+            self.exceeded = True
+
+    def _fold_peak(self) -> int:
+        """前回からのピークを実行中の全区間に反映してリセットし、現在の使用量を返す"""
+        current, peak = tracemalloc.get_traced_memory()
+        for active in self._active.values():
+            active.peak_bytes = max(active.peak_bytes, peak)
+        self.peak_bytes = max(self.peak_bytes, peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def _top_sites(self) -> list[AllocationSite]:
+        """計測開始時から多く増えた割り当て箇所を返す"""
+        if self._baseline is None:
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED_FILTERS)
+        differences = sorted(
+            (
+                difference
+                for difference in snapshot.compare_to(self._baseline, "lineno")
+                if difference.size_diff > 0
+            ),
+            key=lambda difference: difference.size_diff,
+            reverse=True,
+        )
+        sites = []
+        for difference in differences[: self.top]:
+            frame = difference.traceback[0]
+            sites.append(
+                AllocationSite(
+                    location=f"{frame.filename}:{frame.lineno}",
+                    size_bytes=difference.size_diff,
+                    count=difference.count_diff,
+                )
+            )
+        return sites
+
+    def on_span_start(self, span: Span) -> None:
+        with self._lock:
+            current = self._fold_peak()
+            self._active[id(span)] = _ActiveSpan(current, current)
+
+    def on_span_end(self, span: Span) -> None:
+        with self._lock:
+            current = self._fold_peak()
+            active = self._active.pop(id(span), None)
+            if active is None:
+                # 計測開始前に始まった区間
+                return
+            stage = self.stages.setdefault(span.name, StageMemory(span.name))
+            stage.count += 1
+            stage.peak_bytes = max(stage.peak_bytes, active.peak_bytes)
+            stage.growth_bytes = max(stage.growth_bytes, current - active.start_bytes)
+            if active.peak_bytes > self._snapshot_peaks.get(span.name, 0) * (
+                _SNAPSHOT_GROWTH
+            ):
+                self._snapshot_peaks[span.name] = active.peak_bytes
+                stage.top_sites = self._top_sites()
+            span.set(memory_peak_bytes=active.peak_bytes)
+            budget = self.budget_bytes
+            exceeded = budget is not None and active.peak_bytes > budget
+            self.exceeded = self.exceeded or exceeded
+
+        # 区間が別の例外で終わった場合は、その例外をそのまま伝える
+        if budget is not None and exceeded and "error" not in span.attributes:
+            raise MemoryBudgetExceededError(
+                f"メモリの使用量が予算を超えました ({span.name}): "
+                f"{active.peak_bytes / _MB:.1f} MB > {budget / _MB:.1f} MB"
+            )
+
+    def format_report(self) -> str:
+        """ステージごとのピークと割り当て箇所を表形式の文字列にする"""
+        lines = [f"{'stage':<24}{'count':>8}{'peak':>12}{'growth':>12}  (MB)"]
+        stages = sorted(
+            self.stages.values(), key=lambda stage: stage.peak_bytes, reverse=True
+        )
+        for stage in stages:
+            lines.append(
+                f"{stage.name:<24}{stage.count:>8}"
+                f"{stage.peak_bytes / _MB:>12.1f}{stage.growth_bytes / _MB:>12.1f}"
+            )
+            for site in stage.top_sites:
+                lines.append(
+                    f"    {site.size_bytes / _MB:>8.1f} MB {site.count:>8} blocks"
+                    f"  {site.location}"
+                )
+        budget = (
+            f" (予算 {self.budget_bytes / _MB:.1f} MB)"
+            if self.budget_bytes is not None
+            else ""
+        )
+        lines.append(f"全体のピーク: {self.peak_bytes / _MB:.1f} MB{budget}")
+        max_rss = get_max_rss_bytes()
+        if max_rss is not None:
+            lines.append(f"最大RSS: {max_rss / _MB:.1f} MB")
+        return "\n".join(lines)
@@ -0,0 +1,245 @@
+# ruff: noqa: RUF002
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional, Protocol, Union
+
+
+@dataclass
+class Span:
+    """
+    計測した1つの処理区間
+
+    Attributes:
+        name (str): 区間の名前 (例: "voice.synthesis")
+        start_ns (int): 開始時刻 (time.perf_counter_ns)
+        end_ns (int): 終了時刻 (未終了の場合は0)
+        thread_id (int): 実行したスレッドのID
+        attributes (dict): 区間に付ける属性 (テキストの長さ、ファイルパスなど)
+    """
+
+    name: str
+    start_ns: int
+    end_ns: int = 0
+    thread_id: int = 0
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def set(self, **attributes: Any) -> None:
+        """区間に属性を追加する"""
+        self.attributes.update(attributes)
+
+
+@dataclass
+class StageSummary:
+    """
+    同じ名前の区間をまとめた所要時間の集計 (ミリ秒)
+    """
+
+    name: str
+    count: int
+    total_ms: float
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    max_ms: float
+
+
+class SpanListener(Protocol):
+    """
+    区間の開始と終了を受け取るオブジェクト (Tracer.add_listenerで登録する)
+
+    区間を記録したスレッドから呼ばれる。on_span_endで例外を送出すると、
+    その区間を実行していた処理に例外が伝わる。
+    """
+
+    def on_span_start(self, span: Span) -> None: ...
+
+    def on_span_end(self, span: Span) -> None: ...
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    """ソート済みの値の百分位数を線形補間で求める"""
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (
+        position - lower
+    )
+
+
+class Tracer:
+    """
+    処理区間 (Span) を記録するクラス
+
+    無効な間はspanを呼んでも何も記録しないため、計測箇所を残したままでも
+    ほとんどコストはかからない。複数のスレッドから同時に記録できる。
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.spans: list[Span] = []
+        self._listeners: list[SpanListener] = []
+        self._lock = threading.Lock()
+        self._origin_ns = time.perf_counter_ns()
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """
+        with文の中の処理を1つの区間として記録する
+
+        使い方:
+            with tracer.span("voice.synthesis", speaker=1) as span:
+                data = synthesize()
+                span.set(bytes=len(data))
+        """
+        span = Span(name, time.perf_counter_ns(), attributes=attributes)
+        if not self.enabled:
+            yield span
+            return
+        span.thread_id = threading.get_ident()
+        listeners = list(self._listeners)
+        for listener in listeners:
+            listener.on_span_start(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.end_ns = time.perf_counter_ns()
+            with self._lock:
+                self.spans.append(span)
+            for listener in listeners:
+                listener.on_span_end(span)
+
+    def add_listener(self, listener: SpanListener) -> None:
+        """区間の開始と終了を通知するリスナーを登録する"""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: SpanListener) -> None:
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.spans.clear()
+
+    def summary(self) -> list[StageSummary]:
+        """区間の名前ごとに所要時間を集計する (合計時間の長い順)"""
+        with self._lock:
+            spans = list(self.spans)
+        durations: dict[str, list[float]] = {}
+        for span in spans:
+            durations.setdefault(span.name, []).append(span.duration_ms)
+        stages = []
+        for name, values in durations.items():
+            values.sort()
+            stages.append(
+                StageSummary(
+                    name=name,
+                    count=len(values),
+                    total_ms=sum(values),
+                    p50_ms=_percentile(values, 0.5),
+                    p90_ms=_percentile(values, 0.9),
+                    p99_ms=_percentile(values, 0.99),
+                    max_ms=values[-1],
+                )
+            )
+        return sorted(stages, key=lambda stage: stage.total_ms, reverse=True)
+
+    def format_summary(self) -> str:
+        """集計結果を表形式の文字列にする"""
+        lines = [
+            f"{'stage':<24}{'count':>8}{'total':>12}{'p50':>10}"
+            f"{'p90':>10}{'p99':>10}{'max':>10}  (ms)"
+        ]
+        for stage in self.summary():
+            lines.append(
+                f"{stage.name:<24}{stage.count:>8}{stage.total_ms:>12.1f}"
+                f"{stage.p50_ms:>10.1f}{stage.p90_ms:>10.1f}"
+                f"{stage.p99_ms:>10.1f}{stage.max_ms:>10.1f}"
+            )
+        return "\n".join(lines)
+
+    def export_jsonl(self, path: Union[str, Path]) -> None:
+        """区間を1行1区間のJSON Linesとして書き出す"""
+        with self._lock:
+            spans = list(self.spans)
+        with open(path, "w", encoding="utf-8") as f:
+            for span in spans:
+                record = {
+                    "name": span.name,
+                    "start_ms": (span.start_ns - self._origin_ns) / 1e6,
+                    "duration_ms": span.duration_ms,
+                    "thread": span.thread_id,
+                    "attributes": span.attributes,
+                }
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def export_chrome_trace(self, path: Union[str, Path]) -> None:
+        """
+        区間をChromeのトレース形式 (chrome://tracing や Perfetto で表示できる) で書き出す
+        """
+        with self._lock:
+            spans = list(self.spans)
+        events = [
+            {
+                "name": span.name,
+                "cat": span.name.split(".")[0],
+                "ph": "X",
+                "ts": (span.start_ns - self._origin_ns) / 1e3,
+                "dur": (span.end_ns - span.start_ns) / 1e3,
+                "pid": os.getpid(),
+                "tid": span.thread_id,
+                "args": span.attributes,
+            }
+            for span in spans
+        ]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"traceEvents": events, "displayTimeUnit": "ms"},
+                f,
+                ensure_ascii=False,
+                default=str,
+            )
+
+    def export(self, path: Union[str, Path]) -> None:
+        """拡張子に応じて書き出す (.jsonlはJSON Lines、それ以外はChromeのトレース形式)"""
+        if str(path).endswith(".jsonl"):
+            self.export_jsonl(path)
+        else:
+            self.export_chrome_trace(path)
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """プロセス全体で共有するTracerを取得する"""
+    return _tracer
+
+
+def enable_tracing(enabled: bool = True) -> Tracer:
+    """共有のTracerでの記録を開始 (または停止) する"""
+    _tracer.enabled = enabled
+    return _tracer
+
+
+def span(name: str, **attributes: Any) -> AbstractContextManager[Span]:
+    """共有のTracerで区間を記録する (Tracer.spanを参照)"""
+    return _tracer.span(name, **attributes)
+
+
+def trace_summary() -> Optional[str]:
+    """記録した区間があれば集計結果の文字列を返す"""
+    return _tracer.format_summary() if _tracer.spans else None
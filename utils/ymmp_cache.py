@@ -0,0 +1,198 @@
+# ruff: noqa: RUF002
+import gc
+import hashlib
+import marshal
+import os
+import stat
+import tempfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import astuple, dataclass
+from pathlib import Path
+from typing import Any, Optional
+
+from config import SNAPSHOT_CACHE_DIR, SNAPSHOT_CACHE_MAX_BYTES
+
+# 2: pickleからmarshalに変更 (読み込みでコードが実行されない形式)
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_SUFFIX = ".snapshot"
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+@dataclass(frozen=True)
+class SnapshotKey:
+    """
+    スナップショットの有効性を判定するためのキー
+
+    Attributes:
+        path (str): プロジェクトファイルの絶対パス
+        mtime_ns (int): 更新日時 (ナノ秒)
+        size (int): ファイルサイズ
+        digest (str): ファイル内容のダイジェスト
+    """
+
+    path: str
+    mtime_ns: int
+    size: int
+    digest: str
+
+
+@contextmanager
+def gc_paused() -> Iterator[None]:
+    """
+    大量の辞書を一度に生成する間、循環GCを止める
+
+    プロジェクトの展開中に何度も走る世代別GCは、解析そのものより重くなることがある。
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def get_snapshot_key(project_file: str) -> SnapshotKey:
+    """
+    プロジェクトファイルのスナップショットキーを計算する関数
+
+    Args:
+        project_file (str): プロジェクトファイルのパス
+
+    Returns:
+        SnapshotKey: パス・更新日時・サイズ・内容のダイジェストからなるキー
+    """
+    path = os.path.abspath(project_file)
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        while chunk := f.read(_HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return SnapshotKey(path, stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+
+
+def get_snapshot_path(key: SnapshotKey, cache_dir: Path = SNAPSHOT_CACHE_DIR) -> Path:
+    """キーに対応するスナップショットファイルのパスを返す関数"""
+    name = hashlib.sha1(key.path.encode("utf-8")).hexdigest()
+    return cache_dir / f"{name}{_SNAPSHOT_SUFFIX}"
+
+
+def _prepare_cache_dir(cache_dir: Path) -> None:
+    """キャッシュディレクトリを作成し、自分以外が書き込めないようにする"""
+    cache_dir.mkdir(parents=True, exist_ok=True, mode=0o700)
+    if hasattr(os, "getuid") and cache_dir.stat().st_uid == os.getuid():
+        cache_dir.chmod(0o700)
+
+
+def _is_private(path: Path) -> bool:
+    """自分が所有し、他のユーザーが書き込めないファイル (ディレクトリ) かどうか"""
+    if not hasattr(os, "getuid"):
+        return True
+    info = path.stat()
+    return info.st_uid == os.getuid() and not info.st_mode & (
+        stat.S_IWGRP | stat.S_IWOTH
+    )
+
+
+def load_snapshot(
+    key: SnapshotKey, cache_dir: Path = SNAPSHOT_CACHE_DIR
+) -> Optional[dict[str, Any]]:
+    """
+    スナップショットからプロジェクトデータを読み込む関数
+
+    スナップショットはmarshal形式 (JSONと同じ種類の値しか復元せず、コードを
+    実行しない) で保存する。さらに、他のユーザーが書き込めるキャッシュ
+    ディレクトリやファイルのスナップショットは使わない。
+
+    Args:
+        key (SnapshotKey): 現在のプロジェクトファイルのキー
+        cache_dir (Path): キャッシュディレクトリ
+
+    Returns:
+        dict: キーが一致するスナップショットがあればそのデータ、無ければNone
+    """
+    snapshot_path = get_snapshot_path(key, cache_dir)
+    try:
+        if not (_is_private(cache_dir) and _is_private(snapshot_path)):
+            return None
+        with open(snapshot_path, "rb") as f:
+            header = marshal.load(f)
+            if header != (_SNAPSHOT_VERSION, astuple(key)):
+                return None
+            # ファイルから少しずつ読むより、一括で読んでから復元する方が速い
+            payload = f.read()
+        with gc_paused():
+            project_data = marshal.loads(payload)
+        if not isinstance(project_data, dict):
+            return None
+        # 最近使ったものほど後まで残るよう、更新日時を使用日時として扱う
+        os.utime(snapshot_path)
+        return project_data
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def evict_snapshots(
+    max_bytes: int = SNAPSHOT_CACHE_MAX_BYTES, cache_dir: Path = SNAPSHOT_CACHE_DIR
+) -> None:
+    """
+    キャッシュの合計サイズが上限を超えている場合、古いものから削除する関数
+
+    Args:
+        max_bytes (int): キャッシュの上限サイズ (バイト)
+        cache_dir (Path): キャッシュディレクトリ
+    """
+    entries = []
+    for path in cache_dir.glob(f"*{_SNAPSHOT_SUFFIX}"):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+            total -= size
+        except OSError:
+            continue
+
+
+def store_snapshot(
+    key: SnapshotKey,
+    project_data: dict[str, Any],
+    cache_dir: Path = SNAPSHOT_CACHE_DIR,
+    max_bytes: int = SNAPSHOT_CACHE_MAX_BYTES,
+) -> None:
+    """
+    プロジェクトデータをスナップショットとして保存する関数
+
+    キャッシュは補助的なものなので、書き込みに失敗しても例外は送出しない。
+
+    Args:
+        key (SnapshotKey): プロジェクトファイルのキー
+        project_data (dict): 保存するプロジェクトデータ
+        cache_dir (Path): キャッシュディレクトリ
+        max_bytes (int): キャッシュの上限サイズ (バイト)。0以下ならキャッシュしない
+    """
+    if max_bytes <= 0:
+        return
+    tmp_path: Optional[str] = None
+    try:
+        _prepare_cache_dir(cache_dir)
+        # NamedTemporaryFileは所有者だけが読み書きできる権限 (0600) で作られる
+        with tempfile.NamedTemporaryFile(
+            dir=cache_dir, suffix=".tmp", delete=False
+        ) as f:
+            tmp_path = f.name
+            marshal.dump((_SNAPSHOT_VERSION, astuple(key)), f)
+            marshal.dump(project_data, f)
+        os.replace(tmp_path, get_snapshot_path(key, cache_dir))
+        evict_snapshots(max_bytes, cache_dir)
+    except (OSError, ValueError):
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
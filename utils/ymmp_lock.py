@@ -0,0 +1,316 @@
+# ruff: noqa: RUF002
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, Any, Optional
+
+from config import PROJECT_LOCK_TIMEOUT
+
+from .ymmp_stream import TimelineRef, TimelineScan, find_appendable_timeline
+from .ymmp_timeline import get_timeline
+from .ymmp_utils import (
+    get_last_frame,
+    load_ymmp_project,
+    save_ymmp_project,
+    splice_ymmp_items,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+LOCK_SUFFIX = ".lock"
+
+# ロックが取れるまで待つ間の確認間隔 (秒)
+_POLL_INTERVAL = 0.05
+
+
+@dataclass(frozen=True)
+class FileVersion:
+    """
+    ファイルが書き換えられたかどうかを判定するための情報
+
+    Attributes:
+        mtime_ns (int): 更新日時 (ナノ秒)
+        size (int): ファイルサイズ
+        inode (int): inode番号 (アトミックな置き換えで変わる)
+    """
+
+    mtime_ns: int
+    size: int
+    inode: int
+
+
+def get_file_version(path: str) -> Optional[FileVersion]:
+    """ファイルの現在のバージョンを返す (ファイルが無い場合はNone)"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return FileVersion(stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def get_lock_path(project_file: str) -> Path:
+    """プロジェクトファイルの書き込みを排他するロックファイルのパス"""
+    path = Path(project_file)
+    return path.with_name(path.name + LOCK_SUFFIX)
+
+
+def _try_lock(f: IO[bytes]) -> bool:
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            # 先頭の1バイトをロックする (追記モードでも位置を先頭に戻す)
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock(f: IO[bytes]) -> None:
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class _ProjectLock:
+    """1つのロックファイルに対する、プロセス内のスレッド間と他のプロセスとの排他"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.file: Optional[IO[bytes]] = None
+
+    def acquire_file(self, deadline: Optional[float]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.path, "a+b")
+        while not _try_lock(f):
+            if deadline is not None and time.monotonic() >= deadline:
+                f.close()
+                raise TimeoutError(
+                    f"プロジェクトのロックを取得できませんでした: {self.path}"
+                )
+            time.sleep(_POLL_INTERVAL)
+        self.file = f
+
+    def release_file(self) -> None:
+        if self.file is not None:
+            _unlock(self.file)
+            self.file.close()
+            self.file = None
+
+
+_locks: dict[str, _ProjectLock] = {}
+_locks_guard = threading.Lock()
+
+
+@contextmanager
+def project_lock(
+    project_file: str, timeout: Optional[float] = PROJECT_LOCK_TIMEOUT
+) -> Iterator[None]:
+    """
+    プロジェクトファイルへの書き込みを排他するコンテキストマネージャー
+
+    プロジェクトの隣のロックファイル (<プロジェクト>.lock) に対する勧告ロックで、
+    同じファイルに書き込む他のプロセスやスレッドを待たせる。同じスレッドからは
+    入れ子にして取得できる。ロックを取らずに書き込むプログラムは止められない。
+
+    Args:
+        project_file (str): 書き込むプロジェクトファイルのパス
+        timeout (Optional[float]): 待つ最大の秒数 (Noneの場合は取得できるまで待つ)
+
+    Raises:
+        TimeoutError: 時間内にロックを取得できなかった場合
+    """
+    path = get_lock_path(os.path.abspath(project_file))
+    with _locks_guard:
+        lock = _locks.setdefault(str(path), _ProjectLock(path))
+    deadline = None if timeout is None else time.monotonic() + timeout
+    if not lock.thread_lock.acquire(timeout=-1 if timeout is None else timeout):
+        raise TimeoutError(f"プロジェクトのロックを取得できませんでした: {path}")
+    try:
+        if lock.depth == 0:
+            lock.acquire_file(deadline)
+        lock.depth += 1
+        try:
+            yield
+        finally:
+            lock.depth -= 1
+            if lock.depth == 0:
+                lock.release_file()
+    finally:
+        lock.thread_lock.release()
+
+
+@dataclass
+class CommitResult:
+    """
+    commit_project_itemsの結果
+
+    Attributes:
+        project_data (dict): 実際に保存したプロジェクトデータ
+        version (Optional[FileVersion]): 保存直後の出力先のバージョン
+            (次に保存するときのloaded_versionに使う)
+        merged (bool): 他の書き込みがあったため、読み込み直して追加したかどうか
+    """
+
+    project_data: dict[str, Any]
+    version: Optional[FileVersion]
+    merged: bool = False
+
+
+def _rebase_items(
+    new_items: Sequence[dict[str, Any]], loaded_last_frame: int, latest_last_frame: int
+) -> list[dict[str, Any]]:
+    """最後尾に追加したアイテムを、他の書き込みで伸びた最後尾の後ろへずらす"""
+    shift = latest_last_frame - loaded_last_frame
+    if shift <= 0:
+        return list(new_items)
+    return [{**item, "Frame": item.get("Frame", 0) + shift} for item in new_items]
+
+
+def merge_new_items(
+    latest: dict[str, Any],
+    loaded: dict[str, Any],
+    new_items: Sequence[tuple[TimelineRef, dict[str, Any]]],
+    rebase: bool,
+) -> None:
+    """
+    読み込み直したプロジェクト (latest) に、新しいアイテムだけを追加し直す関数
+
+    Guidが同じアイテムが既にあれば追加しない。
+
+    Args:
+        latest (dict): 読み込み直した出力先のプロジェクトデータ (直接書き換える)
+        loaded (dict): 新しいアイテムを追加したときのプロジェクトデータ
+            (新しいアイテム以外の最後尾をずらす基準にする)
+        new_items (Sequence[tuple[TimelineRef, dict]]): 追加したアイテムと追加先のタイムライン
+        rebase (bool): アイテムをlatestの最後尾の後ろへずらすかどうか
+    """
+    new_guids = {item.get("Guid") for _, item in new_items}
+    for timeline in dict.fromkeys(timeline for timeline, _ in new_items):
+        items = [item for ref, item in new_items if ref == timeline]
+        existing = get_timeline(latest, timeline)["Items"]
+        known = {item.get("Guid") for item in existing}
+        if rebase:
+            loaded_last_frame = max(
+                (
+                    item.get("Frame", 0) + item.get("Length", 0)
+                    for item in get_timeline(loaded, timeline)["Items"]
+                    if item.get("Guid") not in new_guids
+                ),
+                default=0,
+            )
+            items = _rebase_items(
+                items, loaded_last_frame, get_last_frame(latest, timeline)
+            )
+        existing.extend(item for item in items if item.get("Guid") not in known)
+
+
+def commit_project_items(
+    project_data: dict[str, Any],
+    new_items: Sequence[tuple[TimelineRef, dict[str, Any]]],
+    output_file: str,
+    loaded_version: Optional[FileVersion],
+    rebase: bool = True,
+) -> Optional[CommitResult]:
+    """
+    新しいアイテムを追加したプロジェクトを、他の書き込みと競合しないように保存する関数
+
+    ロックを取った上で、出力先が読み込み時 (loaded_version) から変わっていなければ
+    project_dataをそのまま保存する。他のプロセスが先に書き込んでいた場合は、
+    出力先を読み込み直して新しいアイテムだけを追加し直す (楽観的マージ)。
+    Guidが同じアイテムが既にあれば追加しない。
+
+    Args:
+        project_data (dict): 新しいアイテムを追加済みのプロジェクトデータ
+        new_items (Sequence[tuple[TimelineRef, dict]]): 追加したアイテムと追加先のタイムライン
+        output_file (str): 出力ファイルのパス
+        loaded_version (Optional[FileVersion]): プロジェクトを読み込む前の出力先の
+            バージョン (get_file_versionの結果)
+        rebase (bool): 読み込み直した場合に、アイテムを最後尾の後ろへずらすかどうか
+            (最後尾に追加したアイテムはTrue、フレームを指定したアイテムはFalse)
+
+    Returns:
+        Optional[CommitResult]: 保存した結果 (保存に失敗した場合はNone)
+    """
+    with project_lock(output_file):
+        current_version = get_file_version(output_file)
+        if current_version is None or current_version == loaded_version:
+            if not save_ymmp_project(project_data, output_file):
+                return None
+            return CommitResult(project_data, get_file_version(output_file))
+
+        logger.info(
+            f"{output_file} が他の処理で更新されていたため、読み込み直して追加します。"
+        )
+        latest = load_ymmp_project(output_file)
+        if latest is None:
+            return None
+        merge_new_items(latest, project_data, new_items, rebase)
+        if not save_ymmp_project(latest, output_file):
+            return None
+        return CommitResult(latest, get_file_version(output_file), merged=True)
+
+
+def append_project_items(
+    project_file: str,
+    new_items: list[dict[str, Any]],
+    output_file: str,
+    timeline: TimelineScan,
+    loaded_version: Optional[FileVersion],
+) -> bool:
+    """
+    Items配列の末尾への追記 (splice_ymmp_items) を、他の書き込みと競合しないように行う関数
+
+    出力先が走査前 (loaded_version) から変わっていなければproject_fileに追記した
+    結果を出力する。他のプロセスが先に書き込んでいた場合は、出力先を走査し直して
+    その末尾に、最後尾の後ろへずらしたアイテムを追記する。
+
+    Args:
+        project_file (str): 走査した元のプロジェクトファイルのパス
+        new_items (list[dict]): 追記するアイテム
+        output_file (str): 出力ファイルのパス (project_fileと同じでもよい)
+        timeline (TimelineScan): project_fileを走査した追記先のタイムライン
+        loaded_version (Optional[FileVersion]): 走査する前の出力先のバージョン
+
+    Returns:
+        bool: 保存が成功した場合はTrue、失敗した場合はFalse
+    """
+    with project_lock(output_file):
+        current_version = get_file_version(output_file)
+        if current_version is None or current_version == loaded_version:
+            return splice_ymmp_items(project_file, new_items, output_file, timeline)
+
+        logger.info(
+            f"{output_file} が他の処理で更新されていたため、走査し直して追記します。"
+        )
+        latest = find_appendable_timeline(output_file, timeline.index)
+        if latest is not None:
+            items = _rebase_items(new_items, timeline.last_frame, latest.last_frame)
+            return splice_ymmp_items(output_file, items, output_file, latest)
+        # 追記できない構造の場合は全体を読み込み直して保存する
+        project_data = load_ymmp_project(output_file)
+        if project_data is None:
+            return False
+        items = _rebase_items(
+            new_items,
+            timeline.last_frame,
+            get_last_frame(project_data, timeline.index),
+        )
+        get_timeline(project_data, timeline.index)["Items"].extend(items)
+        return save_ymmp_project(project_data, output_file)
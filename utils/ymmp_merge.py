@@ -0,0 +1,208 @@
+# ruff: noqa: RUF002
+import bisect
+import logging
+import uuid
+from contextlib import ExitStack
+from pathlib import Path, PureWindowsPath
+from typing import Any, Optional
+
+from .ymmp_stream import (
+    TimelineRef,
+    get_ymmp_summary,
+    iter_timeline_items,
+    read_ymmp_skeleton,
+)
+from .ymmp_writer import YmmpItemWriter
+
+logger = logging.getLogger(__name__)
+
+
+def _resolve_timeline_index(project_file: str, timeline: TimelineRef) -> int:
+    """タイムライン名をインデックスに解決する (インデックスはそのまま返す)"""
+    if isinstance(timeline, int):
+        return timeline
+    summary = get_ymmp_summary(project_file)
+    found = summary.find_timeline(timeline) if summary is not None else None
+    if found is None:
+        raise ValueError(f"タイムラインが見つかりません: {timeline}")
+    return found.index
+
+
+def _other_timelines_with_items(project_file: str, timeline_index: int) -> list[str]:
+    """対象以外でアイテムを持つタイムラインの名前 (名前が無い場合はインデックス)"""
+    summary = get_ymmp_summary(project_file)
+    if summary is None:
+        return []
+    return [
+        found.name or str(found.index)
+        for found in summary.timelines
+        if found.index != timeline_index and found.item_count > 0
+    ]
+
+
+def remap_asset_path(
+    file_path: str, base_dir: Path, asset_map: Optional[dict[str, str]] = None
+) -> str:
+    """
+    アイテムが参照する素材のパスを結合先でも解決できる形に変換する関数
+
+    相対パスは元のプロジェクトファイルのディレクトリを基準に絶対パスにし、
+    asset_mapに一致する接頭辞があれば置き換える。
+
+    Args:
+        file_path (str): 素材のパス
+        base_dir (Path): 元のプロジェクトファイルのディレクトリ
+        asset_map (dict[str, str], optional): 置き換え前の接頭辞と置き換え後の接頭辞
+
+    Returns:
+        str: 変換後のパス
+    """
+    if not file_path:
+        return file_path
+    if not (Path(file_path).is_absolute() or PureWindowsPath(file_path).is_absolute()):
+        file_path = str((base_dir / file_path).resolve())
+    for old_prefix, new_prefix in (asset_map or {}).items():
+        if file_path.startswith(old_prefix):
+            return new_prefix + file_path[len(old_prefix) :]
+    return file_path
+
+
+def _shift_item(
+    item: dict[str, Any],
+    offset: int,
+    base_dir: Path,
+    asset_map: Optional[dict[str, str]],
+    regenerate_guid: bool,
+) -> dict[str, Any]:
+    item["Frame"] = item.get("Frame", 0) + offset
+    if regenerate_guid and "Guid" in item:
+        item["Guid"] = str(uuid.uuid4())
+    if isinstance(item.get("FilePath"), str):
+        item["FilePath"] = remap_asset_path(item["FilePath"], base_dir, asset_map)
+    return item
+
+
+def merge_ymmp_projects(
+    project_files: list[str],
+    output_file: str,
+    timeline: TimelineRef = 0,
+    gap_frames: int = 0,
+    asset_map: Optional[dict[str, str]] = None,
+) -> bool:
+    """
+    複数のYMM4プロジェクトを順番に連結して1つのプロジェクトにする関数
+
+    先頭のプロジェクトを骨格として使い、各プロジェクトの対象タイムラインの
+    アイテムを、それまでのチャプターの長さ (最後尾フレーム + gap_frames) だけ
+    ずらしながら1つずつ書き出す。2つ目以降のプロジェクトのアイテムには
+    新しいGuidを割り当て、素材のパスはremap_asset_pathで変換する。
+    一度に保持するのはアイテム1つ分だけで、連結後の構造は作らない。
+
+    連結するのは対象のタイムラインだけで、それ以外のタイムラインは先頭の
+    プロジェクトのものをそのまま残す。2つ目以降のプロジェクトの対象外の
+    タイムラインにアイテムがある場合、それらは出力されないため警告を出す。
+
+    Args:
+        project_files (list[str]): 連結するプロジェクトファイルのパス (連結順)
+        output_file (str): 出力ファイルのパス
+        timeline (int | str): 連結するタイムラインのインデックスまたは名前
+        gap_frames (int): チャプター間に空けるフレーム数
+        asset_map (dict[str, str], optional): 素材パスの接頭辞の置き換え表
+
+    Returns:
+        bool: 保存が成功した場合はTrue、失敗した場合はFalse
+    """
+    if not project_files:
+        logger.error("エラー: 連結するプロジェクトが指定されていません。")
+        return False
+
+    try:
+        first_index = _resolve_timeline_index(project_files[0], timeline)
+        skeleton = read_ymmp_skeleton(project_files[0], first_index)
+        with YmmpItemWriter(skeleton, output_file, first_index) as writer:
+            offset = 0
+            for chapter, project_file in enumerate(project_files):
+                timeline_index = _resolve_timeline_index(project_file, timeline)
+                dropped = _other_timelines_with_items(project_file, timeline_index)
+                if chapter > 0 and dropped:
+                    logger.warning(
+                        f"警告: {project_file} の対象外のタイムライン "
+                        f"({', '.join(dropped)}) のアイテムは連結されません。"
+                    )
+                base_dir = Path(project_file).resolve().parent
+                chapter_end = 0
+                for item in iter_timeline_items(project_file, timeline_index):
+                    end_frame = item.get("Frame", 0) + item.get("Length", 0)
+                    chapter_end = max(chapter_end, end_frame)
+                    writer.write(
+                        _shift_item(item, offset, base_dir, asset_map, chapter > 0)
+                    )
+                offset += chapter_end + gap_frames
+    except (OSError, ValueError, IndexError, KeyError) as e:
+        logger.error(f"エラー: プロジェクトの連結に失敗しました: {e}")
+        return False
+
+    logger.info(f"{len(project_files)}個のプロジェクトを連結しました: {output_file}")
+    return True
+
+
+def split_ymmp_project(
+    project_file: str,
+    split_frames: list[int],
+    output_dir: str,
+    timeline: TimelineRef = 0,
+) -> list[str]:
+    """
+    YMM4プロジェクトを指定したフレームで複数のプロジェクトに分割する関数
+
+    アイテムは開始フレームが含まれる区間に割り当て、区間の先頭が
+    0フレームになるようずらす。区間の境界をまたぐアイテムは長さを変えずに
+    開始位置側の区間に残す。アイテムは1つずつ読み出して各出力に直接書き出す。
+
+    分割するのは対象のタイムラインだけで、それ以外のタイムラインは
+    すべての出力にそのまま複製される。対象外のタイムラインにアイテムが
+    ある場合は、各出力に重複して含まれるため警告を出す。
+
+    Args:
+        project_file (str): 分割するプロジェクトファイルのパス
+        split_frames (list[int]): 分割位置のフレーム
+        output_dir (str): 出力先ディレクトリ
+        timeline (int | str): 分割するタイムラインのインデックスまたは名前
+
+    Returns:
+        list[str]: 出力したプロジェクトファイルのパス (失敗した場合は空リスト)
+    """
+    starts = [0, *sorted({frame for frame in split_frames if frame > 0})]
+    stem = Path(project_file).stem
+    output_files = [
+        str(Path(output_dir) / f"{stem}_part{number}.ymmp")
+        for number in range(1, len(starts) + 1)
+    ]
+
+    try:
+        timeline_index = _resolve_timeline_index(project_file, timeline)
+        copied = _other_timelines_with_items(project_file, timeline_index)
+        if copied:
+            logger.warning(
+                f"警告: 対象外のタイムライン ({', '.join(copied)}) は分割されず、"
+                "すべての出力にそのまま含まれます。"
+            )
+        skeleton = read_ymmp_skeleton(project_file, timeline_index)
+        with ExitStack() as stack:
+            writers = [
+                stack.enter_context(
+                    YmmpItemWriter(skeleton, output_file, timeline_index)
+                )
+                for output_file in output_files
+            ]
+            for item in iter_timeline_items(project_file, timeline_index):
+                frame = item.get("Frame", 0)
+                segment = max(bisect.bisect_right(starts, frame) - 1, 0)
+                item["Frame"] = frame - starts[segment]
+                writers[segment].write(item)
+    except (OSError, ValueError, IndexError, KeyError) as e:
+        logger.error(f"エラー: プロジェクトの分割に失敗しました: {e}")
+        return []
+
+    logger.info(f"プロジェクトを{len(output_files)}個に分割しました: {output_dir}")
+    return output_files
@@ -0,0 +1,569 @@
+# ruff: noqa: RUF002
+import codecs
+import json
+import logging
+import os
+import re
+from collections.abc import Iterator
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, BinaryIO, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_BOM = codecs.BOM_UTF8
+_CHUNK_SIZE = 1 << 20
+_SUMMARY_VERSION = 4
+
+# 概要に保持するトップレベルの値 (get_ymmp_metadata・get_ymmp_tracksが読むもの)。
+# それ以外の値は大きくなり得るため、概要には含めずread_ymmp_valueで都度読み出す
+SUMMARY_VALUE_KEYS = ("metadata", "tracks")
+
+# タイムラインの指定方法: Timelines内のインデックス、またはタイムライン名
+TimelineRef = Union[int, str]
+
+TIMELINE_NAME_KEY = "Name"
+
+
+class JsonStream:
+    """
+    JSONを先頭から順に読み進めるストリームリーダー
+
+    オブジェクトや配列の骨格は1文字ずつ辿り、値そのものは
+    json.JSONDecoder.raw_decodeでまとめてデコードする。
+    保持するのは未消費のウィンドウだけなので、メモリ使用量は
+    ファイルサイズではなく最大の値の大きさに比例する。
+    """
+
+    def __init__(self, fp: BinaryIO, chunk_size: int = _CHUNK_SIZE):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self.closing_offset = -1
+
+        head = fp.read(len(_BOM))
+        self._byte_base = len(_BOM) if head == _BOM else 0
+        if head != _BOM:
+            self._buf = self._decoder.decode(head)
+
+    def _fill(self, size: Optional[int] = None) -> bool:
+        """ウィンドウにデータを追加で読み込む。EOFならFalseを返す"""
+        if self._eof:
+            return False
+        if self._pos > 0:
+            consumed = self._buf[: self._pos]
+            self._byte_base += len(consumed.encode("utf-8"))
+            self._buf = self._buf[self._pos :]
+            self._pos = 0
+        chunk = self._fp.read(size or self._chunk_size)
+        if not chunk:
+            self._eof = True
+            self._buf += self._decoder.decode(b"", final=True)
+            return False
+        self._buf += self._decoder.decode(chunk)
+        return True
+
+    def _skip_whitespace(self) -> None:
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._fill():
+                return
+
+    def peek(self) -> str:
+        """空白を読み飛ばし、次の文字を返す (EOFの場合は空文字列)"""
+        self._skip_whitespace()
+        return self._buf[self._pos] if self._pos < len(self._buf) else ""
+
+    def expect(self, char: str) -> None:
+        """次の文字がcharであることを確認して消費する"""
+        found = self.peek()
+        if found != char:
+            raise ValueError(
+                f"'{char}' が必要な位置に '{found}' があります (byte {self.tell()})"
+            )
+        self._pos += 1
+
+    def tell(self) -> int:
+        """現在位置のファイル先頭からのバイトオフセットを返す"""
+        return self._byte_base + len(self._buf[: self._pos].encode("utf-8"))
+
+    def read_value(self) -> Any:
+        """次の値を1つデコードして返す"""
+        self._skip_whitespace()
+        size = self._chunk_size
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # 値がウィンドウの途中で切れている。読み込み量を倍々に増やして再試行
+                if not self._fill(size):
+                    raise
+                size *= 2
+                continue
+            # 数値やリテラルはウィンドウ末尾で途切れている可能性がある
+            if end == len(self._buf) and self._fill(size):
+                continue
+            self._pos = end
+            return value
+
+    def skip_value(self, depth: int = 2) -> None:
+        """
+        次の値を読み飛ばす
+
+        オブジェクトや配列はdepth階層まで骨格を辿り、その先の値だけを
+        まとめてデコードして捨てる。巨大な配列を丸ごと展開せずに済む。
+        """
+        char = self.peek()
+        if depth <= 0 or not char or char not in "{[":
+            self.read_value()
+        elif char == "{":
+            for _ in self.iter_object():
+                self.skip_value(depth - 1)
+        else:
+            for _ in self.iter_array():
+                self.skip_value(depth - 1)
+
+    def iter_object(self) -> Iterator[str]:
+        """
+        オブジェクトのキーを順に返す
+
+        呼び出し側は、キーを受け取るたびに対応する値を
+        read_valueまたは入れ子のiter_object/iter_arrayで消費すること。
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError(f"オブジェクトのキーが文字列ではありません: {key!r}")
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self._pos += 1
+                continue
+            self.expect("}")
+            return
+
+    def iter_array(self) -> Iterator[int]:
+        """
+        配列の要素のインデックスを順に返す
+
+        呼び出し側は、インデックスを受け取るたびに要素を1つ消費すること。
+        ループ終了時、閉じ括弧の位置はclosing_offsetで参照できる。
+        """
+        self.expect("[")
+        index = 0
+        if self.peek() != "]":
+            while True:
+                yield index
+                index += 1
+                if self.peek() != ",":
+                    break
+                self._pos += 1
+        self.peek()
+        self.closing_offset = self.tell()
+        self.expect("]")
+
+
+@dataclass
+class TimelineScan:
+    """
+    ストリーム走査で得たタイムラインの概要
+
+    Attributes:
+        index (int): Timelines内のインデックス
+        name (str): タイムライン名 (設定されていない場合はNone)
+        fps (int): タイムラインのFPS
+        width (int): 動画の横幅 (VideoInfoに無い場合は0)
+        height (int): 動画の縦幅 (VideoInfoに無い場合は0)
+        item_count (int): アイテム数
+        last_frame (int): 最後尾のフレーム位置
+        layer_usage (dict[int, int]): レイヤー番号ごとのアイテム数
+        items_end (int): Items配列の閉じ括弧のバイトオフセット。
+            Items配列を持たない場合は-1
+    """
+
+    index: int
+    name: Optional[str] = None
+    fps: int = 60
+    width: int = 0
+    height: int = 0
+    item_count: int = 0
+    last_frame: int = 0
+    layer_usage: dict[int, int] = field(default_factory=dict)
+    items_end: int = -1
+
+    def add_item(self, item: dict[str, Any]) -> None:
+        """アイテム1つ分を集計に反映する"""
+        self.item_count += 1
+        end_frame = item.get("Frame", 0) + item.get("Length", 0)
+        if end_frame > self.last_frame:
+            self.last_frame = end_frame
+        layer = item.get("Layer", 0)
+        self.layer_usage[layer] = self.layer_usage.get(layer, 0) + 1
+
+
+@dataclass
+class ProjectScan:
+    """
+    ストリーム走査で得たプロジェクトの概要
+
+    Attributes:
+        timelines (list[TimelineScan]): タイムラインごとの概要
+        values (dict[str, Any]): SUMMARY_VALUE_KEYSのトップレベルの値
+    """
+
+    timelines: list[TimelineScan]
+    values: dict[str, Any] = field(default_factory=dict)
+
+    def find_timeline(self, timeline: TimelineRef = 0) -> Optional[TimelineScan]:
+        """
+        インデックスまたはタイムライン名で走査結果を探す
+
+        Returns:
+            TimelineScan: 該当する走査結果。無ければNone
+        """
+        for candidate in self.timelines:
+            if isinstance(timeline, int):
+                if candidate.index == timeline:
+                    return candidate
+            elif candidate.name == timeline:
+                return candidate
+        return None
+
+    def apply_splice(
+        self, timeline_index: int, new_items: list[dict[str, Any]], inserted: int
+    ) -> None:
+        """
+        Items末尾への追記を概要に反映する
+
+        Args:
+            timeline_index (int): 追記したタイムラインのインデックス
+            new_items (list[dict]): 追記したアイテム
+            inserted (int): 閉じ括弧の直前に挿入したバイト数
+        """
+        target = self.timelines[timeline_index]
+        offset = target.items_end
+        for timeline in self.timelines:
+            if timeline.items_end >= offset:
+                timeline.items_end += inserted
+        for item in new_items:
+            target.add_item(item)
+
+
+def _scan_items(stream: JsonStream, timeline: TimelineScan) -> None:
+    for _ in stream.iter_array():
+        item = stream.read_value()
+        if isinstance(item, dict):
+            timeline.add_item(item)
+        else:
+            timeline.item_count += 1
+    timeline.items_end = stream.closing_offset
+
+
+def _scan_timeline(stream: JsonStream, index: int) -> TimelineScan:
+    timeline = TimelineScan(index=index)
+    for key in stream.iter_object():
+        if key == "Items" and stream.peek() == "[":
+            _scan_items(stream, timeline)
+        elif key == TIMELINE_NAME_KEY:
+            name = stream.read_value()
+            timeline.name = name if isinstance(name, str) else None
+        elif key == "VideoInfo":
+            video_info = stream.read_value()
+            if isinstance(video_info, dict):
+                timeline.fps = video_info.get("FPS", timeline.fps)
+                timeline.width = video_info.get("Width", timeline.width)
+                timeline.height = video_info.get("Height", timeline.height)
+        else:
+            stream.skip_value()
+    return timeline
+
+
+def scan_ymmp_project(project_file: str) -> Optional[ProjectScan]:
+    """
+    YMM4プロジェクトファイルを全体を展開せずに1パスで走査する関数
+
+    各タイムラインのFPS・解像度・アイテム数・最後尾フレーム・レイヤー使用状況と、
+    Items配列の終端位置 (追記用のバイトオフセット)、SUMMARY_VALUE_KEYSの
+    トップレベルの値を取得する。それ以外のトップレベルの値は読み飛ばすため、
+    メモリ使用量はファイルサイズではなく、アイテム1つ分とSUMMARY_VALUE_KEYSの
+    値の大きさに比例する。
+
+    Args:
+        project_file (str): プロジェクトファイルのパス
+
+    Returns:
+        ProjectScan: 走査結果。ファイルが読めない、または
+            Timelinesを持たない場合はNone
+    """
+    try:
+        with open(project_file, "rb") as f:
+            stream = JsonStream(f)
+            timelines: list[TimelineScan] = []
+            values: dict[str, Any] = {}
+            if stream.peek() != "{":
+                return None
+            for key in stream.iter_object():
+                if key in SUMMARY_VALUE_KEYS:
+                    values[key] = stream.read_value()
+                    continue
+                if key != "Timelines":
+                    stream.skip_value(depth=3)
+                    continue
+                if stream.peek() != "[":
+                    stream.skip_value()
+                    continue
+                for index in stream.iter_array():
+                    if stream.peek() != "{":
+                        return None
+                    timelines.append(_scan_timeline(stream, index))
+            if stream.peek() != "":
+                return None
+    except (OSError, ValueError) as e:
+        logger.error(
+            f"エラー: プロジェクトファイル '{project_file}' の走査に失敗しました: {e}"
+        )
+        return None
+
+    if not timelines:
+        return None
+    return ProjectScan(timelines=timelines, values=values)
+
+
+def read_ymmp_value(project_file: str, key: str) -> Any:
+    """
+    YMM4プロジェクトファイルのトップレベルの値を1つだけ読み出す関数
+
+    SUMMARY_VALUE_KEYSのキーは概要キャッシュ (get_ymmp_summary) から返すため、
+    ファイルの走査は更新後の最初の1回だけで済む。それ以外のキーと概要を
+    作れない場合は、指定したキー以外の値を骨格を辿って読み飛ばす。
+
+    Args:
+        project_file (str): プロジェクトファイルのパス
+        key (str): 読み出すトップレベルのキー
+
+    Returns:
+        Any: キーに対応する値。存在しない場合はNone
+    """
+    if key in SUMMARY_VALUE_KEYS:
+        summary = get_ymmp_summary(project_file)
+        if summary is not None:
+            return summary.values.get(key)
+    with open(project_file, "rb") as f:
+        stream = JsonStream(f)
+        for found in stream.iter_object():
+            if found == key:
+                return stream.read_value()
+            stream.skip_value(depth=3)
+    return None
+
+
+def read_ymmp_skeleton(project_file: str, timeline_index: int = 0) -> dict[str, Any]:
+    """
+    指定したタイムラインのItemsだけを空にしたプロジェクトデータを読み込む関数
+
+    対象のItemsはアイテムを1つずつ読み飛ばすため、アイテム全体は展開しない。
+    iter_timeline_itemsと組み合わせると、プロジェクトを丸ごと展開せずに
+    アイテムを差し替えたプロジェクトを書き出せる。
+
+    Args:
+        project_file (str): プロジェクトファイルのパス
+        timeline_index (int): Itemsを空にするタイムラインのインデックス
+
+    Returns:
+        dict: 対象のItemsが空のプロジェクトデータ
+
+    Raises:
+        ValueError: JSONの構造が不正な場合
+    """
+    skeleton: dict[str, Any] = {}
+    with open(project_file, "rb") as f:
+        stream = JsonStream(f)
+        for key in stream.iter_object():
+            if key != "Timelines" or stream.peek() != "[":
+                skeleton[key] = stream.read_value()
+                continue
+            timelines: list[Any] = []
+            for index in stream.iter_array():
+                if index != timeline_index or stream.peek() != "{":
+                    timelines.append(stream.read_value())
+                    continue
+                timeline: dict[str, Any] = {}
+                for timeline_key in stream.iter_object():
+                    if timeline_key == "Items":
+                        stream.skip_value(depth=1)
+                        timeline[timeline_key] = []
+                    else:
+                        timeline[timeline_key] = stream.read_value()
+                timelines.append(timeline)
+            skeleton[key] = timelines
+    return skeleton
+
+
+def iter_timeline_items(
+    project_file: str, timeline_index: int = 0
+) -> Iterator[dict[str, Any]]:
+    """
+    指定したタイムラインのアイテムを1つずつ読み出すジェネレーター
+
+    保持するのは読み出し中のアイテム1つ分だけなので、
+    巨大なプロジェクトでもメモリ使用量は一定に保たれる。
+
+    Args:
+        project_file (str): プロジェクトファイルのパス
+        timeline_index (int): 対象のタイムラインのインデックス
+
+    Yields:
+        dict: アイテム
+
+    Raises:
+        ValueError: JSONの構造が不正な場合
+    """
+    with open(project_file, "rb") as f:
+        stream = JsonStream(f)
+        for key in stream.iter_object():
+            if key != "Timelines":
+                stream.skip_value(depth=3)
+                continue
+            for index in stream.iter_array():
+                if index != timeline_index:
+                    stream.skip_value(depth=2)
+                    continue
+                for timeline_key in stream.iter_object():
+                    if timeline_key != "Items":
+                        stream.skip_value()
+                        continue
+                    for _ in stream.iter_array():
+                        item = stream.read_value()
+                        if isinstance(item, dict):
+                            yield item
+                    return
+
+
+def get_summary_path(project_file: str) -> Path:
+    """
+    プロジェクトファイルに対応する概要キャッシュ (サイドカー) のパスを返す関数
+    """
+    path = Path(project_file)
+    return path.with_name(f".{path.name}.summary.json")
+
+
+def _file_signature(project_file: str) -> tuple[int, int]:
+    stat = os.stat(project_file)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _summary_from_json(data: dict[str, Any]) -> ProjectScan:
+    timelines = []
+    for timeline in data["timelines"]:
+        timeline["layer_usage"] = {
+            int(layer): count for layer, count in timeline["layer_usage"].items()
+        }
+        timelines.append(TimelineScan(**timeline))
+    return ProjectScan(timelines=timelines, values=data["values"])
+
+
+def load_cached_summary(project_file: str) -> Optional[ProjectScan]:
+    """
+    サイドカーに保存された概要を読み込む関数
+
+    プロジェクトファイルの更新日時とサイズがキャッシュ作成時と異なる場合は
+    無効とみなす。
+
+    Args:
+        project_file (str): プロジェクトファイルのパス
+
+    Returns:
+        ProjectScan: 有効なキャッシュがあればその概要、無ければNone
+    """
+    try:
+        mtime_ns, size = _file_signature(project_file)
+        with open(get_summary_path(project_file), encoding="utf-8") as f:
+            data = json.load(f)
+        if (
+            data.get("version") != _SUMMARY_VERSION
+            or data.get("mtime_ns") != mtime_ns
+            or data.get("size") != size
+        ):
+            return None
+        return _summary_from_json(data)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_cached_summary(project_file: str, summary: ProjectScan) -> None:
+    """
+    概要をサイドカーに保存する関数
+
+    キャッシュは補助的なものなので、書き込みに失敗しても例外は送出しない。
+
+    Args:
+        project_file (str): プロジェクトファイルのパス
+        summary (ProjectScan): 保存する概要
+    """
+    try:
+        mtime_ns, size = _file_signature(project_file)
+        data = {
+            "version": _SUMMARY_VERSION,
+            "mtime_ns": mtime_ns,
+            "size": size,
+            "timelines": [asdict(timeline) for timeline in summary.timelines],
+            "values": summary.values,
+        }
+        get_summary_path(project_file).write_text(
+            json.dumps(data, ensure_ascii=False), encoding="utf-8"
+        )
+    except OSError:
+        pass
+
+
+def get_ymmp_summary(
+    project_file: str, use_cache: bool = True
+) -> Optional[ProjectScan]:
+    """
+    YMM4プロジェクトファイルの概要を取得する関数
+
+    有効なサイドカーキャッシュがあればそれを返し、無ければ
+    scan_ymmp_projectで走査した結果をキャッシュしてから返す。
+
+    Args:
+        project_file (str): プロジェクトファイルのパス
+        use_cache (bool): サイドカーキャッシュを使うかどうか
+
+    Returns:
+        ProjectScan: 概要。走査できない場合はNone
+    """
+    if use_cache:
+        summary = load_cached_summary(project_file)
+        if summary is not None:
+            return summary
+    summary = scan_ymmp_project(project_file)
+    if summary is not None and use_cache:
+        save_cached_summary(project_file, summary)
+    return summary
+
+
+def find_appendable_timeline(
+    project_file: str, timeline: TimelineRef = 0
+) -> Optional[TimelineScan]:
+    """
+    Items配列の末尾へ直接追記できるタイムラインを探す関数
+
+    Args:
+        project_file (str): プロジェクトファイルのパス
+        timeline (int | str): 対象のタイムラインのインデックスまたは名前
+
+    Returns:
+        TimelineScan: 追記可能な場合はその走査結果、できない場合はNone
+    """
+    scan = get_ymmp_summary(project_file)
+    found = scan.find_timeline(timeline) if scan is not None else None
+    return found if found is not None and found.items_end >= 0 else None
@@ -0,0 +1,159 @@
+# ruff: noqa: RUF002
+import threading
+from typing import Any
+
+from .ymmp_stream import TIMELINE_NAME_KEY, TimelineRef, TimelineScan
+
+
+def parse_timeline_ref(value: str) -> TimelineRef:
+    """
+    コマンドライン引数などの文字列をタイムラインの指定に変換する関数
+
+    数字だけの文字列はインデックス、それ以外はタイムライン名として扱う。
+    """
+    return int(value) if value.isdigit() else value
+
+
+def resolve_timeline_index(
+    timelines: list[dict[str, Any]], timeline: TimelineRef = 0
+) -> int:
+    """
+    タイムラインの指定をTimelines内のインデックスに解決する関数
+
+    Args:
+        timelines (list[dict]): プロジェクトのTimelines
+        timeline (int | str): インデックスまたはタイムライン名
+
+    Returns:
+        int: Timelines内のインデックス
+
+    Raises:
+        ValueError: 該当するタイムラインが無い場合
+    """
+    if isinstance(timeline, int):
+        if 0 <= timeline < len(timelines):
+            return timeline
+    else:
+        for index, candidate in enumerate(timelines):
+            if candidate.get(TIMELINE_NAME_KEY) == timeline:
+                return index
+    raise ValueError(f"タイムラインが見つかりません: {timeline}")
+
+
+def get_timeline(
+    project_data: dict[str, Any], timeline: TimelineRef = 0
+) -> dict[str, Any]:
+    """
+    プロジェクトデータから指定したタイムラインを取得する関数
+
+    Args:
+        project_data (dict): YMM4プロジェクトデータ
+        timeline (int | str): インデックスまたはタイムライン名
+
+    Returns:
+        dict: タイムライン
+
+    Raises:
+        ValueError: 該当するタイムラインが無い場合
+    """
+    timelines: list[dict[str, Any]] = project_data.get("Timelines") or []
+    return timelines[resolve_timeline_index(timelines, timeline)]
+
+
+def get_timeline_fps(project_data: dict[str, Any], timeline: TimelineRef = 0) -> int:
+    """
+    指定したタイムラインのFPSを取得する関数 (未設定の場合は60)
+    """
+    fps: int = get_timeline(project_data, timeline).get("VideoInfo", {}).get("FPS", 60)
+    return fps
+
+
+class TimelineIndex:
+    """
+    1つのタイムラインに対する集計値のキャッシュ
+
+    最後尾フレームやレイヤー使用状況を最初に一度だけ計算し、
+    以降はappendのたびに差分だけを反映する。タイムラインごとに
+    ロックを持つため、別々のタイムラインは並行して編集できる。
+    """
+
+    def __init__(self, timeline: dict[str, Any], index: int):
+        self.timeline = timeline
+        self.lock = threading.Lock()
+        video_info = timeline.get("VideoInfo", {})
+        self.summary = TimelineScan(
+            index=index,
+            name=timeline.get(TIMELINE_NAME_KEY),
+            fps=video_info.get("FPS", 60),
+            width=video_info.get("Width", 0),
+            height=video_info.get("Height", 0),
+        )
+        for item in timeline.setdefault("Items", []):
+            self.summary.add_item(item)
+
+    @property
+    def fps(self) -> int:
+        return self.summary.fps
+
+    @property
+    def last_frame(self) -> int:
+        return self.summary.last_frame
+
+    def append(self, item: dict[str, Any]) -> None:
+        """アイテムをタイムラインに追加し、集計値を更新する"""
+        with self.lock:
+            self.timeline["Items"].append(item)
+            self.summary.add_item(item)
+
+    def append_after_last(self, item: dict[str, Any], margin: float = 0) -> int:
+        """
+        タイムラインの最後尾からmarginフレーム空けた位置にアイテムを追加する
+
+        最後尾の取得と追加を1つのロックの中で行うため、並行して追加しても重ならない。
+
+        Returns:
+            int: 追加したアイテムの開始フレーム
+        """
+        with self.lock:
+            frame = int(self.summary.last_frame + margin)
+            item["Frame"] = frame
+            self.timeline["Items"].append(item)
+            self.summary.add_item(item)
+        return frame
+
+
+class ProjectIndex:
+    """
+    プロジェクト内の各タイムラインのTimelineIndexを管理するクラス
+
+    TimelineIndexは初めて参照されたときに作成する。
+    """
+
+    def __init__(self, project_data: dict[str, Any]):
+        self.project_data = project_data
+        self._timelines: dict[int, TimelineIndex] = {}
+        self._lock = threading.Lock()
+
+    def timeline(self, timeline: TimelineRef = 0) -> TimelineIndex:
+        """
+        指定したタイムラインのTimelineIndexを取得する
+
+        Raises:
+            ValueError: 該当するタイムラインが無い場合
+        """
+        timelines: list[dict[str, Any]] = self.project_data.get("Timelines") or []
+        index = resolve_timeline_index(timelines, timeline)
+        with self._lock:
+            timeline_index = self._timelines.get(index)
+            if timeline_index is None:
+                timeline_index = TimelineIndex(timelines[index], index)
+                self._timelines[index] = timeline_index
+        return timeline_index
+
+    def append(self, item: dict[str, Any], timeline: TimelineRef = 0) -> None:
+        """指定したタイムラインにアイテムを追加する"""
+        self.timeline(timeline).append(item)
+
+    def last_frame(self, timeline: TimelineRef = 0) -> int:
+        """指定したタイムラインの最後尾のフレーム位置を取得する"""
+        return self.timeline(timeline).last_frame
@@ -1,7 +1,58 @@
 # ruff: noqa: RUF002
 import json
+import logging
+import os
+import shutil
+import tempfile
 import wave
-from typing import Any, Optional
+from pathlib import Path
+from typing import Any, BinaryIO, Optional
+
+from .tracing import span
+from .ymmp_cache import gc_paused, get_snapshot_key, load_snapshot, store_snapshot
+from .ymmp_stream import (
+    TimelineRef,
+    TimelineScan,
+    get_ymmp_summary,
+    load_cached_summary,
+    save_cached_summary,
+)
+from .ymmp_timeline import get_timeline
+
+logger = logging.getLogger(__name__)
+
+_COPY_CHUNK_SIZE = 1 << 20
+
+# Items配列の閉じ括弧の行のインデントを探すときに、閉じ括弧の前から読む最大バイト数
+_LAYOUT_WINDOW = 1 << 16
+
+
+def read_ymmp_file(project_file: str) -> dict[str, Any]:
+    """
+    YMM4プロジェクトファイルを解析する関数 (スナップショットキャッシュ経由)
+
+    パス・更新日時・サイズ・内容のダイジェストが一致するスナップショットがあれば
+    JSONを解析せずにそこから読み込む。無ければJSONを解析してスナップショットを作る。
+
+    Args:
+        project_file (str): プロジェクトファイルのパス
+
+    Returns:
+        dict: プロジェクトデータ
+
+    Raises:
+        FileNotFoundError: ファイルが存在しない場合
+        json.JSONDecodeError: JSONの解析に失敗した場合
+    """
+    with span("project.load", path=project_file) as load_span:
+        key = get_snapshot_key(project_file)
+        project_data = load_snapshot(key)
+        load_span.set(bytes=key.size, snapshot=project_data is not None)
+        if project_data is None:
+            with open(project_file, encoding="utf-8-sig") as f, gc_paused():
+                project_data = dict(json.load(f))
+            store_snapshot(key, project_data)
+    return project_data
 
 
 def load_ymmp_project(project_file: str) -> Optional[dict[str, Any]]:
@@ -15,32 +66,33 @@ def load_ymmp_project(project_file: str) -> Optional[dict[str, Any]]:
         dict: プロジェクトデータ。エラーの場合はNone
     """
     try:
-        with open(project_file, encoding="utf-8-sig") as f:
-            project_data: dict[str, Any] = json.load(f)
-        return project_data
+        return read_ymmp_file(project_file)
     except FileNotFoundError:
-        print(f"エラー: プロジェクトファイル '{project_file}' が見つかりません。")
+        logger.error(
+            f"エラー: プロジェクトファイル '{project_file}' が見つかりません。"
+        )
         return None
     except json.JSONDecodeError as e:
-        print(
+        logger.error(
             f"エラー: プロジェクトファイル '{project_file}' のJSON解析に失敗しました: {e}"
         )
         return None
 
 
-def get_last_frame(project_data: dict[str, Any]) -> int:
+def get_last_frame(project_data: dict[str, Any], timeline: TimelineRef = 0) -> int:
     """
     プロジェクトのタイムラインの最後尾のフレーム位置を取得する関数
 
     Args:
         project_data (dict): YMM4プロジェクトデータ
+        timeline (int | str): 対象のタイムラインのインデックスまたは名前
 
     Returns:
         int: 最後尾のフレーム位置
     """
     last_frame = 0
     if "Timelines" in project_data and project_data.get("Timelines"):
-        for item in project_data["Timelines"][0]["Items"]:
+        for item in get_timeline(project_data, timeline)["Items"]:
             end_frame = item.get("Frame", 0) + item.get("Length", 0)
             if end_frame > last_frame:
                 last_frame = end_frame
@@ -58,13 +110,140 @@ def save_ymmp_project(project_data: dict[str, Any], output_file: str) -> bool:
     Returns:
         bool: 保存が成功した場合はTrue、失敗した場合はFalse
     """
+    output_path = Path(output_file)
+    tmp_path: Optional[str] = None
     try:
-        with open(output_file, "w", encoding="utf-8-sig") as f:
+        # 書き込み途中のファイルを他の処理が読まないよう、一時ファイルから置き換える
+        with (
+            span("project.save", path=output_file, method="dump"),
+            tempfile.NamedTemporaryFile(
+                "w",
+                encoding="utf-8-sig",
+                dir=output_path.parent,
+                prefix=f".{output_path.name}.",
+                suffix=".tmp",
+                delete=False,
+            ) as f,
+        ):
+            tmp_path = f.name
             json.dump(project_data, f, indent=2, ensure_ascii=False)
-        print(f"プロジェクトファイルを保存しました: {output_file}")
+        os.replace(tmp_path, output_path)
+        logger.info(f"プロジェクトファイルを保存しました: {output_file}")
         return True
     except Exception as e:
-        print(f"エラー: ファイルの書き込みに失敗しました: {e}")
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        logger.error(f"エラー: ファイルの書き込みに失敗しました: {e}")
+        return False
+
+
+def dump_item(item: Any, pad: str) -> str:
+    """json.dump(indent=2)で、インデントpadの位置に置かれた配列の要素1つと同じ文字列を作る"""
+    return json.dumps(item, indent=2, ensure_ascii=False).replace("\n", "\n" + pad)
+
+
+def _items_layout(src: BinaryIO, items_end: int) -> tuple[int, str]:
+    """
+    Items配列の最後の要素 (空の場合は開き括弧) の直後のバイトオフセットと、
+    閉じ括弧の行のインデントを返す
+    """
+    start = max(0, items_end - _LAYOUT_WINDOW)
+    src.seek(start)
+    window = src.read(items_end - start)
+    src.seek(0)
+    content_end = start + len(window.rstrip(b" \t\r\n"))
+    newline = window.rfind(b"\n")
+    if newline < 0 and start > 0:
+        return content_end, ""
+    line = window[newline + 1 :]
+    return content_end, line[: len(line) - len(line.lstrip(b" "))].decode("ascii")
+
+
+def _copy_bytes(src: BinaryIO, dst: BinaryIO, size: int) -> None:
+    remaining = size
+    while remaining > 0:
+        chunk = src.read(min(remaining, _COPY_CHUNK_SIZE))
+        if not chunk:
+            raise ValueError("プロジェクトファイルが走査後に短くなっています。")
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+
+def splice_ymmp_items(
+    project_file: str,
+    new_items: list[dict[str, Any]],
+    output_file: str,
+    timeline: TimelineScan,
+) -> bool:
+    """
+    プロジェクト全体を再シリアライズせず、Items配列の末尾にアイテムを追記する関数
+
+    元ファイルのバイト列をそのまま一時ファイルへコピーしつつ、
+    Items配列の最後の要素の直後に新しいアイテムのJSONだけを書き込み、
+    最後にアトミックに置き換える。アイテムはItems配列の深さに合わせて
+    インデントするため、save_ymmp_project (YmmpItemWriter) で保存し直した
+    場合と同じ内容になる。
+
+    Args:
+        project_file (str): 元のプロジェクトファイルのパス
+        new_items (list[dict]): 追記するアイテム
+        output_file (str): 出力ファイルのパス (project_fileと同じでもよい)
+        timeline (TimelineScan): find_appendable_timelineで得た追記先の走査結果
+
+    Returns:
+        bool: 保存が成功した場合はTrue、失敗した場合はFalse
+    """
+    summary = load_cached_summary(project_file)
+    output_path = Path(output_file)
+    tmp_path: Optional[str] = None
+    try:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with (
+            span("project.save", path=output_file, method="splice"),
+            open(project_file, "rb") as src,
+            tempfile.NamedTemporaryFile(
+                dir=output_path.parent,
+                prefix=f".{output_path.name}.",
+                suffix=".tmp",
+                delete=False,
+            ) as dst,
+        ):
+            tmp_path = dst.name
+            content_end, indent = _items_layout(src, timeline.items_end)
+            pad = indent + "  "
+            payload = "".join(
+                ("\n" if number == 0 and not timeline.item_count else ",\n")
+                + pad
+                + dump_item(item, pad)
+                for number, item in enumerate(new_items)
+            ).encode("utf-8")
+            if new_items:
+                payload += ("\n" + indent).encode("utf-8")
+            else:
+                content_end = timeline.items_end
+            _copy_bytes(src, dst, content_end)
+            src.seek(timeline.items_end)
+            if src.read(1) != b"]":
+                raise ValueError("追記位置がItems配列の終端と一致しません。")
+            dst.write(payload)
+            dst.write(b"]")
+            shutil.copyfileobj(src, dst, _COPY_CHUNK_SIZE)
+        os.replace(tmp_path, output_path)
+        # 追記内容は分かっているので、出力ファイルの概要は走査し直さずに更新する
+        if (
+            summary is not None
+            and timeline.index < len(summary.timelines)
+            and summary.timelines[timeline.index].items_end == timeline.items_end
+        ):
+            inserted = content_end + len(payload) - timeline.items_end
+            summary.apply_splice(timeline.index, new_items, inserted)
+            save_cached_summary(output_file, summary)
+        logger.info(f"プロジェクトファイルに追記しました: {output_file}")
+        return True
+    except (OSError, ValueError) as e:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        logger.error(f"エラー: ファイルへの追記に失敗しました: {e}")
         return False
 
 
@@ -82,7 +261,7 @@ def get_wav_duration_and_frames(wav_path: str, fps: int = 60) -> tuple[int, str]
             time_str = f"00:00:{duration_sec:09.7f}"
             return duration_frames, time_str
     except Exception as e:
-        print(f"Error reading WAV file {wav_path}: {e}")
+        logger.error(f"Error reading WAV file {wav_path}: {e}")
         return 0, "00:00:00.0000000"
 
 
@@ -96,8 +275,21 @@ def get_ymmp_data(ymmp_path: str) -> dict[str, Any]:
     Returns:
         dict[str, Any]: YMMPファイルのデータ
     """
-    with open(ymmp_path, encoding="utf-8") as f:
-        return dict(json.load(f))
+    return read_ymmp_file(ymmp_path)
+
+
+def _read_top_level_value(ymmp_path: str, key: str) -> Any:
+    """
+    YMMPファイルのトップレベルの値 (SUMMARY_VALUE_KEYSのいずれか) を読み出す関数
+
+    概要キャッシュ (get_ymmp_summary) から返し、概要を作れない場合は
+    スナップショットキャッシュ経由 (read_ymmp_file) で読み込む。
+    どちらの場合も、ファイルが更新されない限り再解析しない。
+    """
+    summary = get_ymmp_summary(ymmp_path)
+    if summary is not None:
+        return summary.values.get(key)
+    return read_ymmp_file(ymmp_path).get(key)
 
 
 def get_ymmp_metadata(ymmp_path: str) -> dict[str, Any]:
@@ -110,8 +302,7 @@ def get_ymmp_metadata(ymmp_path: str) -> dict[str, Any]:
     Returns:
         dict[str, Any]: YMMPファイルのメタデータ
     """
-    data = get_ymmp_data(ymmp_path)
-    return dict(data.get("metadata", {}))
+    return dict(_read_top_level_value(ymmp_path, "metadata") or {})
 
 
 def get_ymmp_tracks(ymmp_path: str) -> dict[str, Any]:
@@ -124,8 +315,7 @@ def get_ymmp_tracks(ymmp_path: str) -> dict[str, Any]:
     Returns:
         dict[str, Any]: YMMPファイルのトラック情報
     """
-    data = get_ymmp_data(ymmp_path)
-    return dict(data.get("tracks", {}))
+    return dict(_read_top_level_value(ymmp_path, "tracks") or {})
 
 
 def get_ymmp_track_data(ymmp_path: str, track_id: str) -> dict[str, Any]:
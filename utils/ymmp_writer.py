@@ -0,0 +1,257 @@
+# ruff: noqa: RUF002
+import codecs
+import json
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from pathlib import Path
+from types import TracebackType
+from typing import IO, Any, Optional, TextIO
+
+from .tracing import span
+from .ymmp_lock import FileVersion, get_file_version, merge_new_items, project_lock
+from .ymmp_stream import TimelineRef, TimelineScan
+from .ymmp_timeline import resolve_timeline_index
+from .ymmp_utils import dump_item, load_ymmp_project, save_ymmp_project
+
+logger = logging.getLogger(__name__)
+
+
+def _dump_items(items: list[Any], indent: str) -> str:
+    """json.dump(indent=2)でItemsを書き出したときと同じ文字列を作る"""
+    return dump_item(items, indent)
+
+
+class YmmpItemWriter:
+    """
+    アイテムを1つずつ書き出しながらプロジェクトファイルを作るクラス
+
+    Items以外の部分 (骨格) は先に書き出し、主タイムラインのアイテムは
+    writeされるたびにファイルへ直接追記する。主タイムラインより後ろの
+    タイムラインへのアイテムは一時ファイルに溜めておき、終了時に差し込む。
+    いずれの場合も結合後のアイテム一覧をメモリ上に作らずに済む。
+    出力はsave_ymmp_projectと同じ形式 (BOM付きUTF-8、インデント2) になる。
+    書き込みは一時ファイルに対して行い、正常終了時にアトミックに置き換える。
+
+    mergeを指定した場合、置き換えの前に出力先がloaded_versionから変わって
+    いないかをロックを取った上で確認し、他の処理が先に保存していれば
+    commit_project_itemsと同じく出力先を読み込み直して、書き出したアイテム
+    だけを追加し直す (このときだけプロジェクト全体をメモリに読み込む)。
+
+    使い方:
+        with YmmpItemWriter(skeleton, "output.ymmp") as writer:
+            for item in items:
+                writer.write(item)
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        skeleton: dict[str, Any],
+        output_file: str,
+        timeline_index: int = 0,
+        loaded_version: Optional[FileVersion] = None,
+        merge: bool = False,
+        rebase: bool = False,
+    ):
+        """
+        Args:
+            skeleton (dict): 出力するプロジェクトデータ。各タイムラインの既存のItemsは
+                書き出したアイテムの前に置かれる
+            output_file (str): 出力ファイルのパス
+            timeline_index (int): アイテムを直接書き出す主タイムラインのインデックス
+            loaded_version (Optional[FileVersion]): skeletonを読み込む前の出力先の
+                バージョン (get_file_versionの結果)
+            merge (bool): 出力先が他の処理で更新されていた場合に、読み込み直して
+                追加するかどうか (Falseの場合はそのまま置き換える)
+            rebase (bool): 読み込み直した場合に、アイテムを最後尾の後ろへずらすかどうか
+        """
+        self.output_file = output_file
+        self.timeline_index = timeline_index
+        self.loaded_version = loaded_version
+        self.merge = merge
+        self.rebase = rebase
+        self.merged = False
+        self._timelines: list[dict[str, Any]] = list(skeleton["Timelines"])
+        self.summaries: dict[int, TimelineScan] = {
+            timeline_index: TimelineScan(index=timeline_index)
+        }
+        self._parts, self._indents = self._split_skeleton(skeleton)
+        self._spools: dict[int, IO[str]] = {}
+        self._file: Optional[TextIO] = None
+        self._tmp_path: Optional[str] = None
+
+    @property
+    def summary(self) -> TimelineScan:
+        """主タイムラインに書き出したアイテムの集計"""
+        return self.summaries[self.timeline_index]
+
+    def _split_skeleton(self, skeleton: dict[str, Any]) -> tuple[list[str], list[str]]:
+        """骨格を各タイムラインのItemsの値の前後で分割し、アイテムのインデントと共に返す"""
+        markers = [f"__ymmp_items_{uuid.uuid4().hex}__" for _ in self._timelines]
+        timelines = [
+            {**timeline, "Items": marker}
+            for timeline, marker in zip(self._timelines, markers)
+        ]
+        text = json.dumps(
+            {**skeleton, "Timelines": timelines}, indent=2, ensure_ascii=False
+        )
+        parts: list[str] = []
+        indents: list[str] = []
+        for marker in markers:
+            head, text = text.split(json.dumps(marker), 1)
+            line = head[head.rfind("\n") + 1 :]
+            parts.append(head)
+            indents.append(line[: len(line) - len(line.lstrip(" "))])
+        parts.append(text)
+        return parts, indents
+
+    def _original_items(self, index: int) -> list[Any]:
+        items: list[Any] = self._timelines[index].get("Items", [])
+        return items
+
+    def __enter__(self) -> "YmmpItemWriter":
+        output_path = Path(self.output_file)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(
+            dir=output_path.parent, prefix=f".{output_path.name}.", suffix=".tmp"
+        )
+        self._file = open(fd, "w", encoding="utf-8")
+        self._file.write(codecs.BOM_UTF8.decode("utf-8"))
+        for index in range(self.timeline_index):
+            self._file.write(self._parts[index])
+            self._file.write(
+                _dump_items(self._original_items(index), self._indents[index])
+            )
+        self._file.write(self._parts[self.timeline_index])
+        for item in self._original_items(self.timeline_index):
+            self.write(item)
+        return self
+
+    def _target(self, index: int) -> TextIO:
+        """アイテムの書き込み先 (主タイムラインなら出力ファイル、それ以外は一時ファイル)"""
+        if self._file is None:
+            raise RuntimeError("YmmpItemWriterはwith文の中で使用してください。")
+        if index == self.timeline_index:
+            return self._file
+        if index < self.timeline_index:
+            raise ValueError(
+                f"主タイムライン ({self.timeline_index}) より前のタイムライン"
+                f" ({index}) にはアイテムを追加できません。"
+            )
+        spool = self._spools.get(index)
+        if spool is None:
+            spool = tempfile.TemporaryFile("w+", encoding="utf-8")
+            self._spools[index] = spool
+            summary = TimelineScan(index=index)
+            pad = self._indents[index] + "  "
+            for item in self._original_items(index):
+                spool.write(("[\n" if summary.item_count == 0 else ",\n") + pad)
+                spool.write(dump_item(item, pad))
+                summary.add_item(item)
+            self.summaries[index] = summary
+        return spool
+
+    def write(
+        self, item: dict[str, Any], timeline: Optional[TimelineRef] = None
+    ) -> None:
+        """
+        アイテムを1つ書き出す
+
+        Args:
+            item (dict): アイテム
+            timeline (int | str, optional): 追加先のタイムライン。省略時は主タイムライン
+        """
+        index = (
+            self.timeline_index
+            if timeline is None
+            else resolve_timeline_index(self._timelines, timeline)
+        )
+        target = self._target(index)
+        summary = self.summaries[index]
+        pad = self._indents[index] + "  "
+        target.write(("[\n" if summary.item_count == 0 else ",\n") + pad)
+        target.write(dump_item(item, pad))
+        summary.add_item(item)
+
+    def _close_items(self, target: TextIO, index: int) -> None:
+        count = self.summaries[index].item_count
+        target.write(f"\n{self._indents[index]}]" if count else "[]")
+
+    def _finish(self, output: TextIO) -> None:
+        self._close_items(output, self.timeline_index)
+        for index in range(self.timeline_index + 1, len(self._timelines)):
+            output.write(self._parts[index])
+            spool = self._spools.get(index)
+            if spool is None:
+                output.write(
+                    _dump_items(self._original_items(index), self._indents[index])
+                )
+                continue
+            self._close_items(spool, index)
+            spool.seek(0)
+            shutil.copyfileobj(spool, output)
+        output.write(self._parts[-1])
+
+    def _has_conflict(self) -> bool:
+        """出力先が読み込み時から他の処理で書き換えられたかどうか"""
+        current_version = get_file_version(self.output_file)
+        return (
+            self.merge
+            and current_version is not None
+            and current_version != self.loaded_version
+        )
+
+    def _merge_into_latest(self, written_path: str) -> None:
+        """出力先を読み込み直し、書き出したアイテムだけを追加して保存する"""
+        logger.info(
+            f"{self.output_file} が他の処理で更新されていたため、読み込み直して追加します。"
+        )
+        with open(written_path, encoding="utf-8-sig") as f:
+            written = json.load(f)["Timelines"]
+        new_items: list[tuple[TimelineRef, dict[str, Any]]] = [
+            (index, item)
+            for index in sorted(self.summaries)
+            for item in written[index]["Items"][len(self._original_items(index)) :]
+        ]
+        latest = load_ymmp_project(self.output_file)
+        if latest is None:
+            raise RuntimeError(
+                f"更新されたプロジェクトを読み込み直せませんでした: {self.output_file}"
+            )
+        merge_new_items(latest, {"Timelines": self._timelines}, new_items, self.rebase)
+        if not save_ymmp_project(latest, self.output_file):
+            raise RuntimeError(
+                f"プロジェクトを保存できませんでした: {self.output_file}"
+            )
+        self.merged = True
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if self._file is None or self._tmp_path is None:
+            return
+        try:
+            if exc_type is None:
+                with span("project.save", path=self.output_file, method="stream"):
+                    self._finish(self._file)
+                    self._file.close()
+                    with project_lock(self.output_file):
+                        if self._has_conflict():
+                            self._merge_into_latest(self._tmp_path)
+                        else:
+                            os.replace(self._tmp_path, self.output_file)
+            else:
+                self._file.close()
+        finally:
+            for spool in self._spools.values():
+                spool.close()
+            self._spools.clear()
+            if os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+            self._file = None
+            self._tmp_path = None
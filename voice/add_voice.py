@@ -1,23 +1,36 @@
+import hashlib
+import logging
 import sys
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional, Union
 
-# プロジェクトのルートディレクトリをPythonパスに追加
-sys.path.append(str(Path(__file__).parent.parent.absolute()))
+# スクリプトとして直接実行された場合だけ、プロジェクトのルートディレクトリをPythonパスに追加
+# (パッケージとしてインポートされた場合はsys.pathを書き換えない)
+if __package__ in (None, ""):
+    sys.path.append(str(Path(__file__).parent.parent.absolute()))
 
 # isort: off
 from utils import (
+    TimelineRef,
+    append_project_items,
+    commit_project_items,
+    find_appendable_timeline,
+    get_file_version,
     get_last_frame,
+    get_timeline,
+    get_timeline_fps,
     load_ymmp_project,
-    save_ymmp_project,
 )
+from utils.tracing import span
 from utils.ymmp_templates import create_voice_item_template
 from voice.generate_voice import generate_voice, VoiceConfig
 from voice.voicevox_client import VoicevoxClient
 
 # isort: on
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class VoiceSceneConfig:
@@ -31,6 +44,8 @@ class VoiceSceneConfig:
         speaker_name (str): 話者名
         speed (float): 話速
         time_margin (float): 時間マージン
+        append (bool): Trueの場合、プロジェクト全体を書き直さずItems末尾へ追記する
+        timeline (int | str): 追加先のタイムラインのインデックスまたは名前
     """
 
     project_file: str
@@ -39,6 +54,84 @@ class VoiceSceneConfig:
     speaker_name: str = "ずんだもん"
     speed: float = 1.0
     time_margin: float = 1.0
+    append: bool = False
+    timeline: TimelineRef = 0
+
+
+def get_voice_asset_path(text: str, speed: float = 1.0) -> Path:
+    """セリフと話速から一意に決まる音声ファイルのパスを返します。
+
+    同じセリフを並行して生成しても、別々のセリフが同じファイルを奪い合わないように
+    ファイル名に内容のハッシュ値を使います。
+    """
+    digest = hashlib.sha1(f"{speed}:{text}".encode()).hexdigest()[:16]
+    return Path("output") / "voices" / f"voice_{digest}.wav"
+
+
+def render_voice_asset(
+    text: str,
+    speed: float = 1.0,
+    output_path: Optional[Union[str, Path]] = None,
+    client: Optional[VoicevoxClient] = None,
+) -> str:
+    """音声ファイルを生成します。
+
+    Args:
+        text (str): 読み上げるセリフ
+        speed (float, optional): 話速. デフォルトは1.0.
+        output_path (Union[str, Path], optional): 出力先.
+            デフォルトはget_voice_asset_pathで決まるセリフごとのパス.
+        client (VoicevoxClient, optional): 使い回すVOICEVOXクライアント.
+
+    Returns:
+        str: 生成された音声ファイルのパス
+    """
+    voice_config = VoiceConfig(
+        text=text,
+        speaker_id=1,  # ずんだもんのデフォルトID
+        speed=speed,
+    )
+    if output_path is None:
+        output_path = get_voice_asset_path(text, speed)
+    voice_file_path = generate_voice(voice_config, output_path, client)
+    if not voice_file_path or not Path(voice_file_path).exists():
+        raise RuntimeError("音声ファイルの生成に失敗したか、ファイルが見つかりません。")
+    return voice_file_path
+
+
+def build_voice_item(
+    text: str,
+    file_path: str,
+    speaker_name: str = "ずんだもん",
+    frame: int = 0,
+    length: int = 60,
+) -> dict[str, Any]:
+    """生成済みの音声ファイルから音声アイテムを組み立てます。
+
+    Args:
+        text (str): 読み上げるセリフ
+        file_path (str): 音声ファイルのパス
+        speaker_name (str, optional): 話者名. デフォルトは"ずんだもん".
+        frame (int, optional): 開始フレーム. デフォルトは0.
+        length (int, optional): 表示フレーム数. デフォルトは60.
+
+    Returns:
+        dict: 音声アイテム
+    """
+    with span("item.build", type="voice"):
+        new_voice_item = create_voice_item_template(
+            speaker_name=speaker_name,
+            frame=frame,
+            length=length,
+            file_path=str(file_path),
+        )
+
+        # 基本情報を設定
+        new_voice_item["Serif"] = text
+        new_voice_item["Hatsuon"] = text
+        new_voice_item["Remark"] = text
+
+    return new_voice_item
 
 
 def create_voice_item(
@@ -61,30 +154,17 @@ def create_voice_item(
         dict: 生成された音声アイテム
     """
     # 音声ファイルを生成
-    voice_config = VoiceConfig(
-        text=text,
-        speaker_id=1,  # ずんだもんのデフォルトID
-        speed=speed,
-    )
-    voice_file_path = generate_voice(voice_config, "output/voice.wav")
-    if not voice_file_path or not Path(voice_file_path).exists():
-        raise RuntimeError("音声ファイルの生成に失敗したか、ファイルが見つかりません。")
+    voice_file_path = render_voice_asset(text, speed)
 
     # 音声アイテムを生成
-    new_voice_item = create_voice_item_template(
+    return build_voice_item(
+        text,
+        voice_file_path,
         speaker_name=speaker_name,
         frame=frame,
         length=length,
-        file_path=str(voice_file_path),
     )
 
-    # 基本情報を設定
-    new_voice_item["Serif"] = text
-    new_voice_item["Hatsuon"] = text
-    new_voice_item["Remark"] = text
-
-    return new_voice_item
-
 
 def add_voice_scene(config: VoiceSceneConfig) -> None:
     """
@@ -93,16 +173,31 @@ def add_voice_scene(config: VoiceSceneConfig) -> None:
     Args:
         config (VoiceSceneConfig): 音声シーン設定
     """
-    # プロジェクトファイルを読み込む
-    project_data = load_ymmp_project(config.project_file)
-    if project_data is None:
-        return
-
-    # FPSを取得
-    fps = project_data.get("Timelines", [{}])[0].get("VideoInfo", {}).get("FPS", 60)
-
-    # タイムラインの最後尾の時間を取得
-    last_frame = get_last_frame(project_data)
+    # 他の処理が同じ出力先へ同時に書き込んでいないか、保存時に確認するため記録しておく
+    loaded_version = get_file_version(config.output_file)
+
+    # 追記モードでは全体を読み込まずに、FPSと最後尾の時間を走査で取得する
+    appendable = None
+    if config.append:
+        appendable = find_appendable_timeline(config.project_file, config.timeline)
+        if appendable is None:
+            logger.info("追記できない構造のため、プロジェクト全体を書き直します。")
+
+    project_data: Optional[dict[str, Any]] = None
+    if appendable is not None:
+        fps = appendable.fps
+        last_frame = appendable.last_frame
+    else:
+        # プロジェクトファイルを読み込む
+        project_data = load_ymmp_project(config.project_file)
+        if project_data is None:
+            return
+
+        # FPSを取得
+        fps = get_timeline_fps(project_data, config.timeline)
+
+        # タイムラインの最後尾の時間を取得
+        last_frame = get_last_frame(project_data, config.timeline)
 
     # 間隔を空ける (計算結果を整数に変換)
     start_frame = int(last_frame + fps * config.time_margin)
@@ -115,13 +210,32 @@ def add_voice_scene(config: VoiceSceneConfig) -> None:
         speed=config.speed,
     )
 
-    # プロジェクトデータに新しいアイテムを追加
-    project_data["Timelines"][0]["Items"].append(new_voice_item)
-
-    # 新しいプロジェクトファイルとして保存
-    if not save_ymmp_project(project_data, config.output_file):
+    if appendable is not None:
+        # 元ファイルのItems末尾へ新しいアイテムだけを書き込む
+        saved = append_project_items(
+            config.project_file,
+            [new_voice_item],
+            config.output_file,
+            appendable,
+            loaded_version,
+        )
+    elif project_data is not None:
+        # 新しいアイテムを追加して保存 (他の処理が先に保存していれば、その結果に追加する)
+        get_timeline(project_data, config.timeline)["Items"].append(new_voice_item)
+        saved = (
+            commit_project_items(
+                project_data,
+                [(config.timeline, new_voice_item)],
+                config.output_file,
+                loaded_version,
+            )
+            is not None
+        )
+    else:
+        return
+    if not saved:
         return
-    print(f"音声シーンを追加しました: {config.output_file}")
+    logger.info(f"音声シーンを追加しました: {config.output_file}")
 
 
 def add_voice(config: VoiceConfig, output_path: str) -> None:
@@ -1,6 +1,8 @@
+import os
+import tempfile
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 from .voicevox_client import VoicevoxClient
 
@@ -23,13 +25,19 @@ class VoiceConfig:
     speed: float = 1.0
 
 
-def generate_voice(config: VoiceConfig, output_path: Union[str, Path]) -> str:
+def generate_voice(
+    config: VoiceConfig,
+    output_path: Union[str, Path],
+    client: Optional[VoicevoxClient] = None,
+) -> str:
     """
     音声を生成する関数
 
     Args:
         config (VoiceConfig): 音声設定
         output_path (Union[str, Path]): 出力ファイルのパス
+        client (VoicevoxClient, optional): 使用するクライアント.
+            指定しない場合は新しく作成する (VOICEVOXの起動確認を含む).
 
     Returns:
         str: 生成された音声ファイルのパス
@@ -39,7 +47,8 @@ def generate_voice(config: VoiceConfig, output_path: Union[str, Path]) -> str:
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
     # 音声生成
-    client = VoicevoxClient()
+    if client is None:
+        client = VoicevoxClient()
 
     # 音声合成クエリの取得
     audio_query = client.get_audio_query_with_emotion_and_style(
@@ -59,7 +68,18 @@ def generate_voice(config: VoiceConfig, output_path: Union[str, Path]) -> str:
     audio_data = client.synthesize_audio(audio_query, config.speaker_id)
 
     # 音声ファイルの保存
-    output_path.write_bytes(audio_data)
+    # (同じファイルを同時に生成しても書きかけのファイルを読まないよう、一時ファイルから置き換える)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=output_path.parent, prefix=f".{output_path.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(audio_data)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
     return str(output_path)
 
@@ -1,4 +1,5 @@
 import json
+import logging
 import subprocess
 import time
 from pathlib import Path
@@ -6,16 +7,19 @@ from typing import Any, Optional, Union
 
 import requests
 
-from config import VOICEVOX_PATH
+from config import API_ENDPOINT, VOICEVOX_PATH
+from utils.tracing import span
+
+logger = logging.getLogger(__name__)
 
 
 class VoicevoxClient:
-    def __init__(self, host: str = "http://localhost:50021"):
+    def __init__(self, host: str = API_ENDPOINT):
         """
         VOICEVOX APIクライアントの初期化
 
         Args:
-            host (str): VOICEVOX APIのホストURL
+            host (str): VOICEVOX APIのホストURL (デフォルト: config.API_ENDPOINT)
         """
         self.host = host
         self.speaker_id = 1  # デフォルトの話者ID (ずんだもん)
@@ -29,7 +33,7 @@ class VoicevoxClient:
             # APIが応答するか確認
             requests.get(f"{self.host}/version")
         except requests.exceptions.ConnectionError:
-            print("VOICEVOXを起動しています...")
+            logger.info("VOICEVOXを起動しています...")
             try:
                 # VOICEVOXを起動
                 subprocess.Popen([VOICEVOX_PATH])
@@ -37,7 +41,7 @@ class VoicevoxClient:
                 for _ in range(30):  # 最大30秒待機
                     try:
                         requests.get(f"{self.host}/version")
-                        print("VOICEVOXが起動しました")
+                        logger.info("VOICEVOXが起動しました")
                         return
                     except requests.exceptions.ConnectionError:
                         time.sleep(1)
@@ -128,12 +132,13 @@ class VoicevoxClient:
                 "text": text,
                 "speaker": speaker_id,
             }
-            response = requests.post(
-                f"{self.host}/audio_query",
-                params=query_params,
-            )
-            response.raise_for_status()
-            return dict[str, Any](response.json())
+            with span("voice.audio_query", speaker=speaker_id, text_length=len(text)):
+                response = requests.post(
+                    f"{self.host}/audio_query",
+                    params=query_params,
+                )
+                response.raise_for_status()
+                return dict[str, Any](response.json())
         except requests.RequestException as e:
             raise Exception(f"音声合成クエリの取得に失敗しました: {e}") from e
 
@@ -150,13 +155,15 @@ class VoicevoxClient:
         """
         try:
             synthesis_params: dict[str, int] = {"speaker": speaker_id}
-            response = requests.post(
-                f"{self.host}/synthesis",
-                params=synthesis_params,
-                json=audio_query,
-            )
-            response.raise_for_status()
-            return response.content
+            with span("voice.synthesis", speaker=speaker_id) as synthesis_span:
+                response = requests.post(
+                    f"{self.host}/synthesis",
+                    params=synthesis_params,
+                    json=audio_query,
+                )
+                response.raise_for_status()
+                synthesis_span.set(bytes=len(response.content))
+                return response.content
         except requests.RequestException as e:
             raise Exception(f"音声の合成に失敗しました: {e}") from e
 